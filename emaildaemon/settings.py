@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'emails.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -136,14 +137,162 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Email daemon settings
 IMAP_SERVER = 'imap.gmail.com'
+IMAP_PORT = 993
+IMAP_USE_SSL = True  # Disable only for a local stand-in server (emails.fakes)
 SMTP_SERVER = 'smtp.gmail.com'
 SMTP_PORT = 587
+SMTP_USE_TLS = True  # STARTTLS; disable only for a local stand-in server (emails.fakes)
+
+# Polling / IMAP IDLE (RFC 2177) behaviour
+POLL_INTERVAL = 60  # seconds between checks in the default poll mode
+IDLE_TIMEOUT = 25 * 60  # re-issue IDLE before Gmail's ~29 minute cutoff
+ADAPTIVE_POLL_MIN = 10  # fallback poll bounds when the server lacks IDLE
+ADAPTIVE_POLL_MAX = 300
+
+# Full-message downloads are grouped into UID FETCH batches
+IMAP_FETCH_BATCH_SIZE = 50  # messages per UID FETCH command
+IMAP_FETCH_BATCH_BYTES = 8 * 1024 * 1024  # approximate payload per command
+IMAP_FETCH_PIPELINE_DEPTH = 2  # UID FETCH commands in flight at once
+# Messages larger than this are downloaded to a temporary file and streamed
+# through passthrough forwarding instead of being held in memory
+IMAP_SPOOL_THRESHOLD = 4 * 1024 * 1024
+# Fetching pauses while this many bytes of downloaded mail await forwarding
+IMAP_FETCH_MAX_IN_FLIGHT = 32 * 1024 * 1024
+
+# The IMAP session is kept open between checks; failed reconnects back off exponentially
+IMAP_RECONNECT_BACKOFF_MIN = 1
+IMAP_RECONNECT_BACKOFF_MAX = 300
+
+# Authenticated SMTP sessions are pooled and reused across forwards
+SMTP_POOL_SIZE = 2  # idle sessions kept warm; 0 opens a new session per forward
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+SMTP_POOL_MAX_IDLE = 240  # seconds; Gmail drops idle sessions after a few minutes
+
+# Sender workers deliver subscriber envelopes in parallel, each on its own SMTP
+# session (0 sends sequentially). The token bucket caps the combined rate in
+# recipients per second across all workers (None disables it).
+SMTP_SENDER_WORKERS = 0
+SMTP_SEND_QUEUE_SIZE = 100  # envelopes waiting for a worker before forwarding blocks
+SMTP_RATE_LIMIT = 5.0
+SMTP_RATE_BURST = 50
+
+# run_email_daemon --engine async: one asyncio event loop fetches, routes and
+# sends concurrently. It is bounded by the messages forwarded at once and the
+# envelopes in flight, each on its own SMTP session. SMTP_RATE_LIMIT applies too.
+ASYNC_MESSAGE_CONCURRENCY = 4
+ASYNC_SMTP_CONCURRENCY = 8
+
+# The pipeline splits each check into fetch -> parse -> route -> send stages,
+# each with its own worker threads and a bounded queue in front of it, so SMTP
+# fan-out of one message overlaps with fetching and parsing the next ones
+PIPELINE = False
+PIPELINE_PARSE_WORKERS = 1
+PIPELINE_ROUTE_WORKERS = 1
+PIPELINE_SEND_WORKERS = 4  # messages (per list) being fanned out at once
+PIPELINE_QUEUE_SIZE = 8  # items waiting in front of each stage before the one before it blocks
+
+# Bulk mode sends one copy (To: the list alias) per SMTP transaction with many
+# RCPT TOs instead of a personalised copy per subscriber
+FORWARD_BULK_ENVELOPE = False
+SMTP_MAX_RECIPIENTS = 100  # RCPT TOs per transaction (Gmail's per-message limit)
+SUBSCRIBER_CHUNK_SIZE = 500  # subscribers loaded per query while fanning out
+
+# Keep alias -> active subscribers in memory and route messages without queries;
+# changes made anywhere are picked up at the start of the next check
+ROUTING_CACHE = True
+
+# Never forward the same message (by Message-ID, or content hash without one) to
+# a list twice; the newest keys are also kept in an in-memory LRU
+MESSAGE_DEDUP = True
+DEDUP_CACHE_SIZE = 10_000
+DEDUP_TTL_DAYS = 30
+
+# A message sent to several lists reaches each subscriber once. The copy comes from
+# the list that wins the precedence rule: 'header' (addressed first in the message),
+# 'smallest' (fewest subscribers) or a tuple of aliases in priority order.
+CROSS_LIST_DEDUP = True
+CROSS_LIST_PRECEDENCE = 'header'
+
+# With the delivery queue every (message, subscriber) delivery is recorded in the
+# database before sending, retried with exponential backoff and resumed after a
+# crash; without it a failed send is only logged
+DELIVERY_QUEUE = False
+DELIVERY_MAX_ATTEMPTS = 8
+DELIVERY_RETRY_MIN = 60  # seconds before the first retry, doubled per attempt
+DELIVERY_RETRY_MAX = 6 * 60 * 60
+DELIVERY_DRAIN_LIMIT = 1000  # due deliveries loaded per drain pass
+DELIVERY_STATUS_BATCH = 1  # outcomes written back per UPDATE round; more risks re-sends after a crash
+DELIVERY_INFLIGHT_TIMEOUT = 15 * 60  # seconds a crashed sender's claimed deliveries wait before they are retried
+DELIVERY_RETENTION_DAYS = 7  # finished queue records are kept this long
+DELIVERY_CHUNK_SIZE = 1024 * 1024  # spooled messages are queued in rows of this many bytes
+
+# Passthrough mode forwards the original body bytes untouched and rewrites only
+# the top-level headers, instead of decoding and rebuilding the MIME tree
+FORWARD_PASSTHROUGH = False
 EMAIL_ADDRESS = os.getenv('EMAIL_ADDRESS')
 
 # Gmail OAuth2 credentials (replaces EMAIL_PASSWORD / App Password)
 GMAIL_CLIENT_ID = os.getenv('GMAIL_CLIENT_ID')
 GMAIL_CLIENT_SECRET = os.getenv('GMAIL_CLIENT_SECRET')
 GMAIL_REFRESH_TOKEN = os.getenv('GMAIL_REFRESH_TOKEN')
+# Point at a local stub (e.g. emails.fakes.FakeTokenServer) to run without Google
+GMAIL_TOKEN_URI = os.getenv('GMAIL_TOKEN_URI', 'https://oauth2.googleapis.com/token')
+
+# The access token is shared by the daemon and the web workers through the database
+# and refreshed by whichever process first finds it this close to expiry (seconds);
+# the daemon also refreshes it in the background so senders never wait on Google
+OAUTH_REFRESH_MARGIN = 300
+
+# Mailboxes to forward from; `run_email_daemon --supervisor` runs one process per
+# entry and `--shard NAME` runs a single one. Each entry is a dict with 'name',
+# 'account', optionally 'folder' (default INBOX), 'aliases' (the lists it forwards;
+# default all) and 'refresh_token'/'client_id'/'client_secret' (default: the GMAIL_*
+# settings above). Empty: one shard for EMAIL_ADDRESS's INBOX. For example:
+#   {'name': 'lab', 'account': 'lab@cyphy.life', 'aliases': ['lab@cyphy.life'],
+#    'refresh_token': os.getenv('LAB_REFRESH_TOKEN')}
+MAILBOX_SHARDS = []
+SHARD_RESTART_BACKOFF_MIN = 5  # seconds before restarting a crashed shard, doubled per crash
+SHARD_RESTART_BACKOFF_MAX = 300
+SHARD_STATS_INTERVAL = 60  # seconds between shard stats reports
+
+# Turn leases on to run several daemon replicas (e.g. `--supervisor` on two hosts)
+# against the same database: a shard is only worked on by the replica holding its
+# lease, and a standby replica takes it over once the holder has missed renewing it
+# for LEASE_TTL seconds. LEASE_TTL must exceed the clock skew between the hosts.
+SHARD_LEASES = False
+LEASE_TTL = 30
+LEASE_HEARTBEAT = 10  # seconds between renewals, and between standby takeover attempts
+
+# Counters and latency histograms in the Prometheus text format. The web app serves
+# them at /metrics/ to `Authorization: Bearer <METRICS_TOKEN>` only (404 while it is unset);
+# the daemon serves its own on METRICS_PORT, and under --supervisor each shard on
+# METRICS_PORT + 1 + its index in MAILBOX_SHARDS, with per-shard gauges on METRICS_PORT
+METRICS = True
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+METRICS_PORT = None
+METRICS_HOST = '127.0.0.1'
+
+# Opt-in profiling of check cycles (`run_email_daemon --profile/--profile-slow/--trace-memory`).
+# Profiled cycles are written to PROFILE_DIR as .pstats files, keeping the newest PROFILE_KEEP
+# (0 keeps all): every cycle with PROFILE_CYCLES, or only cycles slower than PROFILE_SLOW_CYCLE
+# seconds, which runs the profiler on every cycle. With TRACEMALLOC_INTERVAL set, allocations
+# are traced and the TRACEMALLOC_TOP lines that grew most since the last snapshot are logged
+# every that many seconds. At runtime SIGUSR1 toggles per-cycle profiling and SIGUSR2 takes a
+# memory snapshot (starting tracing on first use); the supervisor passes both on to its shards.
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/emaildaemon-profiles')
+PROFILE_CYCLES = False
+PROFILE_SLOW_CYCLE = None
+PROFILE_KEEP = 20
+TRACEMALLOC_INTERVAL = None
+TRACEMALLOC_TOP = 10
+TRACEMALLOC_FRAMES = 1  # stack frames kept per allocation; more frames cost more memory
+
+# Record a latency trace per list message, from its INTERNALDATE in the mailbox to the
+# last copy accepted by SMTP, with spans for fetching, routing, queueing, parsing and
+# every send (`manage.py message_traces` summarises and exports them). Costs one row
+# written per message and list; traces are kept TRACE_RETENTION_DAYS days.
+MESSAGE_TRACING = True
+TRACE_RETENTION_DAYS = 14
 
 # Add to your existing settings
 SITE_URL = 'https://mailing.cyphy.life'
@@ -155,6 +304,16 @@ EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.getenv('EMAIL_ADDRESS')
 
+# Confirmation and unsubscribe emails are queued by the views and sent by a background
+# thread in each web worker over one reused SMTP session (closed after OUTBOX_IDLE_TIMEOUT
+# idle seconds), so requests don't wait for SMTP. Unsubscribe requests for the same address
+# within OUTBOX_COALESCE_SECONDS go out as one email. With WEB_EMAIL_OUTBOX = False they
+# are sent inside the request. Queued emails are lost if the worker is killed first.
+WEB_EMAIL_OUTBOX = True
+OUTBOX_COALESCE_SECONDS = 2
+OUTBOX_IDLE_TIMEOUT = 60
+OUTBOX_QUEUE_SIZE = 1000  # beyond this, emails are sent inside the request again
+
 # Make sure these are also set
 DEFAULT_FROM_EMAIL = os.getenv('EMAIL_ADDRESS')
 SERVER_EMAIL = os.getenv('EMAIL_ADDRESS')
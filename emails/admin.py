@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import MailingList, Subscriber
+from .models import MailingList, Subscriber, MailboxCheckpoint, OutboundMessage, Delivery, ForwardedMessage, OAuthToken, ShardLease, MessageTrace
 
 @admin.register(MailingList)
 class MailingListAdmin(admin.ModelAdmin):
@@ -16,3 +16,44 @@ class SubscriberAdmin(admin.ModelAdmin):
     def get_mailing_lists(self, obj):
         return ", ".join([ml.alias for ml in obj.mailing_lists.all()])
     get_mailing_lists.short_description = 'Mailing Lists'
+
+@admin.register(MailboxCheckpoint)
+class MailboxCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('account', 'folder', 'uidvalidity', 'last_uid', 'highest_modseq', 'updated_at')
+    readonly_fields = ('updated_at',)
+
+@admin.register(OutboundMessage)
+class OutboundMessageAdmin(admin.ModelAdmin):
+    list_display = ('message_id', 'mailing_list', 'source', 'created_at')
+    list_filter = ('mailing_list',)
+    search_fields = ('message_id', 'source')
+    exclude = ('raw',)
+
+@admin.register(Delivery)
+class DeliveryAdmin(admin.ModelAdmin):
+    list_display = ('recipient', 'message', 'status', 'attempts', 'next_attempt_at', 'updated_at')
+    list_filter = ('status',)
+    search_fields = ('recipient',)
+    raw_id_fields = ('message',)
+
+@admin.register(ForwardedMessage)
+class ForwardedMessageAdmin(admin.ModelAdmin):
+    list_display = ('key', 'mailing_list_id', 'forwarded_at')
+    search_fields = ('key',)
+
+@admin.register(OAuthToken)
+class OAuthTokenAdmin(admin.ModelAdmin):
+    list_display = ('account', 'expires_at', 'refreshed_at', 'refreshing_until')
+    exclude = ('access_token',)
+    readonly_fields = ('expires_at', 'refreshed_at', 'refreshing_until')
+
+@admin.register(ShardLease)
+class ShardLeaseAdmin(admin.ModelAdmin):
+    list_display = ('name', 'holder', 'epoch', 'expires_at', 'renewed_at')
+    readonly_fields = ('holder', 'epoch', 'expires_at', 'acquired_at', 'renewed_at')
+
+@admin.register(MessageTrace)
+class MessageTraceAdmin(admin.ModelAdmin):
+    list_display = ('message_id', 'mailing_list', 'latency_ms', 'delivered', 'refused', 'fetched_at', 'completed_at')
+    list_filter = ('mailing_list',)
+    search_fields = ('trace_id', 'message_id', 'source')
@@ -0,0 +1,459 @@
+"""
+Minimal asyncio IMAP and SMTP clients for AsyncEmailDaemon: just the
+commands the daemon uses, over asyncio streams, raising the same imaplib and
+smtplib exceptions as the blocking clients so errors are handled alike.
+"""
+import asyncio
+import base64
+import contextlib
+import imaplib
+import logging
+import smtplib
+import socket
+import ssl
+import time
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+
+from .imap import EXISTS_RE, LITERAL_SIZE_RE, UNTAGGED_FETCH_RE, parse_fetch
+from .smtp import SMTPDataLost, _dot_stuffed
+
+logger = logging.getLogger(__name__)
+
+# Response codes SELECT reports the folder state with
+SELECT_CODES = {'UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'}
+
+
+class AsyncIMAPClient:
+    """One IMAP connection; commands are sent one at a time and awaited."""
+
+    def __init__(self, reader, writer, timeout=30, spool_threshold=None):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.spool_threshold = spool_threshold
+        self.capabilities = set()
+        self.new_mail = False  # an EXISTS was seen since the last noop()
+        self._tag = 0
+
+    @classmethod
+    async def connect(cls, host, port, use_ssl=True, timeout=30, spool_threshold=None):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl.create_default_context() if use_ssl else None),
+            timeout,
+        )
+        client = cls(reader, writer, timeout, spool_threshold)
+        try:
+            greeting = await client._readline()
+            if not greeting.startswith(b'* OK'):
+                raise imaplib.IMAP4.error(f'Unexpected greeting: {greeting!r}')
+            await client.command('CAPABILITY')
+        except BaseException:
+            client.close()
+            raise
+        return client
+
+    def _new_tag(self):
+        self._tag += 1
+        return f'A{self._tag:04d}'.encode()
+
+    async def _readline(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise imaplib.IMAP4.abort('socket error: EOF')
+        return line
+
+    async def _read_literal(self, size):
+        """Like imap._read_literal(): bytes, or a spooled file beyond the spool threshold."""
+        if self.spool_threshold is None or size <= self.spool_threshold:
+            return await asyncio.wait_for(self.reader.readexactly(size), self.timeout)
+        spool = SpooledTemporaryFile(max_size=self.spool_threshold)
+        remaining = size
+        try:
+            while remaining:
+                chunk = await asyncio.wait_for(self.reader.read(min(remaining, 1024 * 1024)), self.timeout)
+                if not chunk:
+                    raise imaplib.IMAP4.abort('socket error: EOF during FETCH literal')
+                spool.write(chunk)
+                remaining -= len(chunk)
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool
+
+    async def _read_response(self):
+        """One complete response in the shape of imap._read_response()."""
+        parts = []
+        line = await self._readline()
+        while True:
+            literal_size = LITERAL_SIZE_RE.search(line)
+            if not literal_size:
+                parts.append(line.rstrip(b'\r\n'))
+                return parts
+            parts.append((line[:-2], await self._read_literal(int(literal_size.group(1)))))
+            line = await self._readline()
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def command(self, command, continuation=None):
+        """
+        Send *command* and collect its untagged responses until the tagged
+        reply. *continuation*, if given, is sent when the server asks for
+        more with a '+' line. Raises imaplib.IMAP4.error unless it ends OK.
+        """
+        tag = self._new_tag()
+        await self._send(tag + b' ' + command.encode() + b'\r\n')
+        untagged = []
+        while True:
+            parts = await self._read_response()
+            first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+            if first.startswith(tag + b' '):
+                status = first[len(tag) + 1:]
+                if not status.startswith(b'OK'):
+                    for part in untagged:
+                        _close_literals(part)
+                    raise imaplib.IMAP4.error(f'{command.split()[0]} failed: {status!r}')
+                return untagged
+            if first.startswith(b'+'):
+                # A second challenge means the server rejected what we sent; an empty line ends it
+                await self._send((continuation or b'') + b'\r\n')
+                continuation = None
+                continue
+            if EXISTS_RE.match(first):
+                self.new_mail = True
+            elif first.startswith(b'* CAPABILITY '):
+                self.capabilities = set(first[len(b'* CAPABILITY '):].decode().upper().split())
+            untagged.append(parts)
+
+    async def authenticate_xoauth2(self, auth_bytes):
+        await self.command('AUTHENTICATE XOAUTH2', base64.b64encode(auth_bytes))
+
+    async def select(self, folder):
+        """SELECT *folder*; returns {'UIDVALIDITY': ..., 'UIDNEXT': ..., 'HIGHESTMODSEQ': ...} (None if absent)."""
+        status = dict.fromkeys(SELECT_CODES)
+        for parts in await self.command(f'SELECT {folder}'):
+            line = parts[0] if isinstance(parts[0], bytes) else parts[0][0]
+            if line.startswith(b'* OK [') and b']' in line:
+                code = line[len(b'* OK ['):line.index(b']')].split()
+                if len(code) == 2 and code[0].decode().upper() in SELECT_CODES:
+                    status[code[0].decode().upper()] = int(code[1])
+        self.new_mail = False
+        return status
+
+    async def uid_search(self, criteria):
+        uids = []
+        for parts in await self.command(f'UID SEARCH {criteria}'):
+            line = parts[0] if isinstance(parts[0], bytes) else parts[0][0]
+            if line.startswith(b'* SEARCH'):
+                uids.extend(int(uid) for uid in line.split()[2:])
+        return uids
+
+    async def uid_fetch(self, uids, items):
+        """UID FETCH *items* for the UID set *uids*; returns a parse_fetch() dict per message."""
+        messages = []
+        for parts in await self.command(f'UID FETCH {uids} {items}'):
+            first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+            fetch = UNTAGGED_FETCH_RE.match(first)
+            if not fetch:
+                continue
+            prefix = fetch.group(1) + b' ' + fetch.group(2)
+            parts[0] = (prefix, parts[0][1]) if isinstance(parts[0], tuple) else prefix
+            messages.extend(parse_fetch(parts))
+        return messages
+
+    async def noop(self):
+        """NOOP as a liveness check; returns True if new mail was announced since the last call."""
+        await self.command('NOOP')
+        new_mail, self.new_mail = self.new_mail, False
+        return new_mail
+
+    async def idle(self, timeout):
+        """IDLE until the server announces new mail or *timeout* seconds pass; returns True on new mail."""
+        tag = self._new_tag()
+        await self._send(tag + b' IDLE\r\n')
+        line = await self._readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f'IDLE rejected: {line!r}')
+
+        new_mail = False
+        deadline = time.monotonic() + timeout
+        while not new_mail:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not line:
+                raise imaplib.IMAP4.abort('socket error: EOF during IDLE')
+            new_mail = bool(EXISTS_RE.match(line))
+        await self._send(b'DONE\r\n')
+        while True:
+            line = await self._readline()
+            if line.startswith(tag):
+                if not line[len(tag):].strip().startswith(b'OK'):
+                    raise imaplib.IMAP4.error(f'IDLE failed: {line!r}')
+                return new_mail
+            if EXISTS_RE.match(line):
+                new_mail = True
+
+    async def logout(self):
+        try:
+            await self.command('LOGOUT')
+        except (imaplib.IMAP4.error, OSError, asyncio.TimeoutError):
+            pass
+        self.close()
+
+    def close(self):
+        self.writer.close()
+
+
+def _close_literals(parts):
+    for part in parts:
+        if isinstance(part, tuple) and hasattr(part[1], 'close'):
+            part[1].close()
+
+
+class AsyncSMTPClient:
+    """One ESMTP session; see smtp.send_envelope() for the transaction semantics it mirrors."""
+
+    def __init__(self, reader, writer, timeout=30):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.extensions = set()
+
+    @classmethod
+    async def connect(cls, host, port, use_tls=True, timeout=30):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        client = cls(reader, writer, timeout)
+        try:
+            code, response = await client.reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, response)
+            await client.ehlo()
+            if use_tls:
+                code, response = await client.command('STARTTLS')
+                if code != 220:
+                    raise smtplib.SMTPNotSupportedError(f'STARTTLS refused: {code} {response!r}')
+                client.writer = await _start_tls(reader, writer, host, timeout)
+                await client.ehlo()
+        except BaseException:
+            client.close()
+            raise
+        return client
+
+    async def reply(self):
+        """Read one (possibly multiline) reply as smtplib does: (code, text joined by newlines)."""
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip(b' \t\r\n'))
+            if line[3:4] != b'-':
+                try:
+                    return int(line[:3]), b'\n'.join(lines)
+                except ValueError:
+                    raise smtplib.SMTPResponseException(-1, line)
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def command(self, command):
+        await self._send(command.encode() + b'\r\n')
+        return await self.reply()
+
+    async def ehlo(self):
+        code, response = await self.command(f'EHLO {socket.getfqdn()}')
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, response)
+        self.extensions = {line.split()[0].decode().lower() for line in response.split(b'\n')[1:] if line}
+
+    async def auth_xoauth2(self, auth_b64):
+        code, response = await self.command('AUTH XOAUTH2 ' + auth_b64)
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, response)
+
+    async def send_envelope(self, from_addr, recipients, data, mail_options=()):
+        """Async smtp.send_envelope(): returns refused recipients, raising for sender or DATA failures."""
+        recipients = list(recipients)
+        if '8bitmime' not in self.extensions:
+            mail_options = [option for option in mail_options if option.upper() != 'BODY=8BITMIME']
+        commands = [' '.join([f'MAIL FROM:{smtplib.quoteaddr(from_addr)}', *mail_options])]
+        commands += [f'RCPT TO:{smtplib.quoteaddr(rcpt)}' for rcpt in recipients]
+
+        if 'pipelining' in self.extensions:
+            await self._send(''.join(command + '\r\n' for command in commands).encode())
+            replies = [await self.reply() for _ in commands]
+        else:
+            replies = []
+            for command in commands:
+                replies.append(await self.command(command))
+                if len(replies) == 1 and replies[0][0] != 250:
+                    break
+
+        code, response = replies[0]
+        if code != 250:
+            await self.command('RSET')
+            raise smtplib.SMTPSenderRefused(code, response, from_addr)
+
+        refused = {
+            rcpt: reply for rcpt, reply in zip(recipients, replies[1:])
+            if reply[0] not in (250, 251)
+        }
+        if len(refused) == len(recipients):
+            await self.command('RSET')
+            return refused
+
+        try:
+            code, response = await self.command('DATA')
+            if code != 354:
+                await self.command('RSET')
+                raise smtplib.SMTPDataError(code, response)
+            last = b''
+            for piece in _dot_stuffed(data.chunks() if hasattr(data, 'chunks') else [data]):
+                if piece:
+                    await self._send(piece)
+                    last = piece
+            await self._send(b'.\r\n' if last.endswith(b'\r\n') else b'\r\n.\r\n')
+            code, response = await self.reply()
+        except smtplib.SMTPServerDisconnected as e:
+            raise SMTPDataLost(str(e)) from e
+        except smtplib.SMTPException:
+            raise
+        except (OSError, asyncio.TimeoutError) as e:
+            raise SMTPDataLost(str(e)) from e
+        if code != 250:
+            await self.command('RSET')
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        self.close()
+
+    def close(self):
+        self.writer.close()
+
+
+async def _start_tls(reader, writer, host, timeout):
+    """Upgrade the connection behind *reader*/*writer* to TLS and return the writer to use from then on."""
+    context = ssl.create_default_context()
+    if hasattr(writer, 'start_tls'):
+        # Python 3.11+; the old writer must not be dropped, it would close the connection when collected
+        await asyncio.wait_for(writer.start_tls(context, server_hostname=host), timeout)
+        return writer
+    loop = asyncio.get_running_loop()
+    protocol = writer.transport.get_protocol()
+    transport = await asyncio.wait_for(
+        loop.start_tls(writer.transport, protocol, context, server_hostname=host), timeout,
+    )
+    # The protocol goes on feeding *reader*; only writes need the new transport
+    return asyncio.StreamWriter(transport, protocol, reader, loop)
+
+
+class AsyncSMTPPool:
+    """
+    Up to *size* authenticated sessions, each used by one envelope at a time.
+    Like smtp.SMTPConnectionPool, idle sessions are health-checked with NOOP
+    before reuse and recycled once their token has expired, after
+    *max_messages* messages, or when idle for longer than *max_idle*
+    seconds. *connect* is a coroutine function returning a (client, naive
+    UTC token expiry) pair.
+    """
+
+    def __init__(self, connect, size=8, max_messages=100, max_idle=240):
+        self._connect = connect
+        self.size = size
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self._idle = []  # [client, expires_at, messages_sent, last_used]
+        self._slots = asyncio.Semaphore(size)
+        self._quitting = set()  # QUITs of retired sessions, awaited by close()
+        self.stats = {'connections': 0, 'sent': 0, 'recycled': 0}
+
+    def _is_reusable(self, entry):
+        if entry[1] is not None and entry[1] <= datetime.utcnow():
+            return False
+        return time.monotonic() - entry[3] <= self.max_idle
+
+    async def _is_alive(self, entry):
+        try:
+            return (await entry[0].command('NOOP'))[0] == 250
+        except (OSError, asyncio.TimeoutError):
+            return False
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        async with self._slots:
+            entry = None
+            while self._idle and entry is None:
+                entry = self._idle.pop()
+                if not (self._is_reusable(entry) and await self._is_alive(entry)):
+                    self.stats['recycled'] += 1
+                    await entry[0].quit()
+                    entry = None
+            if entry is None:
+                client, expires_at = await self._connect()
+                entry = [client, expires_at, 0, time.monotonic()]
+                self.stats['connections'] += 1
+            try:
+                yield entry[0]
+            except smtplib.SMTPResponseException:
+                # The server answered; the session is still in a known state
+                self._release(entry)
+                raise
+            except BaseException:
+                entry[0].close()
+                raise
+            self._release(entry)
+
+    async def send_envelope(self, from_addr, recipients, data, mail_options=()):
+        """
+        AsyncSMTPClient.send_envelope() on a pooled session. A session the
+        server has silently dropped is replaced and the envelope retried once,
+        unless the message may already have been accepted (SMTPDataLost).
+        """
+        for attempt in (1, 2):
+            try:
+                async with self.session() as client:
+                    return await client.send_envelope(from_addr, recipients, data, mail_options)
+            except SMTPDataLost:
+                raise
+            except smtplib.SMTPServerDisconnected as e:
+                error = e
+            except smtplib.SMTPException:
+                raise
+            except (OSError, asyncio.TimeoutError) as e:
+                # SMTPException subclasses OSError, so this only sees socket errors
+                error = e
+            if attempt == 2:
+                raise error
+            logger.warning(f"Pooled SMTP connection was dropped ({str(error)}), retrying on a new one")
+
+    def _release(self, entry):
+        entry[2] += 1
+        entry[3] = time.monotonic()
+        self.stats['sent'] += 1
+        if entry[2] >= self.max_messages:
+            task = asyncio.ensure_future(entry[0].quit())
+            self._quitting.add(task)
+            task.add_done_callback(self._quitting.discard)
+        else:
+            self._idle.append(entry)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for client, *_ in idle:
+            await client.quit()
+        if self._quitting:
+            await asyncio.gather(*self._quitting, return_exceptions=True)
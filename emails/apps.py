@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class EmailsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'emails'
+
+    def ready(self):
+        from django.conf import settings
+        from . import metrics, signals  # noqa: F401
+
+        metrics.REGISTRY.enabled = settings.METRICS
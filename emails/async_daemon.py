@@ -0,0 +1,405 @@
+"""
+EmailDaemon on one asyncio event loop. The next batch is fetched while
+earlier messages are still being routed and sent, and each message's
+envelopes go out over several SMTP sessions at once, all on one thread:
+ASYNC_MESSAGE_CONCURRENCY bounds the messages in progress and
+ASYNC_SMTP_CONCURRENCY the envelopes in flight. Routing, deduplication,
+cross-list assignment and message rendering are inherited from EmailDaemon,
+so both engines forward identically; database work runs through
+sync_to_async, and queued deliveries are drained by the blocking sender.
+"""
+import asyncio
+import imaplib
+import logging
+import random
+import smtplib
+import socket
+import time
+from email.parser import BytesHeaderParser
+
+import django.db
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics
+from .aio import AsyncIMAPClient, AsyncSMTPClient, AsyncSMTPPool
+from .email_daemon import EmailDaemon
+from .imap import plan_batches, uid_set
+from .leases import LeaseLost
+from .smtp import TokenBucket
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Connection failures worth reconnecting for, as opposed to protocol errors
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError)
+
+
+class AsyncEmailDaemon(EmailDaemon):
+    def __init__(self, shard=None):
+        super().__init__(shard)
+        self.imap = None
+        self.imap_failures = 0
+        # Created on the running loop by _start()
+        self.smtp = None
+        self._loop = None
+        self._message_slots = None
+        self._send_slots = None
+        self.limiter = None
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Streams and semaphores belong to the loop they were created on
+            self._loop = loop
+            self.imap = None
+            self.smtp = AsyncSMTPPool(
+                self._connect_smtp_async,
+                size=settings.ASYNC_SMTP_CONCURRENCY,
+                max_messages=settings.SMTP_MAX_MESSAGES_PER_CONNECTION,
+                max_idle=settings.SMTP_POOL_MAX_IDLE,
+            )
+            self._message_slots = asyncio.Semaphore(settings.ASYNC_MESSAGE_CONCURRENCY)
+            self._send_slots = asyncio.Semaphore(settings.ASYNC_SMTP_CONCURRENCY)
+            self.limiter = None
+            if settings.SMTP_RATE_LIMIT:
+                self.limiter = TokenBucket(settings.SMTP_RATE_LIMIT, settings.SMTP_RATE_BURST)
+
+    async def _connect_smtp_async(self):
+        """Async _connect_smtp(): an authenticated AsyncSMTPClient and the expiry of its token."""
+        started = time.perf_counter()
+        client = await AsyncSMTPClient.connect(self.smtp_server, settings.SMTP_PORT, settings.SMTP_USE_TLS)
+        try:
+            await client.auth_xoauth2(await sync_to_async(self._xoauth2_b64)())
+        except smtplib.SMTPAuthenticationError:
+            client.close()
+            # The shared access token may have been revoked early; force a refresh
+            await sync_to_async(self.tokens.invalidate)()
+            raise
+        except BaseException:
+            client.close()
+            raise
+        metrics.SMTP_CONNECT_SECONDS.observe(time.perf_counter() - started)
+        return client, self.tokens.expiry
+
+    async def _connect_imap_async(self):
+        """Async _connect_imap(): an authenticated AsyncIMAPClient with the folder selected."""
+        started = time.perf_counter()
+        client = await AsyncIMAPClient.connect(
+            self.imap_server, settings.IMAP_PORT, settings.IMAP_USE_SSL,
+            spool_threshold=settings.IMAP_SPOOL_THRESHOLD,
+        )
+        try:
+            try:
+                await client.authenticate_xoauth2(await sync_to_async(self._xoauth2_bytes)())
+            except imaplib.IMAP4.error:
+                await sync_to_async(self.tokens.invalidate)()
+                raise
+            status = await client.select(self.folder)
+            max_uid = None
+            if not status['UIDNEXT']:
+                max_uid = max(await client.uid_search('ALL'), default=0)
+            await sync_to_async(self._load_checkpoint)(
+                status['UIDVALIDITY'], status['UIDNEXT'], status['HIGHESTMODSEQ'], lambda: max_uid,
+            )
+        except BaseException:
+            client.close()
+            raise
+        metrics.IMAP_CONNECT_SECONDS.observe(time.perf_counter() - started)
+        logger.info(f"Connected to {self.imap_server} as {self.email} (async)")
+        return client
+
+    async def _imap_session(self):
+        """The live IMAP connection, reconnecting with the same backoff as IMAPSession."""
+        while self.imap is None:
+            try:
+                self.imap = await self._connect_imap_async()
+                self.imap_failures = 0
+            except Exception as e:
+                self.imap_failures += 1
+                delay = min(
+                    settings.IMAP_RECONNECT_BACKOFF_MAX,
+                    settings.IMAP_RECONNECT_BACKOFF_MIN * 2 ** (self.imap_failures - 1),
+                ) * random.uniform(0.5, 1.0)
+                logger.error(
+                    f"IMAP connection attempt {self.imap_failures} failed: {e}. Retrying in {delay:.1f} seconds"
+                )
+                await asyncio.sleep(delay)
+        return self.imap
+
+    def _reset_imap(self):
+        if self.imap is not None:
+            self.imap.close()
+        self.imap = None
+
+    async def check_emails_async(self, probe=True):
+        """check_emails() on the event loop; returns the number of new emails processed."""
+        # The profile covers every task on the loop while the cycle runs, but not sync_to_async threads
+        with self.profiler.cycle():
+            return await self._check_emails_async(probe)
+
+    async def _check_emails_async(self, probe):
+        self._start()
+        if not await sync_to_async(self._hold_lease)():
+            self._reset_imap()
+            await sync_to_async(django.db.connections.close_all)()
+            return 0
+        started = time.perf_counter()
+        result = 'ok'
+        processed = 0
+        try:
+            try:
+                processed = await self._check_session_async(probe)
+            except CONNECTION_ERRORS as e:
+                logger.warning(f"IMAP connection lost: {str(e)}. Reconnecting...")
+                self._reset_imap()
+                processed = await self._check_session_async(probe)
+            logger.info(f"Email check completed. Next check will process UIDs after {self.checkpoint.last_uid}")
+
+        except LeaseLost as e:
+            result = 'lease_lost'
+            logger.warning(f"Stopped checking {self.shard}: {str(e)}")
+            self._reset_imap()
+            self.checkpoint = self.selected_status = None
+        except CONNECTION_ERRORS as e:
+            result = 'error'
+            self.stats['errors'] += 1
+            logger.error(f"IMAP connection lost: {str(e)}")
+            self._reset_imap()
+        except Exception as e:
+            result = 'error'
+            self.stats['errors'] += 1
+            logger.error(f"Error checking emails: {str(e)}")
+            logger.error("Error details:", exc_info=True)
+        self.check_failed = result == 'error'
+        self.stats['checks'] += 1
+        self.stats['processed'] += processed
+        metrics.CHECK_SECONDS.observe(time.perf_counter() - started, result)
+        metrics.LAST_CHECK.set(time.time())
+
+        try:
+            if settings.DELIVERY_QUEUE:
+                await sync_to_async(self.drain_deliveries)()
+        except Exception as e:
+            logger.error(f"Error delivering queued emails: {str(e)}")
+            logger.error("Error details:", exc_info=True)
+        finally:
+            await sync_to_async(django.db.connections.close_all)()
+        return processed
+
+    async def _check_session_async(self, probe):
+        if self.checkpoint is None:
+            # The lease has just been (re)acquired: SELECT again to reload the checkpoint
+            self._reset_imap()
+        imap = await self._imap_session()
+        if probe and self.selected_status is None and not self.check_failed and not await imap.noop():
+            logger.info(f"No new emails after UID {self.checkpoint.last_uid}")
+            return 0
+        return await self._process_inbox_async(imap)
+
+    async def _process_inbox_async(self, imap):
+        last_uid = self.checkpoint.last_uid
+        status, self.selected_status = self.selected_status, None
+        if status and (
+            (status['uidnext'] and status['uidnext'] - 1 <= last_uid)
+            or (status['highest_modseq'] and status['highest_modseq'] == self.checkpoint.highest_modseq)
+        ):
+            logger.info(f"No new emails after UID {last_uid}")
+            return 0
+
+        logger.info(f"Checking for new emails after UID {last_uid}...")
+        started = time.monotonic()
+        candidates = await imap.uid_fetch(f'{last_uid + 1}:*', self._header_fetch_items())
+        header_fetch = (started, time.monotonic())
+        metrics.IMAP_FETCH_SECONDS.observe(header_fetch[1] - started, 'headers')
+        candidates = [m for m in candidates if m.get('UID', 0) > last_uid and 'HEADER' in m]
+        max_uid = max((m['UID'] for m in candidates), default=last_uid)
+
+        suppressed_before = self.dedup.stats['suppressed'] if self.dedup is not None else 0
+        claimed = set()
+        routes = await sync_to_async(self._route_candidates)(candidates, claimed, header_fetch)
+        processed = len(candidates)
+        del candidates
+
+        # Fetch batch after batch while earlier messages are still being sent
+        outstanding = sorted(routes)
+        tasks = set()
+        batches = plan_batches(
+            [(uid, size) for uid, (_, size, _) in sorted(routes.items())],
+            settings.IMAP_FETCH_BATCH_SIZE,
+            settings.IMAP_FETCH_BATCH_BYTES,
+        )
+        try:
+            for batch in batches:
+                started = time.monotonic()
+                batch_fetched = await imap.uid_fetch(uid_set(batch), '(RFC822)')
+                metrics.IMAP_FETCH_SECONDS.observe(time.monotonic() - started, 'body')
+                for fetched in batch_fetched:
+                    uid = fetched.get('UID')
+                    if uid not in routes or 'RFC822' not in fetched:
+                        continue
+                    trace = self._fetched_trace(uid, started)
+                    await self._message_slots.acquire()
+                    raw = fetched.pop('RFC822')
+                    tasks.add(asyncio.create_task(
+                        self._process_message(uid, raw, routes.pop(uid), claimed, outstanding, trace)
+                    ))
+        finally:
+            if tasks:
+                await asyncio.wait(tasks)
+
+        await sync_to_async(self._finish_inbox)(routes, max_uid, status, suppressed_before)
+        return processed
+
+    async def _process_message(self, uid, raw, route, claimed, outstanding, trace=None):
+        mailing_lists, size, key = route
+        logger.info(f"Fetched UID {uid} ({size} bytes)")
+        metrics.IMAP_FETCHED_BYTES.inc(amount=size)
+        if trace is not None:
+            trace.queued()
+        try:
+            if self.dedup is not None and key is None:
+                key = self._content_key(raw, BytesHeaderParser())
+                mailing_lists = await sync_to_async(self.dedup.filter_new)(key, mailing_lists, claimed)
+            if mailing_lists:
+                if settings.DELIVERY_QUEUE:
+                    await sync_to_async(self._enqueue_email)(raw, uid, mailing_lists, trace)
+                    forwarded = mailing_lists
+                else:
+                    forwarded = await self._route_email_async(raw, mailing_lists, trace)
+                if self.dedup is not None and forwarded:
+                    await sync_to_async(self.dedup.record)(key, forwarded)
+        except Exception as e:
+            logger.error(f"Error processing email UID {uid}: {str(e)}")
+            logger.error("Error details:", exc_info=True)
+        finally:
+            if not isinstance(raw, bytes):
+                raw.close()
+            self._message_slots.release()
+
+        # Everything below the oldest list message still in flight is done
+        outstanding.remove(uid)
+        if outstanding and outstanding[0] - 1 > self.checkpoint.last_uid:
+            await sync_to_async(self._advance_checkpoint)(outstanding[0] - 1)
+
+    async def _route_email_async(self, raw, mailing_lists, trace=None):
+        """Async _route_email(): every list's envelopes go out concurrently. Returns the lists delivered from."""
+        assigned = await sync_to_async(
+            lambda: [(mailing_list, list(recipients)) for mailing_list, recipients in self._assign_recipients(mailing_lists)]
+        )()
+        parsed = {}
+        with span(trace, 'parse'):
+            self._parse_raw(raw, parsed)
+        results = await asyncio.gather(*(
+            self._deliver_async(
+                mailing_list, *self._envelopes(raw, parsed, mailing_list, recipients),
+                record=trace.recorder(mailing_list.alias) if trace is not None else None,
+            )
+            for mailing_list, recipients in assigned
+        ))
+        forwarded = []
+        for (mailing_list, _), (delivered, refused) in zip(assigned, results):
+            if delivered or refused:
+                logger.info(f"Email forwarded to {delivered} subscribers ({refused} refused)")
+            else:
+                logger.warning(f"No active subscribers found for {mailing_list.alias}")
+            if delivered:
+                forwarded.append(mailing_list)
+            if trace is not None:
+                await sync_to_async(trace.save)(mailing_list.alias)
+        return forwarded
+
+    async def _deliver_async(self, mailing_list, envelopes, mail_options=(), record=None):
+        """
+        Async _deliver(): each envelope is rendered once a send slot is free
+        and sent on its own pooled session. *record* is as for _deliver().
+        Returns (delivered, refused) counts.
+        """
+        counts = [0, 0]
+        pending = set()
+
+        async def send(recipients, data):
+            try:
+                if self.limiter is not None:
+                    wait = self.limiter.reserve(len(recipients))
+                    if wait:
+                        await asyncio.sleep(wait)
+                started = time.perf_counter()
+                result = await self.smtp.send_envelope(mailing_list.alias, recipients, data, mail_options)
+                metrics.SMTP_SEND_SECONDS.observe(time.perf_counter() - started)
+            except Exception as e:
+                result = e
+            finally:
+                self._send_slots.release()
+            delivered, refused = self._count_result(recipients, result, record)
+            counts[0] += delivered
+            counts[1] += refused
+
+        try:
+            while True:
+                await self._send_slots.acquire()
+                try:
+                    recipients, data = next(envelopes)
+                except BaseException:
+                    self._send_slots.release()
+                    raise
+                pending.add(asyncio.create_task(send(recipients, data)))
+        except StopIteration:
+            pass
+        finally:
+            if pending:
+                await asyncio.wait(pending)
+        return tuple(counts)
+
+    async def run_async(self, idle=False):
+        self._start()
+        self._serve_metrics()
+        self.profiler.start()
+        self.tokens.start()
+        if self.lease is not None:
+            self.lease.start()
+        try:
+            await self._run_loop(idle)
+        finally:
+            if self.lease is not None:
+                self.lease.stop()
+                await sync_to_async(self.lease.release)()
+
+    async def _run_loop(self, idle):
+        interval = settings.ADAPTIVE_POLL_MIN
+        new_mail = False
+        while True:
+            processed = await self.check_emails_async(probe=not new_mail)
+            new_mail = False
+            if self.lease is not None and not self.lease.held:
+                # Standing by for another replica
+                await asyncio.sleep(settings.LEASE_HEARTBEAT)
+                continue
+            if self.check_failed:
+                # IDLE would only wake for new mail, leaving what the failed check missed until then
+                logger.info(f"Retrying the failed check in {settings.POLL_INTERVAL} seconds...")
+                await asyncio.sleep(settings.POLL_INTERVAL)
+            elif idle and self.imap is not None and 'IDLE' in self.imap.capabilities:
+                try:
+                    timeout = await sync_to_async(self._idle_timeout)()
+                    logger.debug(f"Entering IDLE for up to {timeout:.0f} seconds")
+                    new_mail = await self.imap.idle(timeout)
+                except CONNECTION_ERRORS as e:
+                    logger.error(f"IMAP connection lost during IDLE: {str(e)}")
+                    self._reset_imap()
+            else:
+                interval = self._next_poll_interval(interval, processed) if idle else settings.POLL_INTERVAL
+                logger.info(f"Waiting {interval:.0f} seconds before next check...")
+                await asyncio.sleep(interval)
+
+    async def close(self):
+        if self.imap is not None:
+            await self.imap.logout()
+            self.imap = None
+        if self.smtp is not None:
+            await self.smtp.close()
+
+    def run(self, idle=False):
+        logger.info("Starting email daemon (asyncio engine)...")
+        socket.setdefaulttimeout(30)
+        asyncio.run(self.run_async(idle))
@@ -4,33 +4,21 @@ import smtplib
 from django.conf import settings
 from django.core.mail.backends.base import BaseEmailBackend
 from django.core.mail.message import sanitize_address
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+
+from . import metrics
+from .oauth import get_provider
 
 
 class GmailOAuth2Backend(BaseEmailBackend):
     """
     Django email backend that authenticates to Gmail SMTP using OAuth2 XOAUTH2.
     Reads GMAIL_CLIENT_ID, GMAIL_CLIENT_SECRET, and GMAIL_REFRESH_TOKEN from settings.
+    The access token comes from the cache shared with the email daemon.
     """
 
     def __init__(self, fail_silently=False, **kwargs):
         super().__init__(fail_silently=fail_silently, **kwargs)
         self.connection = None
-        self._credentials = None
-
-    def _get_credentials(self):
-        if self._credentials is None:
-            self._credentials = Credentials(
-                token=None,
-                refresh_token=settings.GMAIL_REFRESH_TOKEN,
-                token_uri='https://oauth2.googleapis.com/token',
-                client_id=settings.GMAIL_CLIENT_ID,
-                client_secret=settings.GMAIL_CLIENT_SECRET,
-            )
-        if not self._credentials.valid:
-            self._credentials.refresh(Request())
-        return self._credentials
 
     def open(self):
         if self.connection:
@@ -38,18 +26,26 @@ class GmailOAuth2Backend(BaseEmailBackend):
         try:
             self.connection = smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT)
             self.connection.ehlo()
-            self.connection.starttls()
-            self.connection.ehlo()
-            creds = self._get_credentials()
+            if settings.EMAIL_USE_TLS:
+                self.connection.starttls()
+                self.connection.ehlo()
+            tokens = get_provider(settings.EMAIL_HOST_USER)
+            token = tokens.get_token()
             auth_string = (
                 f"user={settings.EMAIL_HOST_USER}"
-                f"\x01auth=Bearer {creds.token}\x01\x01"
+                f"\x01auth=Bearer {token}\x01\x01"
             )
-            self.connection.docmd(
+            code, response = self.connection.docmd(
                 'AUTH', 'XOAUTH2 ' + base64.b64encode(auth_string.encode()).decode()
             )
+            if code != 235:
+                # Revoked before its expiry; the next attempt fetches a new one
+                tokens.invalidate(token)
+                raise smtplib.SMTPAuthenticationError(code, response)
             return True
         except Exception:
+            # Don't leave a half-open, unauthenticated session behind
+            self.close()
             if not self.fail_silently:
                 raise
 
@@ -85,7 +81,9 @@ class GmailOAuth2Backend(BaseEmailBackend):
                     from_email, recipients, message.message().as_bytes(linesep='\r\n')
                 )
                 num_sent += 1
+                metrics.WEB_EMAILS.inc('sent')
             except Exception:
+                metrics.WEB_EMAILS.inc('failed')
                 if not self.fail_silently:
                     raise
         if new_conn_created:
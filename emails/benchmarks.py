@@ -0,0 +1,1015 @@
+"""
+Benchmarks for the daemon's hot paths, run against the stand-in servers in
+emails.fakes. Each benchmark returns a list of result dicts so that the
+bench_email_daemon command can print them as a table or JSON.
+"""
+import imaplib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import statistics
+import threading
+import time
+import timeit
+import tracemalloc
+from email import message_from_bytes
+from email.header import Header
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.test.utils import override_settings
+
+from .fakes import FakeIMAPServer, FakeMailbox, FakeSMTPServer, FixedTokenProvider, make_message
+from .imap import fetch_messages, plan_batches
+from .passthrough import PassthroughMessage
+
+
+def bench_fetch(batch_sizes=(1, 5, 10, 25, 50, 100), messages=200, message_size=20_000,
+                latency=0.02, depths=(1, 2), max_bytes=8 * 1024 * 1024):
+    """Time full-message UID FETCH throughput for each batch size and pipeline depth."""
+    results = []
+    with FakeIMAPServer(latency=latency) as server:
+        for i in range(messages):
+            server.mailbox.append(make_message('bench@cyphy.life', subject=f'Bench {i}', body='x' * message_size))
+        sizes = [(m.uid, len(m.raw)) for m in server.mailbox.snapshot()]
+        total_bytes = sum(size for _, size in sizes)
+
+        imap = imaplib.IMAP4('127.0.0.1', server.port)
+        imap.login('bench', 'bench')
+        imap.select('INBOX')
+        try:
+            for depth in depths:
+                for batch_size in batch_sizes:
+                    batches = plan_batches(sizes, batch_size, max_bytes)
+                    started = time.perf_counter()
+                    count = sum(1 for m in fetch_messages(imap, batches, '(RFC822)', depth) if 'RFC822' in m)
+                    elapsed = time.perf_counter() - started
+                    results.append({
+                        'batch_size': batch_size,
+                        'depth': depth,
+                        'messages': count,
+                        'seconds': round(elapsed, 4),
+                        'messages_per_sec': round(count / elapsed, 1),
+                        'mb_per_sec': round(total_bytes / elapsed / 1e6, 2),
+                    })
+        finally:
+            imap.logout()
+    return results
+
+
+def _bench_daemon(smtp_server, **overrides):
+    """An EmailDaemon wired to a FakeSMTPServer with a dummy access token."""
+    from .email_daemon import EmailDaemon
+
+    with override_settings(SMTP_SERVER='127.0.0.1', SMTP_PORT=smtp_server.port, SMTP_USE_TLS=False, **overrides):
+        daemon = EmailDaemon()
+    daemon.tokens = FixedTokenProvider('bench-token')
+    return daemon
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def bench_smtp_pool(pool_sizes=(0, 2), messages=20, subscribers=5, latency=0.02):
+    """Compare SMTP handshakes and per-message forward latency with and without connection pooling."""
+    results = []
+    mailing_list = SimpleNamespace(alias='bench@cyphy.life')
+    recipients = [SimpleNamespace(email=f'subscriber{i}@example.com') for i in range(subscribers)]
+    for pool_size in pool_sizes:
+        with FakeSMTPServer(latency=latency) as server:
+            with override_settings(SMTP_PORT=server.port, SMTP_USE_TLS=False):
+                daemon = _bench_daemon(server, SMTP_POOL_SIZE=pool_size)
+                timings = []
+                for i in range(messages):
+                    message = message_from_bytes(make_message(mailing_list.alias, subject=f'Bench {i}'))
+                    started = time.perf_counter()
+                    daemon.forward_email(message, recipients, mailing_list)
+                    timings.append(time.perf_counter() - started)
+                daemon.smtp_pool.close()
+            results.append({
+                'pool_size': pool_size,
+                'messages': messages,
+                'sends': server.stats['messages'],
+                'handshakes': server.stats['auths'],
+                'mean_forward_ms': round(statistics.mean(timings) * 1000, 1),
+                'p95_forward_ms': round(_percentile(timings, 95) * 1000, 1),
+            })
+    return results
+
+
+def bench_fanout(subscribers=(10, 100, 500), latency=0.02, max_recipients=100):
+    """Compare per-subscriber forwarding with one pipelined multi-RCPT envelope per SMTP_MAX_RECIPIENTS."""
+    results = []
+    mailing_list = SimpleNamespace(alias='bench@cyphy.life')
+    message = message_from_bytes(make_message(mailing_list.alias, subject='Bench fan-out', body='x' * 5_000))
+    for count in subscribers:
+        addresses = [f'subscriber{i}@example.com' for i in range(count)]
+        for mode in ('per-subscriber', 'bulk'):
+            with FakeSMTPServer(latency=latency) as server:
+                with override_settings(SMTP_PORT=server.port, SMTP_USE_TLS=False,
+                                       SMTP_MAX_RECIPIENTS=max_recipients):
+                    daemon = _bench_daemon(server)
+                    started = time.perf_counter()
+                    if mode == 'bulk':
+                        daemon.forward_email_bulk(message, addresses, mailing_list)
+                    else:
+                        daemon.forward_email(message, [SimpleNamespace(email=a) for a in addresses], mailing_list)
+                    elapsed = time.perf_counter() - started
+                    daemon.smtp_pool.close()
+                with server.lock:
+                    delivered = sum(len(rcpts) for _, rcpts, _ in server.messages)
+            results.append({
+                'mode': mode,
+                'subscribers': count,
+                'transactions': server.stats['messages'],
+                'delivered': delivered,
+                'seconds': round(elapsed, 3),
+                'ms_per_recipient': round(elapsed / count * 1000, 2),
+            })
+    return results
+
+
+def _newsletter(html_size, attachments):
+    """Raw bytes of an HTML newsletter with a text alternative and binary attachments."""
+    msg = MIMEMultipart('mixed')
+    msg['From'] = 'news@example.com'
+    msg['To'] = 'bench@cyphy.life'
+    msg['Subject'] = 'Newsletter – Grüße'
+    msg['Message-ID'] = '<newsletter@example.com>'
+    body = MIMEMultipart('alternative')
+    body.attach(MIMEText('Plain text version. ' * 50, 'plain', 'utf-8'))
+    paragraph = '<p>Ünïcode newsletter paragraph with <a href="https://example.com">a link</a>.</p>\n'
+    body.attach(MIMEText(paragraph * (html_size // len(paragraph) + 1), 'html', 'utf-8'))
+    msg.attach(body)
+    for i in range(attachments):
+        msg.attach(MIMEApplication(bytes(range(256)) * 400, Name=f'attachment{i}.bin'))
+    return msg.as_bytes()
+
+
+def _measure(forward, repeat):
+    """CPU seconds per call and peak traced allocation of *forward*()."""
+    cpu = []
+    for _ in range(repeat):
+        started = time.process_time()
+        forward()
+        cpu.append(time.process_time() - started)
+    tracemalloc.start()
+    try:
+        forward()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return statistics.median(cpu), peak
+
+
+def bench_rewrite(subscribers=20, html_size=200_000, attachments=2, repeat=5):
+    """CPU time and peak memory of rebuilding the MIME tree per forward vs. passthrough header rewriting."""
+    from .email_daemon import EmailDaemon
+
+    daemon = EmailDaemon()
+    mailing_list = SimpleNamespace(alias='bench@cyphy.life')
+    addresses = [f'subscriber{i}@example.com' for i in range(subscribers)]
+    raw = _newsletter(html_size, attachments)
+
+    def rebuild():
+        original = message_from_bytes(raw)
+        content = daemon._prepare_forward(original, mailing_list)
+        for address in addresses:
+            msg = daemon._build_forward(content, mailing_list, address)
+            yield msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+
+    def passthrough():
+        message = PassthroughMessage(raw)
+        for address in addresses:
+            yield message.render(mailing_list.alias, address)
+
+    results = []
+    for mode, forward in (('rebuild', rebuild), ('passthrough', passthrough)):
+        cpu, peak = _measure(lambda: sum(len(data) for data in forward()), repeat)
+        results.append({
+            'mode': mode,
+            'subscribers': subscribers,
+            'message_kb': round(len(raw) / 1024, 1),
+            'cpu_ms': round(cpu * 1000, 2),
+            'cpu_ms_per_copy': round(cpu * 1000 / subscribers, 3),
+            'peak_alloc_kb': round(peak / 1024, 1),
+        })
+    return results
+
+
+def bench_workers(workers=(0, 1, 2, 4, 8), subscribers=200, latency=0.02, rate_limit=None, rate_burst=50):
+    """Per-subscriber fan-out time with 0 (sequential) to N sender workers, optionally rate limited."""
+    results = []
+    mailing_list = SimpleNamespace(alias='bench@cyphy.life')
+    message = PassthroughMessage(make_message(mailing_list.alias, subject='Bench workers', body='x' * 5_000))
+    addresses = [f'subscriber{i}@example.com' for i in range(subscribers)]
+    for count in workers:
+        with FakeSMTPServer(latency=latency) as server:
+            with override_settings(SMTP_PORT=server.port, SMTP_USE_TLS=False, FORWARD_BULK_ENVELOPE=False,
+                                   SMTP_SENDER_WORKERS=count, SMTP_RATE_LIMIT=rate_limit,
+                                   SMTP_RATE_BURST=rate_burst):
+                daemon = _bench_daemon(server)
+                started = time.perf_counter()
+                delivered, _ = daemon.forward_passthrough(message, addresses, mailing_list)
+                elapsed = time.perf_counter() - started
+                stats = daemon.sender_pool.snapshot() if daemon.sender_pool else {}
+                if daemon.sender_pool:
+                    daemon.sender_pool.close()
+                daemon.smtp_pool.close()
+        results.append({
+            'workers': count,
+            'delivered': delivered,
+            'handshakes': server.stats['auths'],
+            'seconds': round(elapsed, 3),
+            'recipients_per_sec': round(delivered / elapsed, 1),
+            'max_queue_depth': stats.get('max_queue_depth', 0),
+            'throttled_seconds': round(stats.get('throttled_seconds', 0.0), 2),
+        })
+    return results
+
+
+def _large_message(to, index, size):
+    """Raw bytes of a message with a *size*-byte body of 76-character lines, like a base64 attachment."""
+    line = b'QUJDREVGR0hJSktMTU5PUFFSU1RVVldYWVphYmNkZWZnaGlqa2xtbm9wcXJzdHV2d3h5ejAxMjM0\r\n'
+    head = make_message(to, subject=f'Stress {index}', body='').split(b'\r\n\r\n')[0]
+    return head + b'\r\n\r\n' + line * (size // len(line))
+
+
+def _serve_stress(conn, messages, message_size, alias):
+    """Child process: serve *messages* large messages over IMAP and count what arrives over SMTP."""
+    mailbox = FakeMailbox()
+    for i in range(messages):
+        mailbox.append(_large_message(alias, i, message_size))
+    with FakeIMAPServer(mailbox=mailbox) as imap_server, FakeSMTPServer(keep_data=False) as smtp_server:
+        conn.send((imap_server.port, smtp_server.port, mailbox.uidvalidity))
+        conn.recv()
+        conn.send(dict(smtp_server.stats))
+
+
+def _rss_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def bench_stress(messages=2, message_mb=50, subscribers=2, modes=('spooled', 'in-memory')):
+    """
+    Push *messages* messages of *message_mb* MB through a full check cycle (IMAP
+    fetch, routing, SMTP fan-out) and sample this process's RSS throughout.
+    The stand-in servers run in a child process so only the daemon is measured,
+    and a throwaway test database is used. Linux only (/proc).
+    """
+    from django.db import connection
+    from .email_daemon import EmailDaemon
+    from .models import MailboxCheckpoint, MailingList, Subscriber
+
+    alias = 'stress@cyphy.life'
+    message_size = message_mb * 1024 * 1024
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    results = []
+    try:
+        mailing_list = MailingList.objects.create(alias=alias)
+        for i in range(subscribers):
+            Subscriber.objects.create(email=f'subscriber{i}@example.com').mailing_lists.add(mailing_list)
+
+        for mode in modes:
+            parent_conn, child_conn = multiprocessing.get_context('fork').Pipe()
+            child = multiprocessing.get_context('fork').Process(
+                target=_serve_stress, args=(child_conn, messages, message_size, alias), daemon=True,
+            )
+            child.start()
+            imap_port, smtp_port, uidvalidity = parent_conn.recv()
+            MailboxCheckpoint.objects.all().delete()
+            MailboxCheckpoint.objects.create(account=settings.EMAIL_ADDRESS or '', folder='INBOX',
+                                             uidvalidity=uidvalidity, last_uid=0)
+            overrides = dict(
+                IMAP_SERVER='127.0.0.1', IMAP_PORT=imap_port, IMAP_USE_SSL=False,
+                SMTP_SERVER='127.0.0.1', SMTP_PORT=smtp_port, SMTP_USE_TLS=False,
+                MESSAGE_DEDUP=False, DELIVERY_QUEUE=False,
+            )
+            if mode == 'in-memory':
+                overrides.update(IMAP_SPOOL_THRESHOLD=None, IMAP_FETCH_MAX_IN_FLIGHT=None)
+
+            peak = [0]
+            done = threading.Event()
+
+            def sample():
+                while not done.wait(0.005):
+                    peak[0] = max(peak[0], _rss_bytes())
+
+            try:
+                with override_settings(**overrides):
+                    daemon = EmailDaemon()
+                    daemon._xoauth2_bytes = lambda: b'stress'
+                    daemon.tokens = FixedTokenProvider('stress-token')
+                    baseline = _rss_bytes()
+                    sampler = threading.Thread(target=sample, daemon=True)
+                    sampler.start()
+                    started = time.perf_counter()
+                    processed = daemon.check_emails()
+                    elapsed = time.perf_counter() - started
+                    done.set()
+                    sampler.join()
+                    daemon.session.close()
+                    daemon.smtp_pool.close()
+            finally:
+                parent_conn.send('stop')
+                smtp_stats = parent_conn.recv()
+                child.join()
+
+            results.append({
+                'mode': mode,
+                'messages': processed,
+                'message_mb': message_mb,
+                'copies_sent': smtp_stats['messages'],
+                'mb_sent': round(smtp_stats['bytes'] / 1024 / 1024, 1),
+                'seconds': round(elapsed, 2),
+                'baseline_rss_mb': round(baseline / 1024 / 1024, 1),
+                'peak_rss_mb': round(peak[0] / 1024 / 1024, 1),
+            })
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+    return results
+
+
+def bench_engines(engines=('sync', 'sync-workers', 'async'), messages=20, subscribers=50, latency=0.02, concurrency=8):
+    """
+    Full check cycles (IMAP fetch, routing, per-subscriber SMTP fan-out) of
+    *messages* list messages through the blocking engine, the blocking engine
+    with *concurrency* sender workers, and the asyncio engine with
+    *concurrency* envelopes in flight, against servers with *latency* seconds
+    of simulated round trip. Uses a throwaway test database.
+    """
+    import asyncio
+    from django.db import connection
+    from .async_daemon import AsyncEmailDaemon
+    from .email_daemon import EmailDaemon
+    from .models import MailboxCheckpoint, MailingList, Subscriber
+
+    alias = 'bench@cyphy.life'
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    results = []
+    try:
+        mailing_list = MailingList.objects.create(alias=alias)
+        for i in range(subscribers):
+            Subscriber.objects.create(email=f'subscriber{i}@example.com').mailing_lists.add(mailing_list)
+
+        for engine in engines:
+            mailbox = FakeMailbox()
+            for i in range(messages):
+                mailbox.append(make_message(alias, subject=f'Engine {i}', body='x' * 5_000))
+            with FakeIMAPServer(latency=latency, mailbox=mailbox) as imap_server, \
+                    FakeSMTPServer(latency=latency, keep_data=False) as smtp_server:
+                MailboxCheckpoint.objects.all().delete()
+                MailboxCheckpoint.objects.create(account=settings.EMAIL_ADDRESS or '', folder='INBOX',
+                                                 uidvalidity=mailbox.uidvalidity, last_uid=0)
+                overrides = dict(
+                    IMAP_SERVER='127.0.0.1', IMAP_PORT=imap_server.port, IMAP_USE_SSL=False,
+                    SMTP_SERVER='127.0.0.1', SMTP_PORT=smtp_server.port, SMTP_USE_TLS=False,
+                    MESSAGE_DEDUP=False, DELIVERY_QUEUE=False, FORWARD_BULK_ENVELOPE=False,
+                    FORWARD_PASSTHROUGH=True, SMTP_RATE_LIMIT=None,
+                    SMTP_SENDER_WORKERS=concurrency if engine == 'sync-workers' else 0,
+                    ASYNC_SMTP_CONCURRENCY=concurrency,
+                )
+                with override_settings(**overrides):
+                    if engine == 'async':
+                        daemon = AsyncEmailDaemon()
+                        daemon.tokens = FixedTokenProvider('bench-token')
+
+                        async def check():
+                            try:
+                                return await daemon.check_emails_async()
+                            finally:
+                                await daemon.close()
+
+                        started = time.perf_counter()
+                        processed = asyncio.run(check())
+                        elapsed = time.perf_counter() - started
+                    else:
+                        daemon = EmailDaemon()
+                        daemon.tokens = FixedTokenProvider('bench-token')
+                        started = time.perf_counter()
+                        processed = daemon.check_emails()
+                        elapsed = time.perf_counter() - started
+                        if daemon.sender_pool:
+                            daemon.sender_pool.close()
+                        daemon.session.close()
+                        daemon.smtp_pool.close()
+
+            results.append({
+                'engine': engine,
+                'messages': processed,
+                'copies_sent': smtp_server.stats['messages'],
+                'smtp_sessions': smtp_server.stats['auths'],
+                'seconds': round(elapsed, 2),
+                'messages_per_sec': round(processed / elapsed, 1),
+                'copies_per_sec': round(smtp_server.stats['messages'] / elapsed, 1),
+            })
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+    return results
+
+
+def bench_pipeline(modes=('sequential', 'pipeline'), big_subscribers=200, small_messages=10, small_subscribers=2,
+                   latency=0.02, send_workers=4):
+    """
+    Head-of-line blocking: one message to a list of *big_subscribers* arrives
+    first, followed by *small_messages* messages to a list of
+    *small_subscribers*. Reports when the small messages were all delivered
+    and the whole cycle finished, without and with the staged pipeline.
+    Uses a throwaway test database.
+    """
+    from django.db import connection
+    from .email_daemon import EmailDaemon
+    from .models import MailboxCheckpoint, MailingList, Subscriber
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    results = []
+    try:
+        big = MailingList.objects.create(alias='big@cyphy.life')
+        small = MailingList.objects.create(alias='small@cyphy.life')
+        for i in range(big_subscribers):
+            Subscriber.objects.create(email=f'big{i}@example.com').mailing_lists.add(big)
+        small_addresses = [f'small{i}@example.com' for i in range(small_subscribers)]
+        for address in small_addresses:
+            Subscriber.objects.create(email=address).mailing_lists.add(small)
+        small_copies = small_messages * small_subscribers
+
+        for mode in modes:
+            mailbox = FakeMailbox()
+            mailbox.append(make_message(big.alias, subject='Big list', body='x' * 5_000))
+            for i in range(small_messages):
+                mailbox.append(make_message(small.alias, subject=f'Small {i}', body='x' * 5_000))
+            with FakeIMAPServer(latency=latency, mailbox=mailbox) as imap_server, \
+                    FakeSMTPServer(latency=latency) as smtp_server:
+                MailboxCheckpoint.objects.all().delete()
+                MailboxCheckpoint.objects.create(account=settings.EMAIL_ADDRESS or '', folder='INBOX',
+                                                 uidvalidity=mailbox.uidvalidity, last_uid=0)
+                overrides = dict(
+                    IMAP_SERVER='127.0.0.1', IMAP_PORT=imap_server.port, IMAP_USE_SSL=False,
+                    SMTP_SERVER='127.0.0.1', SMTP_PORT=smtp_server.port, SMTP_USE_TLS=False,
+                    MESSAGE_DEDUP=False, DELIVERY_QUEUE=False, FORWARD_BULK_ENVELOPE=False,
+                    FORWARD_PASSTHROUGH=True, SMTP_SENDER_WORKERS=0,
+                    PIPELINE=mode == 'pipeline', PIPELINE_SEND_WORKERS=send_workers,
+                )
+                small_done = [None]
+                done = threading.Event()
+
+                def watch():
+                    while not done.wait(0.005):
+                        delivered = sum(
+                            1 for _, recipients, _ in list(smtp_server.messages) if recipients[0] in small_addresses
+                        )
+                        if delivered >= small_copies:
+                            small_done[0] = time.perf_counter()
+                            return
+
+                with override_settings(**overrides):
+                    daemon = EmailDaemon()
+                    daemon.tokens = FixedTokenProvider('bench-token')
+                    watcher = threading.Thread(target=watch, daemon=True)
+                    started = time.perf_counter()
+                    watcher.start()
+                    processed = daemon.check_emails()
+                    elapsed = time.perf_counter() - started
+                    watcher.join(timeout=1)
+                    done.set()
+                    daemon.session.close()
+                    daemon.smtp_pool.close()
+
+            stages = daemon.pipeline_snapshot()
+            busiest = max(stages, key=lambda stage: stage['items'] * stage['mean_service_ms'], default=None)
+            results.append({
+                'mode': mode,
+                'messages': processed,
+                'copies_sent': len(smtp_server.messages),
+                'small_done_seconds': round(small_done[0] - started, 2) if small_done[0] else None,
+                'seconds': round(elapsed, 2),
+                'busiest_stage': busiest['stage'] if busiest else '-',
+            })
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+    return results
+
+
+def _run_replica(shards):
+    """Child process: one replica, supervising a daemon process per shard until SIGTERM."""
+    from .supervisor import ShardSupervisor
+
+    ShardSupervisor(shards).run()
+
+
+def bench_replicas(replicas=3, shards=2, messages=20, subscribers=3, lease_ttl=3):
+    """
+    Run *replicas* supervisor processes over the same *shards* mailbox
+    shards with leases on, as separate hosts would. Half the messages are
+    forwarded, every lease holder is killed with SIGKILL, and the rest must
+    be forwarded after the standby replicas take over. Reports how many
+    copies each subscriber got per message; every count should be exactly
+    one. Uses a throwaway test database, in a file so the replicas share it.
+    """
+    import signal
+    import tempfile
+    from collections import Counter
+    from django.db import connection
+    from .fakes import FakeTokenServer
+    from .models import MailboxCheckpoint, MailingList, ShardLease, Subscriber
+    from .shards import get_shards
+
+    if connection.vendor == 'sqlite':
+        test_dir = tempfile.mkdtemp(prefix='bench-replicas-')
+        connection.settings_dict['TEST']['NAME'] = os.path.join(test_dir, 'replicas.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    context = multiprocessing.get_context('fork')
+    processes = []
+    try:
+        account = 'replicas@cyphy.life'
+        aliases = [f'shard{i}@cyphy.life' for i in range(shards)]
+        addresses = [f'subscriber{i}@example.com' for i in range(subscribers)]
+        for address in addresses:
+            Subscriber.objects.create(email=address)
+        for alias in aliases:
+            MailingList.objects.create(alias=alias).subscribers.add(*Subscriber.objects.all())
+
+        mailbox = FakeMailbox()
+        with FakeIMAPServer(mailbox=mailbox) as imap_server, FakeSMTPServer() as smtp_server, \
+                FakeTokenServer() as token_server:
+            # The stand-in IMAP server serves one mailbox whatever the folder, so each shard forwards one list
+            shard_config = [
+                dict(name=f'shard{i}', account=account, folder=f'Shard{i}', aliases=[alias],
+                     refresh_token='bench', client_id='bench', client_secret='bench')
+                for i, alias in enumerate(aliases)
+            ]
+            for config in shard_config:
+                MailboxCheckpoint.objects.create(account=account, folder=config['folder'],
+                                                 uidvalidity=mailbox.uidvalidity, last_uid=0)
+            overrides = dict(
+                IMAP_SERVER='127.0.0.1', IMAP_PORT=imap_server.port, IMAP_USE_SSL=False,
+                SMTP_SERVER='127.0.0.1', SMTP_PORT=smtp_server.port, SMTP_USE_TLS=False,
+                GMAIL_TOKEN_URI=token_server.url, MAILBOX_SHARDS=shard_config,
+                SHARD_LEASES=True, LEASE_TTL=lease_ttl, LEASE_HEARTBEAT=max(lease_ttl / 3, 0.2),
+                SHARD_RESTART_BACKOFF_MIN=1, SHARD_STATS_INTERVAL=1, POLL_INTERVAL=0.2,
+                SMTP_RATE_LIMIT=None, DELIVERY_QUEUE=False,
+            )
+
+            def wait_for(copies, timeout):
+                deadline = time.monotonic() + timeout
+                while len(smtp_server.messages) < copies and time.monotonic() < deadline:
+                    time.sleep(0.05)
+
+            def add_messages(start, stop):
+                for i in range(start, stop):
+                    mailbox.append(make_message(aliases[i % shards], subject=f'Replica {i}'))
+
+            with override_settings(**overrides):
+                started = time.perf_counter()
+                connection.close()
+                for _ in range(replicas):
+                    process = context.Process(target=_run_replica, args=(get_shards(),))
+                    process.start()
+                    processes.append(process)
+
+                half = messages // 2
+                add_messages(0, half)
+                wait_for(half * subscribers, timeout=60)
+
+                # Kill whichever shard processes hold the leases now
+                holders = list(ShardLease.objects.exclude(holder='').values_list('holder', flat=True))
+                connection.close()
+                for holder in holders:
+                    os.kill(int(holder.split(':')[1]), signal.SIGKILL)
+                killed_at = time.perf_counter()
+                add_messages(half, messages)
+                wait_for(messages * subscribers, timeout=60 + lease_ttl)
+                takeover = time.perf_counter() - killed_at
+                # Leave time for any duplicate to show up
+                time.sleep(lease_ttl)
+                elapsed = time.perf_counter() - started
+
+                for process in processes:
+                    process.terminate()
+                for process in processes:
+                    process.join(timeout=15)
+
+            copies = Counter(
+                (recipient, message_from_bytes(data)['Subject'])
+                for _, recipients, data in list(smtp_server.messages)
+                for recipient in recipients
+            )
+            expected = {
+                (address, f'[SHARD{i % shards}] Replica {i}') for i in range(messages) for address in addresses
+            }
+            epochs = dict(ShardLease.objects.values_list('name', 'epoch'))
+            return [{
+                'replicas': replicas,
+                'shards': shards,
+                'messages': messages,
+                'copies_expected': len(expected),
+                'copies_sent': sum(copies.values()),
+                'duplicates': sum(count - 1 for count in copies.values() if count > 1),
+                'missing': len(expected - set(copies)),
+                'holders_killed': len(holders),
+                'lease_acquisitions': sum(epochs.values()),
+                'takeover_seconds': round(takeover, 2),
+                'seconds': round(elapsed, 2),
+            }]
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def synthetic_messages(count, aliases, hit_rate=0.8, size_median=20_000, size_sigma=1.0, size_max=5_000_000,
+                       attachment_rate=0.2, seed=1):
+    """
+    Yield (to, raw) for *count* messages. A *hit_rate* share go to one of
+    *aliases*, the rest to @cyphy.life addresses that are not lists. Sizes
+    are log-normal around *size_median* bytes, capped at *size_max*; an
+    *attachment_rate* share carry most of their size in one to three binary
+    attachments. Message i has the subject "Synthetic i".
+    """
+    rng = random.Random(seed)
+    words = ('mailing', 'list', 'robotics', 'lab', 'meeting', 'paper', 'deadline', 'seminar', 'Grüße', 'naïve')
+    for i in range(count):
+        to = rng.choice(aliases) if rng.random() < hit_rate else f'unlisted{i}@cyphy.life'
+        size = min(size_max, max(200, int(rng.lognormvariate(math.log(size_median), size_sigma))))
+        attachments = rng.randint(1, 3) if rng.random() < attachment_rate else 0
+        text_size = size // 10 if attachments else size
+        text = ' '.join(rng.choice(words) for _ in range(text_size // 7 + 1))[:text_size]
+        if attachments:
+            msg = MIMEMultipart('mixed')
+            msg.attach(MIMEText(text, 'plain', 'utf-8'))
+            for n in range(attachments):
+                msg.attach(MIMEApplication(rng.randbytes((size - text_size) // attachments), Name=f'data{n}.bin'))
+        else:
+            msg = MIMEText(text, 'plain', 'utf-8')
+        msg['From'] = f'author{rng.randrange(20)}@example.com'
+        msg['To'] = to
+        msg['Subject'] = f'Synthetic {i}'
+        msg['Message-ID'] = f'<synthetic-{seed}-{i}@example.com>'
+        yield to, msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+
+
+def _run_e2e_daemon(engine, idle):
+    """Child process: run the daemon until SIGTERM."""
+    import signal
+    import sys
+    from .async_daemon import AsyncEmailDaemon
+    from .email_daemon import EmailDaemon
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    daemon = AsyncEmailDaemon() if engine == 'async' else EmailDaemon()
+    daemon.tokens = FixedTokenProvider('bench-token')
+    daemon.run(idle=idle)
+
+
+def _peak_rss_bytes(pid):
+    """Peak resident set size of process *pid* so far (VmHWM); Linux only."""
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def bench_e2e(messages=200, lists=4, subscribers=10, hit_rate=0.8, size_median=20_000, size_sigma=1.0,
+              size_max=5_000_000, attachment_rate=0.2, arrival_rate=50.0, imap_latency=0.02, smtp_latency=0.02,
+              imap_failure_rate=0.0, smtp_failure_rate=0.0, engine='sync', idle=True, retry_delay=1,
+              timeout=120, seed=1):
+    """
+    Run the daemon as it runs in production, in its own process, against
+    the stand-in servers. A synthetic mailbox (see synthetic_messages())
+    is delivered into the IMAP server at *arrival_rate* messages per second
+    (0: all at once) and every copy accepted by the SMTP server is matched
+    to its message. Reports throughput, the latency from a message's
+    arrival to each copy's acceptance, and the daemon's peak RSS. Injected
+    failures are retried through the delivery queue, so every copy should
+    still arrive exactly once. Uses a throwaway test database, in a file so
+    the daemon process shares it. Linux only (/proc).
+    """
+    import tempfile
+    from collections import Counter
+    from django.db import connection
+    from .models import MailboxCheckpoint, MailingList, Subscriber
+
+    if connection.vendor == 'sqlite':
+        test_dir = tempfile.mkdtemp(prefix='bench-e2e-')
+        connection.settings_dict['TEST']['NAME'] = os.path.join(test_dir, 'e2e.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    process = None
+    try:
+        aliases = [f'list{j}@cyphy.life' for j in range(lists)]
+        members = {}
+        for alias in aliases:
+            mailing_list = MailingList.objects.create(alias=alias)
+            members[alias] = [f'{alias.split("@")[0]}-subscriber{k}@example.com' for k in range(subscribers)]
+            for address in members[alias]:
+                Subscriber.objects.create(email=address).mailing_lists.add(mailing_list)
+
+        corpus = list(synthetic_messages(messages, aliases, hit_rate, size_median, size_sigma, size_max,
+                                         attachment_rate, seed))
+        expected = {(address, i) for i, (to, _) in enumerate(corpus) for address in members.get(to, ())}
+        arrived = {}
+        mailbox = FakeMailbox()
+        with FakeIMAPServer(latency=imap_latency, mailbox=mailbox, failure_rate=imap_failure_rate,
+                            seed=seed) as imap_server, \
+                FakeSMTPServer(latency=smtp_latency, failure_rate=smtp_failure_rate, seed=seed) as smtp_server:
+            MailboxCheckpoint.objects.create(account=settings.EMAIL_ADDRESS or '', folder='INBOX',
+                                             uidvalidity=mailbox.uidvalidity, last_uid=0)
+            overrides = dict(
+                IMAP_SERVER='127.0.0.1', IMAP_PORT=imap_server.port, IMAP_USE_SSL=False,
+                SMTP_SERVER='127.0.0.1', SMTP_PORT=smtp_server.port, SMTP_USE_TLS=False,
+                POLL_INTERVAL=0.2, DELIVERY_QUEUE=True, DELIVERY_RETRY_MIN=retry_delay,
+                SMTP_RATE_LIMIT=None, METRICS_PORT=None,
+            )
+            with override_settings(**overrides):
+                connection.close()
+                process = multiprocessing.get_context('fork').Process(
+                    target=_run_e2e_daemon, args=(engine, idle), daemon=True,
+                )
+                process.start()
+                # Start the clock once the daemon has its mailbox open
+                deadline = time.monotonic() + timeout
+                while not imap_server.stats['selects'] and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                started = time.monotonic()
+                for i, (_, raw) in enumerate(corpus):
+                    if arrival_rate:
+                        time.sleep(max(0.0, started + i / arrival_rate - time.monotonic()))
+                    arrived[i] = time.monotonic()
+                    mailbox.append(raw)
+                while len(smtp_server.messages) < len(expected) and time.monotonic() < deadline:
+                    time.sleep(0.02)
+                finished = max(smtp_server.accepted_at, default=time.monotonic())
+                # Leave time for any duplicate to show up
+                time.sleep(0.5)
+                peak_rss = _peak_rss_bytes(process.pid)
+                process.terminate()
+                process.join(timeout=15)
+
+        subject = re.compile(rb'^Subject:.*?Synthetic (\d+)', re.MULTILINE)
+        copies = Counter()
+        latencies = []
+        for (_, recipients, data), accepted in zip(list(smtp_server.messages), list(smtp_server.accepted_at)):
+            i = int(subject.search(data).group(1))
+            for recipient in recipients:
+                copies[recipient, i] += 1
+                if copies[recipient, i] == 1:
+                    latencies.append(accepted - arrived[i])
+        elapsed = finished - started
+        return [{
+            'engine': engine,
+            'mode': 'idle' if idle else 'poll',
+            'messages': messages,
+            'list_messages': len({i for _, i in expected}),
+            'mean_message_kb': round(statistics.mean(len(raw) for _, raw in corpus) / 1024, 1),
+            'copies_expected': len(expected),
+            'copies_sent': sum(copies.values()),
+            'duplicates': sum(count - 1 for count in copies.values() if count > 1),
+            'missing': len(expected - set(copies)),
+            'imap_failures': imap_server.stats['failures'],
+            'smtp_failures': smtp_server.stats['failures'],
+            'seconds': round(elapsed, 2),
+            'messages_per_sec': round(messages / elapsed, 1),
+            'sends_per_sec': round(smtp_server.stats['messages'] / elapsed, 1),
+            'p50_latency_ms': round(_percentile(latencies, 50) * 1000, 1) if latencies else None,
+            'p95_latency_ms': round(_percentile(latencies, 95) * 1000, 1) if latencies else None,
+            'p99_latency_ms': round(_percentile(latencies, 99) * 1000, 1) if latencies else None,
+            'max_latency_ms': round(max(latencies) * 1000, 1) if latencies else None,
+            'peak_rss_mb': round(peak_rss / 1024 / 1024, 1),
+        }]
+    finally:
+        if process is not None and process.is_alive():
+            process.kill()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def bench_web(modes=('inline', 'outbox'), signups=10, lists=3, smtp_latency=0.05, coalesce=0.5):
+    """
+    Latency of the subscribe and unsubscribe requests with their emails sent
+    inside the request (inline) and queued to the background outbox. Each of
+    *signups* addresses subscribes to *lists* lists, then unsubscribes from
+    the first list in one request and from the others in the next, against
+    an SMTP server with *smtp_latency* seconds of round trip; the outbox
+    folds unsubscribes within *coalesce* seconds together. Also reports the
+    emails and SMTP sessions used and when the last email was accepted. Uses
+    a throwaway test database.
+    """
+    from django.db import connection
+    from django.test import Client
+    from .fakes import FakeTokenServer
+    from .models import MailingList
+    from .outbox import get_outbox, reset_outbox
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    results = []
+    try:
+        mailing_lists = [MailingList.objects.create(alias=f'web{i}@cyphy.life') for i in range(lists)]
+        with FakeTokenServer() as token_server:
+            for mode in modes:
+                with FakeSMTPServer(latency=smtp_latency) as smtp_server:
+                    overrides = dict(
+                        EMAIL_BACKEND='emails.backends.GmailOAuth2Backend',
+                        EMAIL_HOST='127.0.0.1', EMAIL_PORT=smtp_server.port, EMAIL_USE_TLS=False,
+                        EMAIL_HOST_USER='web@cyphy.life', EMAIL_ADDRESS='web@cyphy.life',
+                        GMAIL_TOKEN_URI=token_server.url, GMAIL_REFRESH_TOKEN='bench',
+                        GMAIL_CLIENT_ID='bench', GMAIL_CLIENT_SECRET='bench',
+                        ALLOWED_HOSTS=['testserver'],
+                        WEB_EMAIL_OUTBOX=mode == 'outbox', OUTBOX_COALESCE_SECONDS=coalesce,
+                    )
+                    with override_settings(**overrides):
+                        client = Client()
+                        latencies = {'subscribe': [], 'unsubscribe': []}
+                        errors = 0
+                        started = time.perf_counter()
+                        for i in range(signups):
+                            address = f'{mode}-{i}@example.com'
+                            requests = [
+                                ('subscribe', {'action': 'subscribe', 'email': address,
+                                               'mailing_lists': [ml.pk for ml in mailing_lists]}),
+                                ('unsubscribe', {'action': 'unsubscribe', 'email': address,
+                                                 'unsubscribe_from': [mailing_lists[0].pk]}),
+                                ('unsubscribe', {'action': 'unsubscribe', 'email': address,
+                                                 'unsubscribe_from': [ml.pk for ml in mailing_lists[1:]]}),
+                            ]
+                            for kind, data in requests:
+                                request_started = time.perf_counter()
+                                response = client.post('/', data)
+                                latencies[kind].append(time.perf_counter() - request_started)
+                                errors += response.status_code != 302
+                        if mode == 'outbox':
+                            get_outbox().join()
+                        elapsed = time.perf_counter() - started
+                        reset_outbox()
+
+                all_latencies = latencies['subscribe'] + latencies['unsubscribe']
+                results.append({
+                    'mode': mode,
+                    'requests': len(all_latencies),
+                    'errors': errors,
+                    'subscribe_p50_ms': round(_percentile(latencies['subscribe'], 50) * 1000, 1),
+                    'unsubscribe_p50_ms': round(_percentile(latencies['unsubscribe'], 50) * 1000, 1),
+                    'p95_ms': round(_percentile(all_latencies, 95) * 1000, 1),
+                    'max_ms': round(max(all_latencies) * 1000, 1),
+                    'emails': smtp_server.stats['messages'],
+                    'smtp_sessions': smtp_server.stats['auths'],
+                    'all_sent_seconds': round(elapsed, 2),
+                })
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+    return results
+
+
+def _with_headers(msg, subject):
+    """*msg* as raw bytes, with the addressing and threading headers of a reply posted to a list."""
+    msg['From'] = '"Dr. Ada Example" <ada@example.com>'
+    msg['To'] = '"Robotics Lab" <bench@cyphy.life>, Grace Example <grace@example.com>, "alan@example.org" <alan@example.org>'
+    msg['Cc'] = 'seminar@cyphy.life, <barbara@example.net>'
+    msg['Delivered-To'] = 'bench@cyphy.life'
+    msg['X-Original-To'] = 'bench@cyphy.life'
+    msg['Subject'] = subject
+    msg['Date'] = 'Tue, 14 Oct 2025 09:30:00 +0200'
+    msg['Message-ID'] = '<reply-6@example.com>'
+    msg['In-Reply-To'] = '<reply-5@example.com>'
+    msg['References'] = ' '.join(f'<reply-{i}@example.com>' for i in range(6))
+    return msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+
+
+def mime_corpus(attachment_mb=10):
+    """Fixture messages for bench_mime(), by name: the shapes of mail the lists actually carry."""
+    paragraph = 'Reminder: the lab meeting moves to room 2.14 on Thursday. Bring your slides. '
+    html = '<p>Ünïcode newsletter paragraph with <a href="https://example.com">a link</a>.</p>\n'
+    rng = random.Random(1)
+    corpus = {}
+
+    corpus['plain'] = _with_headers(MIMEText(paragraph * 30, 'plain', 'utf-8'), 'Lab meeting')
+
+    corpus['html-only'] = _with_headers(MIMEText(html * 600, 'html', 'utf-8'), 'Newsletter – Grüße')
+
+    alternative = MIMEMultipart('alternative')
+    alternative.attach(MIMEText(paragraph * 600, 'plain', 'utf-8'))
+    alternative.attach(MIMEText(html * 1200, 'html', 'utf-8'))
+    corpus['alternative'] = _with_headers(alternative, 'Newsletter – Grüße')
+
+    # A rich-text client's post: inline images next to the HTML, plus a document
+    related = MIMEMultipart('related')
+    body = MIMEMultipart('alternative')
+    body.attach(MIMEText(paragraph * 100, 'plain', 'utf-8'))
+    body.attach(MIMEText(html * 200 + '<img src="cid:figure0"><img src="cid:figure1">', 'html', 'utf-8'))
+    related.attach(body)
+    for i in range(2):
+        image = MIMEImage(b'\x89PNG\r\n\x1a\n' + rng.randbytes(150_000), 'png')
+        image.add_header('Content-ID', f'<figure{i}>')
+        image.add_header('Content-Disposition', 'inline', filename=f'figure{i}.png')
+        related.attach(image)
+    mixed = MIMEMultipart('mixed')
+    mixed.attach(related)
+    mixed.attach(MIMEApplication(rng.randbytes(300_000), 'pdf', Name='minutes.pdf'))
+    corpus['related'] = _with_headers(mixed, 'Figures for the paper')
+
+    attachment = MIMEMultipart('mixed')
+    attachment.attach(MIMEText(paragraph * 5, 'plain', 'utf-8'))
+    attachment.attach(MIMEApplication(rng.randbytes(attachment_mb * 1024 * 1024), Name='dataset.bin'))
+    corpus[f'attachment-{attachment_mb}mb'] = _with_headers(attachment, 'Dataset')
+
+    legacy = MIMEMultipart('alternative')
+    legacy.attach(MIMEText('Grüße aus München, café à côté. ' * 200, 'plain', 'iso-8859-1'))
+    legacy.attach(MIMEText('<p>Привет из лаборатории робототехники.</p>\n' * 400, 'html', 'koi8-r'))
+    corpus['legacy-charsets'] = _with_headers(legacy, Header('Семинар по робототехнике', 'koi8-r'))
+    return corpus
+
+
+def _time_per_call(func, repeat):
+    """Best seconds per call of *func* over *repeat* timeit runs of at least 0.2 seconds each."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def _peak_alloc(func):
+    """Peak bytes traced while *func*() runs."""
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def bench_mime(messages=None, repeat=5, attachment_mb=10):
+    """
+    Time and peak allocation per call of the daemon's CPU-bound MIME paths
+    over mime_corpus() (or the *messages* named in it): parsing, recipient
+    address extraction (per message and per address), body part
+    extraction, and building and serializing one subscriber's copy, rebuilt
+    or passthrough.
+    """
+    from .email_daemon import EmailDaemon
+
+    daemon = EmailDaemon()
+    mailing_list = SimpleNamespace(alias='bench@cyphy.life')
+    corpus = mime_corpus(attachment_mb)
+    results = []
+    for name in messages or corpus:
+        raw = corpus[name]
+        original = message_from_bytes(raw)
+        content = daemon._prepare_forward(original, mailing_list)
+        passthrough = PassthroughMessage(raw)
+        next_address = itertools.cycle(original['To'].split(',') + original['Cc'].split(',')).__next__
+
+        def rebuild():
+            msg = daemon._build_forward(content, mailing_list, 'subscriber@example.com')
+            return msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+
+        operations = [
+            ('parse', lambda: message_from_bytes(raw)),
+            ('extract_email_addresses', lambda: daemon.extract_email_addresses(original)),
+            ('extract_email_address', lambda: daemon.extract_email_address(next_address())),
+            ('extract_parts', lambda: daemon._extract_parts(original)),
+            ('rebuild', rebuild),
+            ('passthrough', lambda: passthrough.render(mailing_list.alias, 'subscriber@example.com')),
+        ]
+        for operation, func in operations:
+            results.append({
+                'message': name,
+                'operation': operation,
+                'message_kb': round(len(raw) / 1024, 1),
+                'us_per_op': round(_time_per_call(func, repeat) * 1e6, 2),
+                'peak_alloc_kb': round(_peak_alloc(func) / 1024, 1),
+            })
+    return results
+
+
+def compare_with_baseline(results, path, key, measures, threshold):
+    """
+    Add each measure's baseline value and relative change to *results* from
+    the --output file at *path*, matching rows on the *key* columns. Returns
+    the rows where a measure grew by more than *threshold* (e.g. 0.2 for 20%).
+    """
+    with open(path) as baseline_file:
+        baseline = {tuple(row[k] for k in key): row for row in json.load(baseline_file)['results']}
+    regressions = []
+    for row in results:
+        before = baseline.get(tuple(row[k] for k in key))
+        regressed = False
+        for measure in measures:
+            old = before[measure] if before else None
+            row[f'baseline_{measure}'] = old
+            row[f'{measure}_change'] = f'{row[measure] / old - 1:+.1%}' if old else None
+            if old and row[measure] > old * (1 + threshold):
+                regressed = True
+        row['regressed'] = regressed
+        if regressed:
+            regressions.append(row)
+    return regressions
@@ -0,0 +1,109 @@
+"""
+Suppresses repeat forwards of the same message to the same list. Keys are
+the Message-ID, or a hash of the identifying headers and body for mail
+without one; recently seen keys are answered from an in-memory LRU and
+everything else from the ForwardedMessage table.
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import ForwardedMessage
+
+logger = logging.getLogger(__name__)
+
+# Headers that identify a message when it has no Message-ID (Received/Delivered-To differ per copy)
+CONTENT_KEY_HEADERS = ('From', 'Date', 'Subject')
+
+
+def message_id_key(message_id):
+    """Dedup key for a Message-ID header value, or None if it is empty."""
+    message_id = (message_id or '').strip()
+    if not message_id:
+        return None
+    return message_id[:255]
+
+
+def content_key(headers, body):
+    """Fallback dedup key: a hash of the identifying headers and the body (bytes or an iterable of chunks)."""
+    digest = hashlib.sha256()
+    for name in CONTENT_KEY_HEADERS:
+        digest.update(f"{name}: {headers.get(name, '')}\n".encode('utf-8', 'surrogateescape'))
+    for chunk in [body] if isinstance(body, bytes) else body:
+        digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+
+class DedupStore:
+    def __init__(self, capacity=10_000, ttl=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._recent = OrderedDict()  # (key, mailing_list_id) -> None, most recent last
+        self._lock = threading.Lock()
+        self._last_prune = None
+        self.stats = {'suppressed': 0, 'recorded': 0, 'cache_hits': 0}
+
+    def _remember(self, entry):
+        with self._lock:
+            self._recent[entry] = None
+            self._recent.move_to_end(entry)
+            while len(self._recent) > self.capacity:
+                self._recent.popitem(last=False)
+
+    def seen(self, key, mailing_list_id):
+        """Whether the message with *key* was already forwarded to the list."""
+        entry = (key, mailing_list_id)
+        with self._lock:
+            if entry in self._recent:
+                self._recent.move_to_end(entry)
+                self.stats['cache_hits'] += 1
+                return True
+        if ForwardedMessage.objects.filter(key=key, mailing_list_id=mailing_list_id).exists():
+            self._remember(entry)
+            return True
+        return False
+
+    def filter_new(self, key, mailing_lists, claimed=None):
+        """
+        The subset of *mailing_lists* the message with *key* has not been
+        forwarded to yet. *claimed*, a set shared across one pass, also
+        catches copies of a message that have been routed but not recorded.
+        """
+        fresh = []
+        for mailing_list in mailing_lists:
+            entry = (key, mailing_list.pk)
+            if (claimed is not None and entry in claimed) or self.seen(key, mailing_list.pk):
+                self.stats['suppressed'] += 1
+                logger.info(f"Skipping duplicate {key} for {mailing_list.alias}")
+            else:
+                fresh.append(mailing_list)
+                if claimed is not None:
+                    claimed.add(entry)
+        return fresh
+
+    def record(self, key, mailing_lists):
+        """Remember that the message with *key* has been forwarded to *mailing_lists*."""
+        for mailing_list in mailing_lists:
+            try:
+                with transaction.atomic():
+                    ForwardedMessage.objects.create(key=key, mailing_list_id=mailing_list.pk)
+            except IntegrityError:
+                pass
+            else:
+                self.stats['recorded'] += 1
+            self._remember((key, mailing_list.pk))
+
+    def prune(self, interval=3600):
+        """Delete records older than the TTL, at most once per *interval* seconds."""
+        now = timezone.now()
+        if self.ttl is None or (self._last_prune and (now - self._last_prune).total_seconds() < interval):
+            return 0
+        self._last_prune = now
+        deleted, _ = ForwardedMessage.objects.filter(forwarded_at__lt=now - self.ttl).delete()
+        if deleted:
+            logger.info(f"Pruned {deleted} dedup records older than {self.ttl.days} days")
+        return deleted
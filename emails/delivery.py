@@ -0,0 +1,213 @@
+"""
+Database-backed outbound queue: every (incoming message, subscriber) pair
+is recorded as a Delivery before anything is sent, so a crash mid fan-out
+resumes with exactly the recipients that have not been recorded as sent.
+Deliveries being sent are claimed first, so a restarted daemon leaves them
+alone until the claim goes stale.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Delivery, OutboundChunk, OutboundMessage
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(raw, source, mailing_list, message_id='', recipients=None, account='', folder='INBOX'):
+    """
+    Queue *raw* for *recipients* (default: every active subscriber of
+    *mailing_list*) in one transaction, as coming from the mailbox
+    *account*/*folder*. *raw* is bytes, or a spooled file that is copied in
+    DELIVERY_CHUNK_SIZE pieces. Returns the number of
+    deliveries created, or 0 when the message from *source* was already
+    queued for this list.
+    """
+    spooled = not isinstance(raw, bytes)
+    with transaction.atomic():
+        outbound, created = OutboundMessage.objects.get_or_create(
+            source=source,
+            # A cached ListRoute or a MailingList
+            mailing_list_id=mailing_list.pk,
+            defaults={
+                'raw': b'' if spooled else raw, 'message_id': message_id or '', 'account': account, 'folder': folder,
+            },
+        )
+        if not created:
+            logger.info(f"{source} is already queued for {mailing_list.alias}")
+            return 0
+        if spooled:
+            raw.seek(0)
+            for index, data in enumerate(iter(lambda: raw.read(settings.DELIVERY_CHUNK_SIZE), b'')):
+                OutboundChunk.objects.create(message=outbound, index=index, data=data)
+
+        now = timezone.now()
+        count = 0
+        batch = []
+        if recipients is None:
+            recipients = mailing_list.iter_active_subscriber_emails(settings.SUBSCRIBER_CHUNK_SIZE)
+        for recipient in recipients:
+            batch.append(Delivery(message=outbound, recipient=recipient, next_attempt_at=now))
+            if len(batch) >= settings.SUBSCRIBER_CHUNK_SIZE:
+                Delivery.objects.bulk_create(batch, ignore_conflicts=True)
+                count += len(batch)
+                batch = []
+        if batch:
+            Delivery.objects.bulk_create(batch, ignore_conflicts=True)
+            count += len(batch)
+    return count
+
+
+def open_raw(outbound):
+    """
+    The queued message's bytes, or for a message queued in chunks a
+    SpooledTemporaryFile (on disk beyond IMAP_SPOOL_THRESHOLD bytes) filled
+    one chunk at a time; the caller closes it.
+    """
+    chunks = list(outbound.chunks.order_by('index').values_list('pk', flat=True))
+    if not chunks:
+        return bytes(outbound.raw)
+    spool = SpooledTemporaryFile(max_size=settings.IMAP_SPOOL_THRESHOLD or 0)
+    try:
+        for pk in chunks:
+            spool.write(OutboundChunk.objects.values_list('data', flat=True).get(pk=pk))
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def retry_delay(attempts):
+    """Exponential backoff after the *attempts*-th failed attempt."""
+    return timedelta(seconds=min(settings.DELIVERY_RETRY_MAX, settings.DELIVERY_RETRY_MIN * 2 ** (attempts - 1)))
+
+
+def _pending(mailbox):
+    """Pending deliveries, of messages from the (account, folder) *mailbox* only when given."""
+    deliveries = Delivery.objects.filter(status=Delivery.PENDING)
+    if mailbox is not None:
+        account, folder = mailbox
+        deliveries = deliveries.filter(message__account=account, message__folder=folder)
+    return deliveries
+
+
+def due_deliveries(limit, mailbox=None):
+    """
+    (pk, message_id, recipient, attempts) of pending deliveries whose retry
+    time has come, grouped by message. *mailbox*, an (account, folder)
+    pair, limits them to messages from that exact mailbox.
+    """
+    return list(
+        _pending(mailbox).filter(next_attempt_at__lte=timezone.now())
+        .order_by('message_id', 'pk')
+        .values_list('pk', 'message_id', 'recipient', 'attempts')[:limit]
+    )
+
+
+def next_due(mailbox=None):
+    """When the earliest pending delivery (from *mailbox*, if given) becomes due, or None if the queue is empty."""
+    return (
+        _pending(mailbox)
+        .order_by('next_attempt_at')
+        .values_list('next_attempt_at', flat=True)
+        .first()
+    )
+
+
+def prune(older_than):
+    """Delete queued messages whose deliveries have all finished and that are older than *older_than*."""
+    finished = OutboundMessage.objects.filter(created_at__lt=timezone.now() - older_than).exclude(
+        deliveries__status=Delivery.PENDING
+    )
+    deleted, _ = finished.delete()
+    return deleted
+
+
+class DeliveryRecorder:
+    """
+    Claims the deliveries in *pending* ({recipient: (pk, attempts)}), then
+    collects their per-recipient outcomes and writes them back in batches of
+    *batch_size* with one UPDATE per outcome group. SMTP 5xx refusals and
+    running out of attempts mark a delivery failed; anything else is retried
+    with exponential backoff.
+    """
+
+    def __init__(self, pending, batch_size=1):
+        self.pending = pending
+        self.batch_size = batch_size
+        self.sent = []
+        self.retry = defaultdict(list)  # (attempts, error) -> pks
+        self.failed = defaultdict(list)  # error -> pks
+        self.recorded = set()
+        self.counts = {'sent': 0, 'retry': 0, 'failed': 0}
+
+    def __len__(self):
+        return len(self.sent) + sum(map(len, self.retry.values())) + sum(map(len, self.failed.values()))
+
+    def claim(self):
+        """
+        Mark every pending delivery in flight before anything is sent: its
+        retry time moves DELIVERY_INFLIGHT_TIMEOUT ahead, so a restarted
+        daemon skips it unless this one died without recording an outcome
+        and the claim has gone stale.
+        """
+        now = timezone.now()
+        Delivery.objects.filter(pk__in=[pk for pk, _ in self.pending.values()], status=Delivery.PENDING).update(
+            next_attempt_at=now + timedelta(seconds=settings.DELIVERY_INFLIGHT_TIMEOUT), updated_at=now,
+        )
+
+    def record(self, recipients, result):
+        """Record the result of one envelope: a refused-recipients dict or the exception it raised."""
+        for recipient in recipients:
+            self.recorded.add(recipient)
+            pk, attempts = self.pending[recipient]
+            attempts += 1
+            if isinstance(result, Exception):
+                code, error = getattr(result, 'smtp_code', None), str(result)
+            elif recipient in result:
+                code, response = result[recipient]
+                error = f"{code} {response!r}"
+            else:
+                self.sent.append(pk)
+                continue
+            if (code and code >= 500) or attempts >= settings.DELIVERY_MAX_ATTEMPTS:
+                self.failed[error[:1000]].append(pk)
+            else:
+                self.retry[(attempts, error[:1000])].append(pk)
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def unrecorded(self):
+        """Recipients no outcome was recorded for, e.g. because forwarding failed before sending."""
+        return [recipient for recipient in self.pending if recipient not in self.recorded]
+
+    def flush(self):
+        if not len(self):
+            return
+        now = timezone.now()
+        with transaction.atomic():
+            if self.sent:
+                Delivery.objects.filter(pk__in=self.sent).update(
+                    status=Delivery.SENT, attempts=F('attempts') + 1, last_error='', updated_at=now,
+                )
+            for (attempts, error), pks in self.retry.items():
+                Delivery.objects.filter(pk__in=pks).update(
+                    attempts=attempts, next_attempt_at=now + retry_delay(attempts), last_error=error, updated_at=now,
+                )
+            for error, pks in self.failed.items():
+                Delivery.objects.filter(pk__in=pks).update(
+                    status=Delivery.FAILED, attempts=F('attempts') + 1, last_error=error, updated_at=now,
+                )
+        self.counts['sent'] += len(self.sent)
+        self.counts['retry'] += sum(map(len, self.retry.values()))
+        self.counts['failed'] += sum(map(len, self.failed.values()))
+        self.sent = []
+        self.retry.clear()
+        self.failed.clear()
@@ -1,56 +1,172 @@
 import base64
 import imaplib
+import queue
 import smtplib
 import socket
+import threading
 from email import message_from_bytes
+from email.parser import BytesHeaderParser
+from email.utils import parsedate_to_datetime
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from django.conf import settings
+from django.utils import timezone
 import django.db
 import time
 import logging
-from datetime import datetime, timedelta
-import email.utils
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from .models import MailingList
+from datetime import timedelta
+from itertools import groupby, islice
+from .imap import IMAPSession, fetch_messages, idle as imap_idle, parse_fetch, plan_batches, supports_idle
+from .dedup import DedupStore, content_key, message_id_key
+from .leases import Lease, LeaseLost, replica_id
+from . import metrics
+from .delivery import DeliveryRecorder, due_deliveries, enqueue, next_due, open_raw, prune
+from .models import Delivery, MailingList, MailboxCheckpoint, OutboundMessage
+from .passthrough import PassthroughMessage, read_head
+from .pipeline import Pipeline
+from .profiling import CycleProfiler
+from .routing import RoutingTable
+from .shards import get_shards
+from .smtp import SenderPool, SMTPConnectionPool, TokenBucket
+from .tracing import Trace, Tracer, span
 
 logger = logging.getLogger(__name__)
 
+# Everything routing needs, fetched before deciding whether to download a message body
+ROUTING_HEADERS = ('To', 'Delivered-To', 'X-Original-To', 'Envelope-To', 'Date', 'Message-ID')
+
+class PipelineJob:
+    """A fetched message on its way through the pipeline stages."""
+
+    __slots__ = ('uid', 'raw', 'mailing_lists', 'key', 'claimed', 'trace', 'parsed', 'pending', 'forwarded', 'lock')
+
+    def __init__(self, uid, raw, mailing_lists, key, claimed, trace=None):
+        self.uid = uid
+        self.raw = raw
+        self.mailing_lists = mailing_lists
+        self.key = key
+        self.claimed = claimed
+        self.trace = trace
+        self.parsed = {}
+        self.pending = 0  # lists still being sent to
+        self.forwarded = []  # lists at least one subscriber got it from
+        self.lock = threading.Lock()
+
+
 class EmailDaemon:
-    def __init__(self):
+    def __init__(self, shard=None):
         self.imap_server = settings.IMAP_SERVER
         self.smtp_server = settings.SMTP_SERVER
-        self.email = settings.EMAIL_ADDRESS
-        self.credentials = Credentials(
-            token=None,
-            refresh_token=settings.GMAIL_REFRESH_TOKEN,
-            token_uri='https://oauth2.googleapis.com/token',
-            client_id=settings.GMAIL_CLIENT_ID,
-            client_secret=settings.GMAIL_CLIENT_SECRET,
+        # The mailbox folder this daemon reads, and which lists it forwards
+        self.shard = shard or get_shards()[0]
+        self.email = self.shard.account
+        # Access token shared with the web workers, refreshed ahead of expiry
+        self.tokens = self.shard.token_provider()
+        self.folder = self.shard.folder
+        # Messages from this mailbox are traced and queued as source_prefix + "uidvalidity/uid",
+        # and the delivery queue is drained by the exact (account, folder) pair
+        self.source_prefix = f"{self.email}/{self.folder}/"
+        self.mailbox = (self.email or '', self.folder)
+        self.stats = {'checks': 0, 'processed': 0, 'errors': 0}
+        self.metrics_port = settings.METRICS_PORT
+        # Opt-in cProfile captures of check cycles and tracemalloc snapshots
+        self.profiler = CycleProfiler(
+            settings.PROFILE_DIR, self.shard.name,
+            every=settings.PROFILE_CYCLES,
+            slow=settings.PROFILE_SLOW_CYCLE,
+            keep=settings.PROFILE_KEEP,
+            memory_interval=settings.TRACEMALLOC_INTERVAL,
+            memory_top=settings.TRACEMALLOC_TOP,
+            memory_frames=settings.TRACEMALLOC_FRAMES,
         )
-        self.last_check = datetime.now() - timedelta(minutes=1)
-        logger.info(f"Email daemon initialized with email: {self.email}")
-
-    def _refresh_credentials(self):
-        """Refresh the access token if needed."""
-        if not self.credentials.valid:
-            self.credentials.refresh(Request())
+        # With replicas, the mailbox is only worked on while this process holds its lease
+        self.lease = None
+        if settings.SHARD_LEASES:
+            self.lease = Lease(f"{self.email or ''}/{self.folder}", replica_id(),
+                               ttl=settings.LEASE_TTL, heartbeat=settings.LEASE_HEARTBEAT)
+        self.checkpoint = None
+        # UIDNEXT/HIGHESTMODSEQ from the last SELECT, consumed by the first check after it
+        self.selected_status = None
+        # Set when a check fails partway: UIDs past the checkpoint may be waiting without a new EXISTS to announce them
+        self.check_failed = False
+        self.session = IMAPSession(
+            self._connect_imap,
+            backoff_min=settings.IMAP_RECONNECT_BACKOFF_MIN,
+            backoff_max=settings.IMAP_RECONNECT_BACKOFF_MAX,
+        )
+        self.smtp_pool = SMTPConnectionPool(
+            self._connect_smtp,
+            # Keep a warm session per sender worker
+            size=max(settings.SMTP_POOL_SIZE, settings.SMTP_SENDER_WORKERS,
+                     settings.PIPELINE_SEND_WORKERS if settings.PIPELINE else 0),
+            max_messages=settings.SMTP_MAX_MESSAGES_PER_CONNECTION,
+            max_idle=settings.SMTP_POOL_MAX_IDLE,
+        )
+        self.sender_pool = None
+        if settings.SMTP_SENDER_WORKERS:
+            limiter = None
+            if settings.SMTP_RATE_LIMIT:
+                limiter = TokenBucket(settings.SMTP_RATE_LIMIT, settings.SMTP_RATE_BURST)
+            self.sender_pool = SenderPool(
+                self.smtp_pool,
+                workers=settings.SMTP_SENDER_WORKERS,
+                queue_size=settings.SMTP_SEND_QUEUE_SIZE,
+                limiter=limiter,
+            )
+        # alias -> active subscribers, kept current through RoutingVersion counters
+        self.routes = RoutingTable() if settings.ROUTING_CACHE else None
+        self.dedup = None
+        if settings.MESSAGE_DEDUP:
+            self.dedup = DedupStore(settings.DEDUP_CACHE_SIZE, timedelta(days=settings.DEDUP_TTL_DAYS))
+        # Latency traces of list messages, from arrival in the mailbox to the last accepted copy
+        self.tracer = None
+        if settings.MESSAGE_TRACING:
+            self.tracer = Tracer(timedelta(days=settings.TRACE_RETENTION_DAYS))
+        self.pipeline = None
+        if settings.PIPELINE:
+            self.pipeline = Pipeline([
+                ('parse', self._stage_parse, settings.PIPELINE_PARSE_WORKERS),
+                ('route', self._stage_route, settings.PIPELINE_ROUTE_WORKERS),
+                ('send', self._stage_send, settings.PIPELINE_SEND_WORKERS),
+            ], queue_size=settings.PIPELINE_QUEUE_SIZE)
+        self.fetch_stats = {'items': 0, 'service_seconds': 0.0, 'blocked_seconds': 0.0}
+        self._completed = queue.Queue()  # UIDs the pipeline has finished with
+        self._claim_lock = threading.Lock()
+        logger.info(f"Email daemon initialized for shard {self.shard}")
 
     def _xoauth2_bytes(self):
         """Return raw XOAUTH2 bytes for imaplib.authenticate() (imaplib base64-encodes itself)."""
-        self._refresh_credentials()
-        return f"user={self.email}\x01auth=Bearer {self.credentials.token}\x01\x01".encode()
+        return f"user={self.email}\x01auth=Bearer {self.tokens.get_token()}\x01\x01".encode()
 
     def _xoauth2_b64(self):
         """Return base64-encoded XOAUTH2 string for SMTP AUTH command."""
-        self._refresh_credentials()
-        auth_string = f"user={self.email}\x01auth=Bearer {self.credentials.token}\x01\x01"
+        auth_string = f"user={self.email}\x01auth=Bearer {self.tokens.get_token()}\x01\x01"
         return base64.b64encode(auth_string.encode()).decode()
 
+    def _connect_smtp(self):
+        """Open an authenticated SMTP session; returns it with the expiry of the token used."""
+        started = time.perf_counter()
+        server = smtplib.SMTP(self.smtp_server, settings.SMTP_PORT, timeout=30)
+        try:
+            server.ehlo()
+            if settings.SMTP_USE_TLS:
+                server.starttls()
+                server.ehlo()
+            code, response = server.docmd('AUTH', 'XOAUTH2 ' + self._xoauth2_b64())
+            if code != 235:
+                # The shared access token may have been revoked early; force a refresh
+                self.tokens.invalidate()
+                raise smtplib.SMTPAuthenticationError(code, response)
+        except Exception:
+            server.close()
+            raise
+        metrics.SMTP_CONNECT_SECONDS.observe(time.perf_counter() - started)
+        return server, self.tokens.expiry
+
     def extract_email_addresses(self, email_message):
         """Extract all possible recipient addresses from various headers"""
-        addresses = set()
+        # Ordered set: the order lists are addressed in decides CROSS_LIST_PRECEDENCE = 'header'
+        addresses = {}
 
         # Headers that might contain our target address
         recipient_headers = ['To', 'Delivered-To', 'X-Original-To', 'Envelope-To']
@@ -62,79 +178,722 @@ class EmailDaemon:
                 for addr_part in header_value.split(','):
                     clean_addr = self.extract_email_address(addr_part)
                     if clean_addr:
-                        addresses.add(clean_addr)
+                        addresses[clean_addr] = None
 
-        logger.debug(f"Extracted addresses: {addresses}")
-        return addresses
+        logger.debug(f"Extracted addresses: {list(addresses)}")
+        return list(addresses)
 
-    def check_emails(self):
+    def _connect_imap(self):
+        """Open an authenticated IMAP session with the shard's folder selected."""
+        started = time.perf_counter()
+        imap_class = imaplib.IMAP4_SSL if settings.IMAP_USE_SSL else imaplib.IMAP4
+        imap = imap_class(self.imap_server, settings.IMAP_PORT, timeout=30)
         try:
-            current_time = datetime.now()
-            logger.info(f"Checking for new emails since {self.last_check}...")
-
-            with imaplib.IMAP4_SSL(self.imap_server, timeout=30) as imap:
+            try:
                 imap.authenticate('XOAUTH2', lambda _: self._xoauth2_bytes())
-                imap.select('INBOX')
-
-                # Server-side SINCE filter to only download recent emails
-                date_str = self.last_check.strftime('%d-%b-%Y')
-                _, message_numbers = imap.search(None, f'(SINCE "{date_str}")')
-
-                for num in message_numbers[0].split():
-                    _, msg_data = imap.fetch(num, '(RFC822)')
-                    email_body = msg_data[0][1]
-                    email_message = message_from_bytes(email_body)
-
-                    # Get email date
-                    date_header = email_message['Date']
-                    if date_header:
-                        try:
-                            email_date = datetime.fromtimestamp(
-                                email.utils.mktime_tz(email.utils.parsedate_tz(date_header))
-                            )
-
-                            # Only process emails newer than last check
-                            if email_date > self.last_check:
-                                # Get all possible recipient addresses
-                                recipient_addresses = self.extract_email_addresses(email_message)
-                                logger.info(f"Found recipient addresses: {recipient_addresses}")
-
-                                # Check each address for @cyphy.life
-                                for address in recipient_addresses:
-                                    if '@cyphy.life' in address:
-                                        # Find corresponding mailing list
-                                        mailing_list = MailingList.objects.filter(alias=address).first()
-
-                                        if mailing_list:
-                                            logger.info(f"Found mailing list for: {address}")
-                                            subscribers = mailing_list.subscribers.filter(is_active=True)
-                                            if subscribers:
-                                                self.forward_email(email_message, subscribers, mailing_list)
-                                                logger.info(f"Email forwarded to {len(subscribers)} subscribers")
-                                            else:
-                                                logger.warning(f"No active subscribers found for {address}")
-                                        else:
-                                            logger.info(f"No mailing list found for: {address}")
-                            else:
-                                logger.debug(f"Skipping old email from {email_date}")
-                        except Exception as e:
-                            logger.error(f"Error processing email date: {str(e)}")
-                            logger.error("Error details:", exc_info=True)
-                            continue
-
-                    # Free memory after processing each email
-                    del email_message
-                    del msg_data
-
-            # Update last check time only after successful processing
-            self.last_check = current_time
-            logger.info(f"Email check completed. Next check will process emails after {self.last_check}")
+            except imaplib.IMAP4.error:
+                # The shared access token may have been revoked early; force a refresh
+                self.tokens.invalidate()
+                raise
+            self._select_folder(imap)
+        except Exception:
+            try:
+                imap.shutdown()
+            except OSError:
+                pass
+            raise
+        metrics.IMAP_CONNECT_SECONDS.observe(time.perf_counter() - started)
+        logger.info(f"Connected to {self.imap_server} as {self.email}")
+        return imap
+
+    def _select_folder(self, imap):
+        """SELECT the folder and reconcile the persisted checkpoint with the server's UIDVALIDITY."""
+        typ, data = imap.select(self.folder)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"SELECT {self.folder} failed: {data}")
+        uidvalidity = int(imap.response('UIDVALIDITY')[1][0])
+        uidnext = imap.response('UIDNEXT')[1][0]
+        uidnext = int(uidnext) if uidnext else None
+        modseq = imap.response('HIGHESTMODSEQ')[1][0]
+        modseq = int(modseq) if modseq else None
+        imap.untagged_responses.clear()
+        self._load_checkpoint(uidvalidity, uidnext, modseq, lambda: self._max_uid(imap))
+
+    def _load_checkpoint(self, uidvalidity, uidnext, modseq, max_uid):
+        """
+        Reconcile the persisted checkpoint with a freshly selected folder.
+        *max_uid* is called for the folder's highest UID when the server sent
+        no UIDNEXT.
+        """
+        checkpoint = MailboxCheckpoint.objects.filter(account=self.email or '', folder=self.folder).first()
+        if checkpoint is None or checkpoint.uidvalidity != uidvalidity:
+            # UIDs from another UIDVALIDITY epoch are meaningless, so start from the current end of the folder
+            baseline = uidnext - 1 if uidnext else max_uid()
+            if checkpoint is None:
+                logger.info(f"No checkpoint for {self.folder}, starting after UID {baseline}")
+                checkpoint = MailboxCheckpoint(account=self.email or '', folder=self.folder)
+            else:
+                logger.warning(
+                    f"UIDVALIDITY of {self.folder} changed from {checkpoint.uidvalidity} to {uidvalidity}, "
+                    f"resetting checkpoint to UID {baseline}"
+                )
+            checkpoint.uidvalidity = uidvalidity
+            checkpoint.last_uid = baseline
+            checkpoint.highest_modseq = modseq
+            checkpoint.save()
+        self.checkpoint = checkpoint
+        self.selected_status = {'uidnext': uidnext, 'highest_modseq': modseq}
+
+    def _max_uid(self, imap):
+        _, data = imap.uid('SEARCH', None, 'ALL')
+        uids = data[0].split()
+        return int(uids[-1]) if uids else 0
+
+    def _advance_checkpoint(self, uid):
+        """Persist *uid* as processed so a restart resumes right after it."""
+        checkpoints = MailboxCheckpoint.objects.filter(pk=self.checkpoint.pk)
+        if self.lease is not None and not self.lease.fence(checkpoints).update(last_uid=uid):
+            raise LeaseLost(f"Lease {self.lease.name} was taken over before UID {uid} was checkpointed")
+        elif self.lease is None:
+            checkpoints.update(last_uid=uid)
+        self.checkpoint.last_uid = uid
+
+    def _hold_lease(self):
+        """
+        Whether this replica may work on the mailbox now, acquiring its lease
+        if it is free. The checkpoint is dropped whenever the lease changes
+        hands, since another replica may have moved it on in the meantime.
+        """
+        if self.lease is None or self.lease.held:
+            return True
+        if self.lease.acquire():
+            self.checkpoint = self.selected_status = None
+            return True
+        if self.checkpoint is not None:
+            logger.info(f"Another replica holds the lease on {self.shard}, standing by")
+            self.checkpoint = self.selected_status = None
+        return False
+
+    def check_emails(self, probe=True):
+        """
+        Forward new list mail over the persistent IMAP session. Between
+        cycles a NOOP probe avoids any further work when nothing has arrived;
+        pass probe=False when new mail is already known (e.g. from IDLE).
+        Returns the number of new emails processed.
+        """
+        with self.profiler.cycle():
+            return self._check_emails(probe)
 
+    def _check_emails(self, probe):
+        if not self._hold_lease():
+            # Standing by for another replica; don't keep a session to the mailbox
+            self.session.close()
+            django.db.connections.close_all()
+            return 0
+        started = time.perf_counter()
+        result = 'ok'
+        processed = 0
+        try:
+            try:
+                processed = self._check_session(probe)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                # A held connection can go stale between cycles; reconnect and retry once
+                logger.warning(f"IMAP connection lost: {str(e)}. Reconnecting...")
+                self.session.reset()
+                processed = self._check_session(probe)
+            logger.info(f"Email check completed. Next check will process UIDs after {self.checkpoint.last_uid}")
+
+        except LeaseLost as e:
+            result = 'lease_lost'
+            logger.warning(f"Stopped checking {self.shard}: {str(e)}")
+            self.session.close()
+            self.checkpoint = self.selected_status = None
+        except (imaplib.IMAP4.abort, OSError) as e:
+            result = 'error'
+            self.stats['errors'] += 1
+            logger.error(f"IMAP connection lost: {str(e)}")
+            self.session.reset()
         except Exception as e:
+            result = 'error'
+            self.stats['errors'] += 1
             logger.error(f"Error checking emails: {str(e)}")
             logger.error("Error details:", exc_info=True)
+        self.check_failed = result == 'error'
+        self.stats['checks'] += 1
+        self.stats['processed'] += processed
+        metrics.CHECK_SECONDS.observe(time.perf_counter() - started, result)
+        metrics.LAST_CHECK.set(time.time())
+
+        # Queued deliveries (including retries) go out even when the inbox could not be checked
+        try:
+            if settings.DELIVERY_QUEUE:
+                self.drain_deliveries()
+        except Exception as e:
+            logger.error(f"Error delivering queued emails: {str(e)}")
+            logger.error("Error details:", exc_info=True)
         finally:
             django.db.connections.close_all()
+        return processed
+
+    def _check_session(self, probe):
+        if self.checkpoint is None:
+            # The lease has just been (re)acquired: SELECT again to reload the checkpoint
+            self.session.reset()
+        imap = self.session.get()
+        # After a failed check, fetch past the checkpoint whether or not the server announced anything
+        if probe and self.selected_status is None and not self.check_failed and not self.session.probe():
+            logger.info(f"No new emails after UID {self.checkpoint.last_uid}")
+            return 0
+        return self._process_inbox(imap)
+
+    def _process_inbox(self, imap):
+        last_uid = self.checkpoint.last_uid
+        status, self.selected_status = self.selected_status, None
+
+        # Right after SELECT, UIDNEXT/HIGHESTMODSEQ tell us whether anything arrived without asking
+        if status and (
+            (status['uidnext'] and status['uidnext'] - 1 <= last_uid)
+            or (status['highest_modseq'] and status['highest_modseq'] == self.checkpoint.highest_modseq)
+        ):
+            logger.info(f"No new emails after UID {last_uid}")
+            return 0
+
+        logger.info(f"Checking for new emails after UID {last_uid}...")
+
+        # Phase 1: routing headers and sizes of every new message in a single command
+        started = time.monotonic()
+        with metrics.IMAP_FETCH_SECONDS.time('headers'):
+            _, data = imap.uid('FETCH', f'{last_uid + 1}:*', self._header_fetch_items())
+        header_fetch = (started, time.monotonic())
+        # "n:*" always matches the highest UID, even when it is below n
+        candidates = [m for m in parse_fetch(data) if m.get('UID', 0) > last_uid and 'HEADER' in m]
+        del data
+        max_uid = max((m['UID'] for m in candidates), default=last_uid)
+
+        header_parser = BytesHeaderParser()
+        suppressed_before = self.dedup.stats['suppressed'] if self.dedup is not None else 0
+        claimed = set()
+        routes = self._route_candidates(candidates, claimed, header_fetch)
+        processed = len(candidates)
+        del candidates
+
+        # Phase 2: download only list mail, in pipelined UID batches, forwarding each message as it arrives
+        batches = plan_batches(
+            [(uid, size) for uid, (_, size, _) in sorted(routes.items())],
+            settings.IMAP_FETCH_BATCH_SIZE,
+            settings.IMAP_FETCH_BATCH_BYTES,
+        )
+        outstanding = sorted(routes)
+        if self.pipeline is not None and routes:
+            return self._process_pipelined(imap, batches, routes, claimed, outstanding, max_uid, status,
+                                           processed, suppressed_before)
+        fetched_messages = fetch_messages(
+            imap, batches, '(RFC822)', settings.IMAP_FETCH_PIPELINE_DEPTH,
+            spool_threshold=settings.IMAP_SPOOL_THRESHOLD,
+            sizes={uid: size for uid, (_, size, _) in routes.items()},
+            max_in_flight=settings.IMAP_FETCH_MAX_IN_FLIGHT,
+        )
+        started = time.monotonic()
+        for fetched in fetched_messages:
+            uid = fetched.get('UID')
+            if uid not in routes or 'RFC822' not in fetched:
+                continue
+            mailing_lists, size, key = routes.pop(uid)
+            logger.info(f"Fetched UID {uid} ({size} bytes)")
+            metrics.IMAP_FETCH_SECONDS.observe(time.monotonic() - started, 'body')
+            metrics.IMAP_FETCHED_BYTES.inc(amount=size)
+            trace = self._fetched_trace(uid, started)
+            # Bytes, or a spooled file for messages over IMAP_SPOOL_THRESHOLD
+            raw = fetched.pop('RFC822')
+            try:
+                if self.dedup is not None and key is None:
+                    key = self._content_key(raw, header_parser)
+                    mailing_lists = self.dedup.filter_new(key, mailing_lists, claimed)
+                if mailing_lists:
+                    if settings.DELIVERY_QUEUE:
+                        self._enqueue_email(raw, uid, mailing_lists, trace)
+                        forwarded = mailing_lists
+                    else:
+                        forwarded = self._route_email(raw, mailing_lists, trace)
+                    if self.dedup is not None and forwarded:
+                        self.dedup.record(key, forwarded)
+            except Exception as e:
+                logger.error(f"Error processing email UID {uid}: {str(e)}")
+                logger.error("Error details:", exc_info=True)
+            finally:
+                # Free memory (or the spool file) after processing each email
+                if not isinstance(raw, bytes):
+                    raw.close()
+                del raw
+
+            self._mark_done(uid, outstanding)
+            started = time.monotonic()
+
+        self._finish_inbox(routes, max_uid, status, suppressed_before)
+        return processed
+
+    def _header_fetch_items(self):
+        """The phase 1 FETCH items: sizes and routing headers, and arrival times when tracing."""
+        internaldate = ' INTERNALDATE' if self.tracer is not None else ''
+        return f'(UID RFC822.SIZE{internaldate} BODY.PEEK[HEADER.FIELDS ({" ".join(ROUTING_HEADERS)})])'
+
+    def _fetched_trace(self, uid, started):
+        """Take the trace of *uid*, whose body fetch was waited for since *started*; None when not tracing."""
+        trace = self.tracer.pop(uid) if self.tracer is not None else None
+        if trace is not None:
+            trace.queued(started)
+            trace.add('fetch', started)
+        return trace
+
+    def _mark_done(self, uid, outstanding):
+        # Everything below the oldest list message still in flight is done
+        outstanding.remove(uid)
+        if outstanding and outstanding[0] - 1 > self.checkpoint.last_uid:
+            self._advance_checkpoint(outstanding[0] - 1)
+
+    def _finish_inbox(self, routes, max_uid, status, suppressed_before):
+        for uid in routes:
+            # Expunged between the two phases
+            logger.info(f"UID {uid} disappeared before it could be fetched")
+        if max_uid > self.checkpoint.last_uid:
+            self._advance_checkpoint(max_uid)
+
+        if status and status['highest_modseq']:
+            MailboxCheckpoint.objects.filter(pk=self.checkpoint.pk).update(highest_modseq=status['highest_modseq'])
+            self.checkpoint.highest_modseq = status['highest_modseq']
+
+        if self.dedup is not None:
+            suppressed = self.dedup.stats['suppressed'] - suppressed_before
+            if suppressed:
+                logger.info(f"Suppressed {suppressed} duplicate forwards ({self.dedup.stats['suppressed']} since start)")
+            self.dedup.prune()
+
+        if self.tracer is not None:
+            # Traces of messages that were expunged or turned out to be duplicates
+            self.tracer.clear()
+            self.tracer.prune()
+
+    def _process_pipelined(self, imap, batches, routes, claimed, outstanding, max_uid, status,
+                           processed, suppressed_before):
+        """
+        Phase 2 on the pipeline: this thread only fetches, and the parse,
+        route and send stages work through earlier messages meanwhile, so a
+        large fan-out does not hold up the messages behind it.
+        """
+        fetched_messages = fetch_messages(
+            imap, batches, '(RFC822)', settings.IMAP_FETCH_PIPELINE_DEPTH,
+            spool_threshold=settings.IMAP_SPOOL_THRESHOLD,
+            sizes={uid: size for uid, (_, size, _) in routes.items()},
+            max_in_flight=settings.IMAP_FETCH_MAX_IN_FLIGHT,
+        )
+        self.pipeline.start()
+        try:
+            started = time.monotonic()
+            for fetched in fetched_messages:
+                uid = fetched.get('UID')
+                if uid not in routes or 'RFC822' not in fetched:
+                    continue
+                mailing_lists, size, key = routes.pop(uid)
+                logger.info(f"Fetched UID {uid} ({size} bytes)")
+                metrics.IMAP_FETCH_SECONDS.observe(time.monotonic() - started, 'body')
+                metrics.IMAP_FETCHED_BYTES.inc(amount=size)
+                self.fetch_stats['items'] += 1
+                self.fetch_stats['service_seconds'] += time.monotonic() - started
+                trace = self._fetched_trace(uid, started)
+                job = PipelineJob(uid, fetched.pop('RFC822'), mailing_lists, key, claimed, trace)
+                self.fetch_stats['blocked_seconds'] += self.pipeline.put(job)
+                self._mark_completed(outstanding)
+                started = time.monotonic()
+        finally:
+            # Let messages already handed over finish, even if the connection was lost
+            self.pipeline.join()
+            self.pipeline.stop()
+            self._mark_completed(outstanding)
+            logger.info("Pipeline: " + "; ".join(
+                f"{stage['stage']} {stage['items']} items, {stage['mean_service_ms']} ms each, "
+                f"max queue {stage['max_queue_depth']}, {stage['blocked_seconds']}s blocked"
+                for stage in self.pipeline_snapshot()
+            ))
+
+        self._finish_inbox(routes, max_uid, status, suppressed_before)
+        return processed
+
+    def _mark_completed(self, outstanding):
+        """Advance the checkpoint past the messages the pipeline has finished."""
+        while True:
+            try:
+                uid = self._completed.get_nowait()
+            except queue.Empty:
+                return
+            self._mark_done(uid, outstanding)
+
+    def pipeline_snapshot(self):
+        """Per-stage counters, starting with the fetching thread, or [] without the pipeline."""
+        if self.pipeline is None:
+            return []
+        items = self.fetch_stats['items']
+        fetch = {
+            'stage': 'fetch',
+            'workers': 1,
+            'busy': 0,
+            'queue_depth': 0,
+            'max_queue_depth': 0,
+            'items': items,
+            'errors': 0,
+            'mean_service_ms': round(self.fetch_stats['service_seconds'] / items * 1000, 1) if items else 0.0,
+            'blocked_seconds': round(self.fetch_stats['blocked_seconds'], 2),
+        }
+        return [fetch] + self.pipeline.snapshot()
+
+    def _stage_parse(self, job):
+        """Pipeline stage: content-hash dedup for mail without a Message-ID, then parse once for all lists."""
+        try:
+            if job.trace is not None:
+                job.trace.queued()
+            if self.dedup is not None and job.key is None:
+                job.key = self._content_key(job.raw, BytesHeaderParser())
+                with self._claim_lock:
+                    job.mailing_lists = self.dedup.filter_new(job.key, job.mailing_lists, job.claimed)
+            if not job.mailing_lists:
+                self._job_done(job)
+                return None
+            if not settings.DELIVERY_QUEUE:
+                with span(job.trace, 'parse'):
+                    self._parse_raw(job.raw, job.parsed)
+            return [job]
+        except Exception as e:
+            self._job_failed(job, e)
+
+    def _stage_route(self, job):
+        """Pipeline stage: queue the deliveries, or split the message into one send per list."""
+        try:
+            if job.trace is not None:
+                job.trace.queued()
+            if settings.DELIVERY_QUEUE:
+                self._enqueue_email(job.raw, job.uid, job.mailing_lists, job.trace)
+                self._job_done(job, job.mailing_lists)
+                return None
+            assigned = [
+                (mailing_list, list(recipients))
+                for mailing_list, recipients in self._assign_recipients(job.mailing_lists)
+            ]
+            if not assigned:
+                self._job_done(job)
+                return None
+            job.pending = len(assigned)
+            return [(job, mailing_list, recipients) for mailing_list, recipients in assigned]
+        except Exception as e:
+            self._job_failed(job, e)
+
+    def _stage_send(self, item):
+        """Pipeline stage: forward a message to one list's recipients."""
+        job, mailing_list, recipients = item
+        try:
+            record = None
+            if job.trace is not None:
+                job.trace.queued(alias=mailing_list.alias)
+                record = job.trace.recorder(mailing_list.alias)
+            delivered, refused = self._forward(job.raw, job.parsed, mailing_list, recipients, record)
+            if delivered or refused:
+                logger.info(f"Email forwarded to {delivered} subscribers ({refused} refused)")
+            else:
+                logger.warning(f"No active subscribers found for {mailing_list.alias}")
+            if delivered:
+                with job.lock:
+                    job.forwarded.append(mailing_list)
+            if job.trace is not None:
+                job.trace.save(mailing_list.alias)
+        except Exception as e:
+            logger.error(f"Error processing email UID {job.uid}: {str(e)}")
+            logger.error("Error details:", exc_info=True)
+        finally:
+            with job.lock:
+                job.pending -= 1
+                last = not job.pending
+            if last:
+                self._job_done(job, job.forwarded)
+
+    def _job_failed(self, job, error):
+        logger.error(f"Error processing email UID {job.uid}: {str(error)}")
+        logger.error("Error details:", exc_info=True)
+        self._job_done(job)
+
+    def _job_done(self, job, forwarded=()):
+        """
+        Record a finished message for dedup on the *forwarded* lists, free it
+        and hand its UID back to the fetching thread.
+        """
+        try:
+            if forwarded and self.dedup is not None:
+                self.dedup.record(job.key, forwarded)
+        except Exception as e:
+            logger.error(f"Error recording email UID {job.uid}: {str(e)}")
+            logger.error("Error details:", exc_info=True)
+        finally:
+            if not isinstance(job.raw, bytes):
+                job.raw.close()
+            job.raw = job.parsed = job.trace = None
+            self._completed.put(job.uid)
+
+    def _route_candidates(self, candidates, claimed, header_fetch=None):
+        """
+        {uid: (mailing_lists, size, dedup key)} for the phase 1 FETCH results
+        that are addressed to lists which have not had them yet. When tracing,
+        a trace is started for each of them; *header_fetch* is the (start, end)
+        of the FETCH on the monotonic clock.
+        """
+        if candidates and self.routes is not None:
+            self.routes.refresh()
+
+        header_parser = BytesHeaderParser()
+        routes = {}
+        for candidate in candidates:
+            uid = candidate['UID']
+            routed = time.monotonic()
+            try:
+                headers = header_parser.parsebytes(candidate['HEADER'])
+                mailing_lists = self._find_mailing_lists(headers)
+                if not mailing_lists:
+                    metrics.MESSAGES.inc('skipped')
+                    continue
+                key = None
+                if self.dedup is not None:
+                    # Skip the download entirely when every list already got this Message-ID
+                    key = message_id_key(headers.get('Message-ID'))
+                    if key:
+                        mailing_lists = self.dedup.filter_new(key, mailing_lists, claimed)
+                if mailing_lists:
+                    routes[uid] = (mailing_lists, candidate.get('RFC822.SIZE', 0), key)
+                    metrics.MESSAGES.inc('routed')
+                    self._observe_lag(headers.get('Date'))
+                    if self.tracer is not None and header_fetch is not None:
+                        self.tracer.start(
+                            uid, f"{self.source_prefix}{self.checkpoint.uidvalidity}/{uid}", headers,
+                            candidate.get('INTERNALDATE'), header_fetch, routed,
+                        )
+                else:
+                    metrics.MESSAGES.inc('duplicate')
+            except Exception as e:
+                logger.error(f"Error routing email UID {uid}: {str(e)}")
+                logger.error("Error details:", exc_info=True)
+        return routes
+
+    def _observe_lag(self, date):
+        """Record how long ago a message with this Date header was sent."""
+        try:
+            sent_at = parsedate_to_datetime(date)
+        except (TypeError, ValueError):
+            return
+        if sent_at.tzinfo is not None:
+            metrics.PICKUP_LAG_SECONDS.observe(max(0.0, (timezone.now() - sent_at).total_seconds()))
+
+    def _content_key(self, raw, header_parser):
+        """Dedup key for a message without a Message-ID, from its bytes or spooled file."""
+        if isinstance(raw, bytes):
+            head, _, body = raw.partition(b'\r\n\r\n')
+            return content_key(header_parser.parsebytes(head), body)
+        head = read_head(raw)
+        key = content_key(header_parser.parsebytes(head), iter(lambda: raw.read(1024 * 1024), b''))
+        raw.seek(0)
+        return key
+
+    def _find_mailing_lists(self, headers):
+        """Return the mailing lists a message with these headers is addressed to."""
+        # Get all possible recipient addresses
+        recipient_addresses = self.extract_email_addresses(headers)
+        logger.info(f"Found recipient addresses: {recipient_addresses}")
+
+        mailing_lists = []
+        # Check each address for @cyphy.life
+        for address in recipient_addresses:
+            if '@cyphy.life' in address:
+                if not self.shard.handles(address):
+                    logger.info(f"{address} is forwarded by another shard")
+                    continue
+                # Find corresponding mailing list
+                with metrics.ROUTE_LOOKUP_SECONDS.time():
+                    if self.routes is not None:
+                        mailing_list = self.routes.lookup(address)
+                    else:
+                        mailing_list = MailingList.objects.filter(alias=address).first()
+
+                if mailing_list:
+                    logger.info(f"Found mailing list for: {address}")
+                    mailing_lists.append(mailing_list)
+                else:
+                    logger.info(f"No mailing list found for: {address}")
+        return mailing_lists
+
+    def _route_email(self, raw, mailing_lists, trace=None):
+        """
+        Forward the raw message bytes to the active subscribers of each of
+        *mailing_lists*. Returns the lists at least one subscriber got it from.
+        """
+        forwarded = []
+        parsed = {}
+        with span(trace, 'parse'):
+            self._parse_raw(raw, parsed)
+        for mailing_list, recipients in self._assign_recipients(mailing_lists):
+            record = trace.recorder(mailing_list.alias) if trace is not None else None
+            delivered, refused = self._forward(raw, parsed, mailing_list, recipients, record)
+            if delivered or refused:
+                logger.info(f"Email forwarded to {delivered} subscribers ({refused} refused)")
+            else:
+                logger.warning(f"No active subscribers found for {mailing_list.alias}")
+            if delivered:
+                forwarded.append(mailing_list)
+            if trace is not None:
+                trace.save(mailing_list.alias)
+        return forwarded
+
+    def _assign_recipients(self, mailing_lists):
+        """
+        Pair each list with the subscribers it should deliver to. When a
+        message reaches several lists, every address gets exactly one copy,
+        from the list that wins under CROSS_LIST_PRECEDENCE; lists left with
+        nobody are dropped.
+        """
+        if self.lease is not None:
+            self.lease.check()
+        if len(mailing_lists) == 1 or not settings.CROSS_LIST_DEDUP:
+            return [
+                (mailing_list, mailing_list.iter_active_subscriber_emails(settings.SUBSCRIBER_CHUNK_SIZE))
+                for mailing_list in mailing_lists
+            ]
+
+        candidates = [
+            (mailing_list, list(mailing_list.iter_active_subscriber_emails(settings.SUBSCRIBER_CHUNK_SIZE)))
+            for mailing_list in mailing_lists
+        ]
+        precedence = settings.CROSS_LIST_PRECEDENCE
+        if precedence == 'smallest':
+            # The most specific list (fewest subscribers) wins; sort() is stable, so ties keep header order
+            candidates.sort(key=lambda candidate: len(candidate[1]))
+        elif precedence != 'header':
+            rank = {alias: i for i, alias in enumerate(precedence)}
+            candidates.sort(key=lambda candidate: rank.get(candidate[0].alias, len(rank)))
+
+        assigned = []
+        seen = set()
+        avoided = 0
+        for mailing_list, recipients in candidates:
+            unique = []
+            for recipient in recipients:
+                address = recipient.lower()
+                if address in seen:
+                    avoided += 1
+                    continue
+                seen.add(address)
+                unique.append(recipient)
+            if unique:
+                assigned.append((mailing_list, unique))
+            else:
+                logger.info(f"All subscribers of {mailing_list.alias} already get this message through another list")
+        if avoided:
+            logger.info(f"Avoided {avoided} redundant sends to subscribers of several lists")
+        return assigned
+
+    def _forward(self, raw, parsed, mailing_list, recipients, record=None):
+        """
+        Forward *raw* to *recipients* in the configured mode. *parsed* caches
+        the parsed forms of *raw* across the lists it is forwarded to.
+        """
+        if self._parse_raw(raw, parsed) == 'passthrough':
+            return self.forward_passthrough(parsed['passthrough'], recipients, mailing_list, record)
+        if settings.FORWARD_BULK_ENVELOPE:
+            return self.forward_email_bulk(parsed['email'], recipients, mailing_list, record, parsed['body'])
+        return self.forward_email_to(parsed['email'], recipients, mailing_list, record, parsed['body'])
+
+    def _parse_raw(self, raw, parsed):
+        """
+        Fill the *parsed* cache for *raw* in the configured forwarding mode
+        and return the mode: 'passthrough' or 'rebuild'.
+        """
+        # Spooled messages are always passed through: rebuilding would decode them in memory
+        if settings.FORWARD_PASSTHROUGH or not isinstance(raw, bytes):
+            if 'passthrough' not in parsed:
+                with metrics.PARSE_SECONDS.time('passthrough'):
+                    parsed['passthrough'] = PassthroughMessage(raw)
+            return 'passthrough'
+        if 'email' not in parsed:
+            with metrics.PARSE_SECONDS.time('rebuild'):
+                parsed['email'] = message_from_bytes(raw)
+                parsed['body'] = self._parse_body(parsed['email'])
+        return 'rebuild'
+
+    def _enqueue_email(self, raw, uid, mailing_lists, trace=None):
+        """
+        Record one delivery per subscriber of each list; they are sent by
+        drain_deliveries(). A spooled *raw* is queued without reading it
+        into memory.
+        """
+        source = f"{self.source_prefix}{self.checkpoint.uidvalidity}/{uid}"
+        if not isinstance(raw, bytes):
+            raw.seek(0)
+        head = raw if isinstance(raw, bytes) else read_head(raw)
+        message_id = BytesHeaderParser().parsebytes(head).get('Message-ID', '')
+        for mailing_list, recipients in self._assign_recipients(mailing_lists):
+            with span(trace, 'enqueue', mailing_list.alias):
+                queued = enqueue(raw, source, mailing_list, message_id, recipients, *self.mailbox)
+            logger.info(f"Queued {queued} deliveries for {mailing_list.alias}")
+            if trace is not None:
+                # Finished by _drain() once the deliveries have been sent
+                trace.save(mailing_list.alias, complete=False)
+
+    def drain_deliveries(self):
+        """
+        Send queued deliveries that are due, oldest message first, recording
+        each outcome. Returns the number of deliveries sent.
+        """
+        sent = 0
+        while True:
+            due = due_deliveries(settings.DELIVERY_DRAIN_LIMIT, self.mailbox)
+            if not due:
+                break
+            sent += self._drain(due)
+
+        pruned = prune(timedelta(days=settings.DELIVERY_RETENTION_DAYS))
+        if pruned:
+            logger.info(f"Pruned {pruned} finished queue records")
+        return sent
+
+    def _drain(self, due):
+        sent = 0
+        for message_pk, rows in groupby(due, key=lambda row: row[1]):
+            if self.lease is not None:
+                self.lease.check()
+            pending = {recipient: (pk, attempts) for pk, _, recipient, attempts in rows}
+            outbound = OutboundMessage.objects.select_related('mailing_list').get(pk=message_pk)
+            logger.info(f"Delivering {outbound} to {len(pending)} queued recipients")
+            recorder = DeliveryRecorder(pending, settings.DELIVERY_STATUS_BATCH)
+            recorder.claim()
+            record = recorder.record
+            trace = None
+            if self.tracer is not None:
+                trace = Trace.resume(outbound.source, outbound.mailing_list.alias)
+            if trace is not None:
+                trace.queued(alias=outbound.mailing_list.alias)
+                record = trace.recorder(outbound.mailing_list.alias, recorder.record)
+            raw = None
+            try:
+                raw = open_raw(outbound)
+                self._forward(raw, {}, outbound.mailing_list, list(pending), record)
+            finally:
+                if raw is not None and not isinstance(raw, bytes):
+                    raw.close()
+                missing = recorder.unrecorded()
+                if missing:
+                    recorder.record(missing, RuntimeError('Forwarding stopped before this recipient was attempted'))
+                recorder.flush()
+            if trace is not None:
+                retrying = Delivery.objects.filter(message_id=message_pk, status=Delivery.PENDING).exists()
+                trace.save(outbound.mailing_list.alias, complete=not retrying)
+            logger.info(
+                f"Queued deliveries for {outbound}: {recorder.counts['sent']} sent, "
+                f"{recorder.counts['retry']} to retry, {recorder.counts['failed']} failed"
+            )
+            sent += recorder.counts['sent']
+        return sent
 
     def extract_email_address(self, address_string):
         """Extract email address from various formats like 'Name <email>' or '"email" <email>'"""
@@ -184,101 +943,345 @@ class EmailDaemon:
 
         return text_parts, html_parts, attachments
 
-    def forward_email(self, original_email, subscribers, mailing_list):
-        try:
-            logger.info("Starting email forwarding process")
+    def _prepare_forward(self, original_email, mailing_list, body=None):
+        """
+        Decode the body and compute the shared header values once per incoming
+        message. Pass the *body* from an earlier _parse_body() call to reuse
+        it for another list.
+        """
+        content = dict(body or self._parse_body(original_email))
+        list_name = mailing_list.alias.split('@')[0]
+        content['subject'] = f"[{list_name.upper()}] {original_email['Subject'] or ''}"
+        return content
+
+    def _parse_body(self, original_email):
+        """The list-independent parts of a forward: decoded body, attachments and threading headers."""
+        # Parse body ONCE, reuse for all subscribers
+        text_parts, html_parts, attachments = self._extract_parts(original_email)
+
+        # Fallback payload if no text or html found
+        fallback_text = None
+        if not text_parts and not html_parts:
+            try:
+                payload = original_email.get_payload(decode=True)
+                if payload:
+                    fallback_text = payload.decode()
+            except Exception as e:
+                logger.error(f"Error handling fallback payload: {str(e)}")
+                logger.error("Error details:", exc_info=True)
 
-            # Parse body ONCE, reuse for all subscribers
-            text_parts, html_parts, attachments = self._extract_parts(original_email)
+        references = []
+        if 'References' in original_email:
+            references.extend(original_email['References'].split())
+        if 'Message-ID' in original_email:
+            references.append(original_email['Message-ID'])
 
+        return {
             # Build combined text/html content once
-            combined_text = '\n\n'.join(text_parts) if text_parts else None
-            combined_html = '<br><br>'.join(html_parts) if html_parts else None
+            'text': '\n\n'.join(text_parts) if text_parts else None,
+            'html': '<br><br>'.join(html_parts) if html_parts else None,
+            'fallback_text': fallback_text,
+            'attachments': attachments,
+            'references': ' '.join(references) if references else None,
+            'in_reply_to': original_email['In-Reply-To'],
+            'date': original_email['Date'],
+        }
 
-            # Fallback payload if no text or html found
-            fallback_text = None
-            if not text_parts and not html_parts:
-                try:
-                    payload = original_email.get_payload(decode=True)
-                    if payload:
-                        fallback_text = payload.decode()
-                except Exception as e:
-                    logger.error(f"Error handling fallback payload: {str(e)}")
-                    logger.error("Error details:", exc_info=True)
+    def _build_forward(self, content, mailing_list, to_addr):
+        """Build the outgoing MIME message from _prepare_forward() output."""
+        msg = MIMEMultipart('mixed')
+        msg['From'] = mailing_list.alias
+        msg['To'] = to_addr
+        msg['Subject'] = content['subject']
+        msg['Reply-To'] = mailing_list.alias
 
-            # Pre-compute shared header values
-            original_subject = original_email['Subject'] or ''
-            list_name = mailing_list.alias.split('@')[0]
-            new_subject = f"[{list_name.upper()}] {original_subject}"
+        # Build the body
+        body = MIMEMultipart('alternative')
 
-            references = []
-            if 'References' in original_email:
-                references.extend(original_email['References'].split())
-            if 'Message-ID' in original_email:
-                references.append(original_email['Message-ID'])
+        if content['text']:
+            body.attach(MIMEText(content['text'], 'plain', 'utf-8'))
+        if content['html']:
+            body.attach(MIMEText(content['html'], 'html', 'utf-8'))
+        if content['fallback_text']:
+            body.attach(MIMEText(content['fallback_text'], 'plain', 'utf-8'))
 
-            with smtplib.SMTP(self.smtp_server, settings.SMTP_PORT) as server:
-                server.ehlo()
-                server.starttls()
-                server.ehlo()
-                server.docmd('AUTH', 'XOAUTH2 ' + self._xoauth2_b64())
+        msg.attach(body)
 
-                for subscriber in subscribers:
-                    logger.info(f"Forwarding to: {subscriber.email}")
-                    msg = MIMEMultipart('mixed')
-                    msg['From'] = mailing_list.alias
-                    msg['To'] = subscriber.email
-                    msg['Subject'] = new_subject
-                    msg['Reply-To'] = mailing_list.alias
+        # Attach files
+        for attachment in content['attachments']:
+            msg.attach(attachment)
 
-                    # Build the body
-                    body = MIMEMultipart('alternative')
+        # Handle References and In-Reply-To headers
+        if content['references']:
+            msg['References'] = content['references']
 
-                    if combined_text:
-                        body.attach(MIMEText(combined_text, 'plain', 'utf-8'))
-                    if combined_html:
-                        body.attach(MIMEText(combined_html, 'html', 'utf-8'))
-                    if fallback_text:
-                        body.attach(MIMEText(fallback_text, 'plain', 'utf-8'))
+        if content['in_reply_to']:
+            msg['In-Reply-To'] = content['in_reply_to']
 
-                    msg.attach(body)
+        # Preserve original send date (do not copy Content-Type/Content-Transfer-Encoding
+        # — those are managed by the MIME classes and must not be overwritten)
+        if content['date']:
+            msg['Date'] = content['date']
+        return msg
 
-                    # Attach files
-                    for attachment in attachments:
-                        msg.attach(attachment)
+    def forward_email(self, original_email, subscribers, mailing_list):
+        return self.forward_email_to(original_email, (subscriber.email for subscriber in subscribers), mailing_list)
 
-                    # Handle References and In-Reply-To headers
-                    if references:
-                        msg['References'] = ' '.join(references)
+    def forward_email_to(self, original_email, recipients, mailing_list, record=None, body=None):
+        """Forward a personalised rebuild of *original_email* to each address in *recipients*."""
+        delivered = refused = 0
+        try:
+            logger.info("Starting email forwarding process")
+            content = self._prepare_forward(original_email, mailing_list, body)
+            envelopes = self._personalised_envelopes(content, mailing_list, recipients)
+            delivered, refused = self._deliver(mailing_list, envelopes, record=record)
 
-                    if 'In-Reply-To' in original_email:
-                        msg['In-Reply-To'] = original_email['In-Reply-To']
+        except Exception as e:
+            logger.error(f"Error forwarding email: {str(e)}")
+            logger.error("Error details:", exc_info=True)
+        return delivered, refused
+
+    def forward_email_bulk(self, original_email, recipients, mailing_list, record=None, body=None):
+        """
+        Serialize one copy addressed to the list alias and deliver it to
+        *recipients* (an iterable of addresses) in transactions of up to
+        SMTP_MAX_RECIPIENTS RCPT TOs each. Refused recipients are logged one
+        by one without failing the rest of their batch.
+        Returns (delivered, refused) counts.
+        """
+        delivered = refused = 0
+        try:
+            logger.info("Starting bulk email forwarding process")
+            content = self._prepare_forward(original_email, mailing_list, body)
+            msg = self._build_forward(content, mailing_list, mailing_list.alias)
+            data = msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+            del msg, content
+
+            delivered, refused = self._deliver(mailing_list, self._bulk_envelopes(data, recipients), record=record)
+
+        except Exception as e:
+            logger.error(f"Error forwarding email: {str(e)}")
+            logger.error("Error details:", exc_info=True)
+        return delivered, refused
+
+    def _personalised_envelopes(self, content, mailing_list, recipients):
+        """Yield ([recipient], data) with a copy built and serialized for each recipient in turn."""
+        for recipient in recipients:
+            logger.info(f"Forwarding to: {recipient}")
+            msg = self._build_forward(content, mailing_list, recipient)
+            yield [recipient], msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+            del msg
 
-                    # Preserve original send date (do not copy Content-Type/Content-Transfer-Encoding
-                    # — those are managed by the MIME classes and must not be overwritten)
-                    if 'Date' in original_email:
-                        msg['Date'] = original_email['Date']
+    def _bulk_envelopes(self, data, recipients):
+        """Pair the same serialized *data* with consecutive batches of up to SMTP_MAX_RECIPIENTS."""
+        recipients = iter(recipients)
+        while True:
+            batch = list(islice(recipients, settings.SMTP_MAX_RECIPIENTS))
+            if not batch:
+                return
+            yield batch, data
+
+    def _deliver(self, mailing_list, envelopes, mail_options=(), record=None):
+        """
+        Send (recipients, data) *envelopes* from the list alias, on the sender
+        workers when SMTP_SENDER_WORKERS is set and sequentially on one pooled
+        session otherwise. *record*, if given, is called with each envelope's
+        recipients and its refused dict or exception.
+        Returns (delivered, refused) counts.
+        """
+        if self.sender_pool is not None:
+            pending = [
+                (recipients, self.sender_pool.submit(mailing_list.alias, recipients, data, mail_options))
+                for recipients, data in envelopes
+            ]
+            results = ((recipients, future.exception() or future.result()) for recipients, future in pending)
+        else:
+            results = self._send_sequentially(mailing_list, envelopes, mail_options)
+
+        delivered = refused = 0
+        for recipients, result in results:
+            ok, failed = self._count_result(recipients, result, record)
+            delivered += ok
+            refused += failed
+
+        if self.sender_pool is not None:
+            stats = self.sender_pool.snapshot()
+            logger.info(
+                f"Sender pool: {stats['queue_depth']} envelopes queued, "
+                f"{stats['recipients_per_sec']} recipients/s, {stats['throttled_seconds']:.1f}s throttled"
+            )
+        return delivered, refused
 
-                    try:
-                        server.send_message(msg)
-                        logger.info(f"Successfully forwarded to {subscriber.email}")
-                    except Exception as e:
-                        logger.error(f"Error sending email to {subscriber.email}: {str(e)}")
-                        logger.error("Error details:", exc_info=True)
+    def _count_result(self, recipients, result, record=None):
+        """Log and record the outcome of one envelope; returns its (delivered, refused) counts."""
+        if record is not None:
+            record(recipients, result)
+        if isinstance(result, Exception):
+            metrics.RECIPIENTS.inc('failed', amount=len(recipients))
+            logger.error(f"Error sending email to {', '.join(recipients)}: {str(result)}")
+            logger.error("Error details:", exc_info=result)
+            return 0, len(recipients)
+        metrics.RECIPIENTS.inc('delivered', amount=len(recipients) - len(result))
+        if result:
+            metrics.RECIPIENTS.inc('refused', amount=len(result))
+        for recipient, (code, response) in result.items():
+            logger.error(f"Recipient {recipient} refused: {code} {response!r}")
+        if len(recipients) == 1 and not result:
+            logger.info(f"Successfully forwarded to {recipients[0]}")
+        elif len(recipients) > 1:
+            logger.info(f"Forwarded to {len(recipients) - len(result)} of {len(recipients)} recipients in one transaction")
+        return len(recipients) - len(result), len(result)
 
-                    del msg
+    def _send_sequentially(self, mailing_list, envelopes, mail_options):
+        """Yield (recipients, refused dict or exception) for each envelope, sent on one pooled session."""
+        with self.smtp_pool.session() as smtp_session:
+            for recipients, data in envelopes:
+                try:
+                    result = smtp_session.send_envelope(mailing_list.alias, recipients, data, mail_options)
+                except Exception as e:
+                    result = e
+                yield recipients, result
+
+    def forward_passthrough(self, message, recipients, mailing_list, record=None):
+        """
+        Forward a PassthroughMessage without decoding or re-encoding its body:
+        only the top-level headers are rewritten for the list. Honours
+        FORWARD_BULK_ENVELOPE. Returns (delivered, refused) counts.
+        """
+        delivered = refused = 0
+        mail_options = ('BODY=8BITMIME',) if message.eight_bit else ()
+        try:
+            logger.info("Starting passthrough email forwarding process")
+            envelopes = self._passthrough_envelopes(message, mailing_list, recipients)
+            delivered, refused = self._deliver(mailing_list, envelopes, mail_options, record)
 
         except Exception as e:
             logger.error(f"Error forwarding email: {str(e)}")
             logger.error("Error details:", exc_info=True)
+        return delivered, refused
+
+    def _passthrough_envelopes(self, message, mailing_list, recipients):
+        """(recipients, data) envelopes of a PassthroughMessage, honouring FORWARD_BULK_ENVELOPE."""
+        if settings.FORWARD_BULK_ENVELOPE:
+            return self._bulk_envelopes(message.render(mailing_list.alias, mailing_list.alias), recipients)
+        return (([recipient], message.render(mailing_list.alias, recipient)) for recipient in recipients)
 
-    def run(self):
+    def _envelopes(self, raw, parsed, mailing_list, recipients):
+        """
+        The (recipients, data) envelopes and MAIL FROM options that _forward()
+        would send, for engines that deliver them themselves.
+        """
+        if self._parse_raw(raw, parsed) == 'passthrough':
+            message = parsed['passthrough']
+            mail_options = ('BODY=8BITMIME',) if message.eight_bit else ()
+            return self._passthrough_envelopes(message, mailing_list, recipients), mail_options
+
+        content = self._prepare_forward(parsed['email'], mailing_list, parsed['body'])
+        if settings.FORWARD_BULK_ENVELOPE:
+            msg = self._build_forward(content, mailing_list, mailing_list.alias)
+            return self._bulk_envelopes(msg.as_bytes(policy=msg.policy.clone(linesep='\r\n')), recipients), ()
+        return self._personalised_envelopes(content, mailing_list, recipients), ()
+
+    def _next_poll_interval(self, interval, processed):
+        """Poll faster while mail is flowing and back off while the inbox is quiet."""
+        if processed:
+            return max(settings.ADAPTIVE_POLL_MIN, interval / 2)
+        return min(settings.ADAPTIVE_POLL_MAX, interval * 2)
+
+    def _idle_timeout(self):
+        """IDLE_TIMEOUT, shortened so that queued retries are not held up by a quiet inbox."""
+        timeout = settings.IDLE_TIMEOUT
+        if settings.DELIVERY_QUEUE:
+            due = next_due(self.mailbox)
+            django.db.connections.close_all()
+            if due is not None:
+                timeout = min(timeout, max(1, (due - timezone.now()).total_seconds()))
+        return timeout
+
+    def run_idle(self):
+        """
+        Keep the session on INBOX in IMAP IDLE and check as soon as the
+        server announces new mail, falling back to adaptive polling if the
+        server lacks IDLE.
+        """
+        interval = settings.ADAPTIVE_POLL_MIN
+        new_mail = False
+        warned = False
+        while True:
+            processed = self.check_emails(probe=not new_mail)
+            new_mail = False
+            if self._standing_by():
+                continue
+            if self.check_failed:
+                # IDLE would only wake for new mail, leaving what the failed check missed until then
+                logger.info(f"Retrying the failed check in {settings.POLL_INTERVAL} seconds...")
+                time.sleep(settings.POLL_INTERVAL)
+                continue
+
+            imap = self.session.get()
+            if supports_idle(imap):
+                try:
+                    timeout = self._idle_timeout()
+                    logger.debug(f"Entering IDLE for up to {timeout:.0f} seconds")
+                    new_mail = imap_idle(imap, timeout)
+                except (imaplib.IMAP4.abort, OSError) as e:
+                    logger.error(f"IMAP connection lost during IDLE: {str(e)}")
+                    self.session.reset()
+            else:
+                if not warned:
+                    logger.warning("IMAP server does not support IDLE, falling back to adaptive polling")
+                    warned = True
+                interval = self._next_poll_interval(interval, processed)
+                logger.info(f"Waiting {interval:.0f} seconds before next check...")
+                time.sleep(interval)
+
+    def snapshot(self):
+        """This daemon's counters, as reported to the shard supervisor."""
+        return {
+            'shard': self.shard.name,
+            'mailbox': f"{self.email}/{self.folder}",
+            'checks': self.stats['checks'],
+            'processed': self.stats['processed'],
+            'errors': self.stats['errors'],
+            'last_uid': self.checkpoint.last_uid if self.checkpoint is not None else None,
+            'smtp_handshakes': self.smtp_pool.stats['handshakes'],
+            'duplicates_suppressed': self.dedup.stats['suppressed'] if self.dedup is not None else 0,
+        }
+
+    def _standing_by(self):
+        """While another replica holds the lease, wait a heartbeat and return True to check it again."""
+        if self.lease is None or self.lease.held:
+            return False
+        time.sleep(settings.LEASE_HEARTBEAT)
+        return True
+
+    def _serve_metrics(self):
+        if self.metrics_port and metrics.REGISTRY.enabled:
+            metrics.serve(self.metrics_port, settings.METRICS_HOST)
+
+    def run(self, idle=False):
         logger.info("Starting email daemon...")
         socket.setdefaulttimeout(30)
-        while True:
-            try:
-                self.check_emails()
-            except Exception as e:
-                logger.error(f"Unhandled error in check loop: {e}", exc_info=True)
-            logger.info("Waiting 60 seconds before next check...")
-            time.sleep(60)
+        self._serve_metrics()
+        self.profiler.start()
+        self.tokens.start()
+        if self.lease is not None:
+            self.lease.start()
+        try:
+            if idle:
+                self.run_idle()
+                return
+            while True:
+                try:
+                    self.check_emails()
+                except Exception as e:
+                    logger.error(f"Unhandled error in check loop: {e}", exc_info=True)
+                if self._standing_by():
+                    continue
+                logger.info(f"Waiting {settings.POLL_INTERVAL} seconds before next check...")
+                time.sleep(settings.POLL_INTERVAL)
+        finally:
+            if self.lease is not None:
+                # Let a standby replica take over right away
+                self.lease.stop()
+                self.lease.release()
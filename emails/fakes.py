@@ -0,0 +1,638 @@
+"""
+In-process stand-in mail servers for exercising the daemon locally.
+
+Point IMAP_SERVER/IMAP_PORT at a running FakeIMAPServer (with IMAP_USE_SSL
+disabled) and SMTP_SERVER/SMTP_PORT at a FakeSMTPServer (with SMTP_USE_TLS
+disabled) to drive EmailDaemon without touching Gmail. GMAIL_TOKEN_URI can
+point at a FakeTokenServer in the same way. Both mail servers can inject
+failures at a given rate, drawn from a seeded generator so runs repeat.
+"""
+import json
+import os
+import random
+import re
+import queue
+import socket
+import socketserver
+import ssl
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import format_datetime
+
+_COMMAND_RE = re.compile(r'^(\S+) (\S+)(?: (.*))?$')
+
+# Self-signed certificate and key for 127.0.0.1/localhost, for FakeSMTPServer(tls=True)
+TLS_CERT_FILE = os.path.join(os.path.dirname(__file__), 'fakes_tls.pem')
+
+
+class FakeMessage:
+    def __init__(self, uid, raw, internaldate):
+        self.uid = uid
+        self.raw = raw
+        self.internaldate = internaldate
+
+
+class FakeMailbox:
+    """A single thread-safe mailbox shared by every client session."""
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.highest_modseq = 1
+        self._next_uid = 1
+        self._lock = threading.Lock()
+
+    def append(self, raw, internaldate=None):
+        with self._lock:
+            message = FakeMessage(
+                self._next_uid, raw, internaldate or datetime.now(timezone.utc)
+            )
+            self._next_uid += 1
+            self.highest_modseq += 1
+            self.messages.append(message)
+            return message
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.messages)
+
+
+class _LineHandler(socketserver.StreamRequestHandler):
+    """Shared plumbing for the line-oriented fake protocol servers."""
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.connections.add(self.connection)
+        # Lines are timestamped on arrival so injected latency behaves like
+        # network delay: pipelined commands overlap instead of queueing up.
+        self.lines = queue.Queue()
+        self.tls_replied = threading.Event()
+        self.tls_started = threading.Event()
+        threading.Thread(target=self._read_lines, daemon=True).start()
+
+    def _read_lines(self):
+        try:
+            # self.rfile is looked up per line: STARTTLS replaces it
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                self.lines.put((time.monotonic(), line))
+                if self.server.tls_context is not None and line.upper().startswith(b'STARTTLS'):
+                    # Reads happen on this thread, so the handshake does too, once handle() has said go ahead
+                    if not self.tls_replied.wait(30) or not self._start_tls():
+                        break
+        except OSError:
+            pass
+        self.lines.put((time.monotonic(), b''))
+
+    def _start_tls(self):
+        self.server.connections.discard(self.connection)
+        try:
+            self.connection = self.server.tls_context.wrap_socket(self.connection, server_side=True)
+            self.rfile = self.connection.makefile('rb')
+            self.wfile = self.connection.makefile('wb', buffering=0)
+            return True
+        except (OSError, ssl.SSLError):
+            return False
+        finally:
+            self.server.connections.add(self.connection)
+            self.tls_started.set()
+
+    def finish(self):
+        self.server.connections.discard(self.connection)
+        try:
+            # Wake the reader thread; closing rfile would otherwise wait for the client's next line
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            super().finish()
+        except OSError:
+            pass
+
+    def read_line(self, timeout=None):
+        """Return the next client line, b'' on EOF or None on timeout."""
+        try:
+            return self.lines.get(timeout=timeout)[1]
+        except queue.Empty:
+            return None
+
+    def next_command(self):
+        """Return the next client line once the simulated latency has elapsed."""
+        arrived, line = self.lines.get()
+        delay = arrived + self.server.latency - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return line
+
+    def send_line(self, line):
+        if isinstance(line, str):
+            line = line.encode()
+        self.wfile.write(line + b'\r\n')
+
+
+class _IMAPHandler(_LineHandler):
+    def setup(self):
+        super().setup()
+        self.selected = False
+        self.seen_count = 0
+
+    @property
+    def mailbox(self):
+        return self.server.mailbox
+
+    def handle(self):
+        with self.server.lock:
+            self.server.stats['connections'] += 1
+        self.send_line('* OK FakeIMAP ready')
+        while True:
+            line = self.next_command()
+            if not line:
+                return
+            match = _COMMAND_RE.match(line.decode().rstrip('\r\n'))
+            if not match:
+                self.send_line('* BAD malformed command')
+                continue
+            tag, command, args = match.group(1), match.group(2).upper(), match.group(3) or ''
+            if command != 'LOGOUT' and self.server.inject_failure():
+                # Drop the connection without answering, like a server crash or network fault
+                return
+            handler = getattr(self, f'do_{command}', None)
+            if handler is None:
+                self.send_line(f'{tag} BAD unknown command {command}')
+                continue
+            if handler(tag, args) is False:
+                return
+
+    def do_CAPABILITY(self, tag, args):
+        self.send_line('* CAPABILITY ' + ' '.join(self.server.capabilities))
+        self.send_line(f'{tag} OK CAPABILITY completed')
+
+    def do_AUTHENTICATE(self, tag, args):
+        self.send_line('+ ')
+        self.read_line()
+        self.send_line(f'{tag} OK AUTHENTICATE completed')
+
+    def do_LOGIN(self, tag, args):
+        self.send_line(f'{tag} OK LOGIN completed')
+
+    def do_SELECT(self, tag, args):
+        messages = self.mailbox.snapshot()
+        with self.server.lock:
+            self.server.stats['selects'] += 1
+        self.selected = True
+        self.seen_count = len(messages)
+        next_uid = messages[-1].uid + 1 if messages else 1
+        self.send_line(f'* {len(messages)} EXISTS')
+        self.send_line('* 0 RECENT')
+        self.send_line(f'* OK [UIDVALIDITY {self.mailbox.uidvalidity}] UIDs valid')
+        self.send_line(f'* OK [UIDNEXT {next_uid}] Predicted next UID')
+        if 'CONDSTORE' in self.server.capabilities:
+            self.send_line(f'* OK [HIGHESTMODSEQ {self.mailbox.highest_modseq}] Highest')
+        self.send_line(f'{tag} OK [READ-WRITE] SELECT completed')
+
+    def do_NOOP(self, tag, args):
+        self._report_exists()
+        self.send_line(f'{tag} OK NOOP completed')
+
+    def do_SEARCH(self, tag, args):
+        messages = self.mailbox.snapshot()
+        since = re.search(r'SINCE "?(\d{1,2}-\w{3}-\d{4})"?', args)
+        if since:
+            day = datetime.strptime(since.group(1), '%d-%b-%Y').date()
+            numbers = [
+                str(i) for i, m in enumerate(messages, 1)
+                if m.internaldate.date() >= day
+            ]
+        else:
+            numbers = [str(i) for i in range(1, len(messages) + 1)]
+        self.send_line('* SEARCH' + ''.join(' ' + n for n in numbers))
+        self.send_line(f'{tag} OK SEARCH completed')
+
+    def do_FETCH(self, tag, args):
+        messages = self.mailbox.snapshot()
+        number, _, items = args.partition(' ')
+        self._send_fetch(int(number), messages[int(number) - 1], items)
+        self.send_line(f'{tag} OK FETCH completed')
+
+    def do_UID(self, tag, args):
+        command, _, args = args.partition(' ')
+        command = command.upper()
+        messages = self.mailbox.snapshot()
+        if command == 'SEARCH':
+            uid_range = re.search(r'UID (\S+)', args)
+            if uid_range:
+                uids = _parse_uid_set(uid_range.group(1), messages)
+            else:
+                uids = [m.uid for m in messages]
+            self.send_line('* SEARCH' + ''.join(f' {uid}' for uid in uids))
+        elif command == 'FETCH':
+            uid_set, _, items = args.partition(' ')
+            wanted = set(_parse_uid_set(uid_set, messages))
+            for number, message in enumerate(messages, 1):
+                if message.uid in wanted:
+                    self._send_fetch(number, message, items)
+        else:
+            self.send_line(f'{tag} BAD unsupported UID {command}')
+            return
+        self.send_line(f'{tag} OK UID {command} completed')
+
+    def _send_fetch(self, number, message, items):
+        items = items.upper()
+        response = f'* {number} FETCH (UID {message.uid}'.encode()
+        if 'RFC822.SIZE' in items:
+            response += f' RFC822.SIZE {len(message.raw)}'.encode()
+        if 'INTERNALDATE' in items:
+            response += f' INTERNALDATE "{message.internaldate.strftime("%d-%b-%Y %H:%M:%S %z")}"'.encode()
+        header_fields = re.search(r'BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]', items)
+        if header_fields:
+            names = header_fields.group(1).split()
+            headers = _header_fields(message.raw, names)
+            response += (
+                f' BODY[HEADER.FIELDS ({" ".join(names)})] {{{len(headers)}}}\r\n'.encode() + headers
+            )
+        if re.search(r'BODY(?:\.PEEK)?\[\]', items):
+            response += f' BODY[] {{{len(message.raw)}}}\r\n'.encode() + message.raw
+        if re.search(r'RFC822(?![.\w])', items):
+            response += f' RFC822 {{{len(message.raw)}}}\r\n'.encode() + message.raw
+        self.wfile.write(response + b')\r\n')
+
+    def do_IDLE(self, tag, args):
+        self.send_line('+ idling')
+        while True:
+            line = self.read_line(timeout=0.05)
+            self._report_exists()
+            if line is not None:
+                if not line:
+                    return False
+                if line.strip().upper() == b'DONE':
+                    self.send_line(f'{tag} OK IDLE terminated')
+                    return
+
+    def do_LOGOUT(self, tag, args):
+        self.send_line('* BYE logging out')
+        self.send_line(f'{tag} OK LOGOUT completed')
+        return False
+
+    def _report_exists(self):
+        count = len(self.mailbox.messages)
+        if self.selected and count != self.seen_count:
+            self.seen_count = count
+            self.send_line(f'* {count} EXISTS')
+
+
+class _FakeServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler, host, port, latency, failure_rate=0.0, seed=None):
+        super().__init__((host, port), handler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.tls_context = None
+        self.drop_once = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.drop_connections()
+
+    def take_drop(self, command):
+        """True, once, when .drop_once is *command*."""
+        with self.lock:
+            if self.drop_once != command:
+                return False
+            self.drop_once = None
+            return True
+
+    def inject_failure(self):
+        """True, and counted in stats['failures'], for a *failure_rate* share of calls."""
+        if not self.failure_rate:
+            return False
+        with self.lock:
+            if self.random.random() >= self.failure_rate:
+                return False
+            self.stats['failures'] += 1
+            return True
+
+    def drop_connections(self):
+        """Abruptly close every client connection, as a crashed server would."""
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeIMAPServer(_FakeServer):
+    """
+    Minimal plaintext IMAP4rev1 server backed by a FakeMailbox.
+    Every command is answered no sooner than *latency* seconds after it
+    arrived, simulating a round trip to a remote server. A *failure_rate*
+    share of commands drop the connection instead. Connections, SELECTs and
+    injected failures are counted in .stats.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 capabilities=('IMAP4rev1', 'IDLE', 'AUTH=XOAUTH2'), mailbox=None, failure_rate=0.0, seed=None):
+        super().__init__(_IMAPHandler, host, port, latency, failure_rate, seed)
+        self.capabilities = capabilities
+        self.mailbox = mailbox or FakeMailbox()
+        self.stats = {'connections': 0, 'selects': 0, 'failures': 0}
+
+
+class _SMTPHandler(_LineHandler):
+    def setup(self):
+        super().setup()
+        self.sender = None
+        self.recipients = []
+
+    def reply(self, code, text='OK'):
+        self.send_line(f'{code} {text}')
+
+    def handle(self):
+        with self.server.lock:
+            self.server.stats['connections'] += 1
+        self.reply(220, 'FakeSMTP ready')
+        while True:
+            line = self.next_command()
+            if not line:
+                return
+            command, _, args = line.decode().rstrip('\r\n').partition(' ')
+            with self.server.lock:
+                self.server.commands.append(command.upper())
+            handler = getattr(self, f'do_{command.upper()}', None)
+            if handler is None:
+                self.reply(502, 'Command not implemented')
+            elif handler(args) is False:
+                return
+
+    def do_EHLO(self, args):
+        extensions = ['fakesmtp', *self.server.extensions]
+        if self.server.tls_context is not None and not self.tls_started.is_set():
+            extensions.append('STARTTLS')
+        for extension in extensions[:-1]:
+            self.send_line(f'250-{extension}')
+        self.reply(250, extensions[-1])
+
+    def do_HELO(self, args):
+        self.reply(250, 'fakesmtp')
+
+    def do_AUTH(self, args):
+        with self.server.lock:
+            self.server.stats['auths'] += 1
+        self.reply(235, 'Accepted')
+
+    def do_NOOP(self, args):
+        self.reply(250)
+
+    def do_STARTTLS(self, args):
+        if self.server.tls_context is None or self.tls_started.is_set():
+            self.reply(502, 'Command not implemented')
+            return
+        self.reply(220, 'Ready to start TLS')
+        self.tls_replied.set()
+        self.tls_started.wait()
+        self.sender, self.recipients = None, []
+        with self.server.lock:
+            self.server.stats['tls'] += 1
+
+    def do_RSET(self, args):
+        self.sender, self.recipients = None, []
+        self.reply(250)
+
+    def do_MAIL(self, args):
+        if self.server.take_drop('MAIL'):
+            return False
+        sender = re.search(r'<([^>]*)>', args).group(1)
+        if 'BODY=8BITMIME' in args.upper() and '8BITMIME' not in self.server.extensions:
+            self.reply(555, 'MAIL parameters not recognized')
+            return
+        if sender in self.server.reject:
+            self.reply(550, 'Sender rejected')
+            return
+        self.sender = sender
+        self.recipients = []
+        self.reply(250)
+
+    def do_RCPT(self, args):
+        recipient = re.search(r'<([^>]*)>', args).group(1)
+        if recipient in self.server.reject:
+            self.reply(550, 'No such user')
+            return
+        self.recipients.append(recipient)
+        self.reply(250)
+
+    def do_DATA(self, args):
+        if not self.recipients:
+            self.reply(503, 'No valid recipients')
+            return
+        self.reply(354, 'End data with <CR><LF>.<CR><LF>')
+        lines = []
+        size = 0
+        while True:
+            line = self.read_line()
+            if not line:
+                return False
+            if line == b'.\r\n':
+                break
+            line = line[1:] if line.startswith(b'.') else line
+            size += len(line)
+            if self.server.keep_data:
+                lines.append(line)
+        if self.server.inject_failure():
+            self.sender, self.recipients = None, []
+            self.reply(451, 'Temporary failure, try again later')
+            return
+        with self.server.lock:
+            data = b''.join(lines) if self.server.keep_data else None
+            self.server.messages.append((self.sender, list(self.recipients), data))
+            self.server.accepted_at.append(time.monotonic())
+            self.server.stats['messages'] += 1
+            self.server.stats['bytes'] += size
+        self.sender, self.recipients = None, []
+        if self.server.take_drop('DATA'):
+            # Accepted, but the client never hears so
+            return False
+        self.reply(250, 'Queued')
+
+    def do_QUIT(self, args):
+        self.reply(221, 'Bye')
+        return False
+
+
+class FakeSMTPServer(_FakeServer):
+    """
+    Minimal ESMTP server that records every accepted message as
+    (sender, recipients, data) in .messages, with its time.monotonic()
+    acceptance time at the same index of .accepted_at, and counts
+    connections and AUTH handshakes in .stats, and every command verb it
+    receives in .commands. Addresses listed in *reject* get a 550 at MAIL
+    or RCPT, BODY=8BITMIME gets a 555 unless 8BITMIME is in *extensions*,
+    and a *failure_rate* share of transactions a 451
+    after DATA. With keep_data=False message bodies are only counted (data
+    is None). Setting .drop_once to 'MAIL' or 'DATA' drops the next
+    connection to reach that command without replying (after accepting the
+    message, for DATA). With tls=True it offers STARTTLS with the self-signed
+    certificate in TLS_CERT_FILE, which clients must be told to trust (e.g.
+    with SSL_CERT_FILE), and counts upgraded sessions in stats['tls'].
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 extensions=('PIPELINING', '8BITMIME', 'AUTH XOAUTH2'), reject=(), keep_data=True,
+                 failure_rate=0.0, seed=None, tls=False):
+        super().__init__(_SMTPHandler, host, port, latency, failure_rate, seed)
+        self.extensions = extensions
+        self.reject = set(reject)
+        self.keep_data = keep_data
+        self.messages = []
+        self.accepted_at = []
+        self.commands = []
+        self.stats = {'connections': 0, 'auths': 0, 'messages': 0, 'bytes': 0, 'failures': 0, 'tls': 0}
+        if tls:
+            self.tls_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.tls_context.load_cert_chain(TLS_CERT_FILE)
+
+
+class _TokenHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.stats['requests'] += 1
+            token = f"fake-token-{server.stats['requests']}"
+        body = json.dumps({'access_token': token, 'expires_in': server.expires_in, 'token_type': 'Bearer'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTokenServer(ThreadingHTTPServer):
+    """
+    Stand-in OAuth2 token endpoint: every POST is answered after *latency*
+    seconds with a new access token valid for *expires_in* seconds, and
+    counted in .stats['requests'].
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, expires_in=3600):
+        super().__init__((host, port), _TokenHandler)
+        self.latency = latency
+        self.expires_in = expires_in
+        self.stats = {'requests': 0}
+        self.lock = threading.Lock()
+        self.tls_context = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/token"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FixedTokenProvider:
+    """Stands in for oauth.TokenProvider with a constant token, for runs that need no database."""
+
+    def __init__(self, token='fake-token'):
+        self.token = token
+        self.expiry = (datetime.now(timezone.utc) + timedelta(days=1)).replace(tzinfo=None)
+
+    def get_token(self):
+        return self.token
+
+    def invalidate(self, token=None):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def _header_fields(raw, names):
+    """Return the raw header lines of *raw* whose field name is in *names*."""
+    wanted = {name.upper() for name in names}
+    header_block = raw.split(b'\r\n\r\n', 1)[0]
+    selected = []
+    keep = False
+    for line in header_block.split(b'\r\n'):
+        if line[:1] in (b' ', b'\t'):
+            if keep:
+                selected.append(line)
+            continue
+        keep = line.split(b':', 1)[0].strip().upper().decode() in wanted
+        if keep:
+            selected.append(line)
+    return b''.join(line + b'\r\n' for line in selected) + b'\r\n'
+
+
+def _parse_uid_set(uid_set, messages):
+    """Expand an IMAP UID set such as "4:*" or "1,3:5" against *messages*."""
+    highest = messages[-1].uid if messages else 0
+    existing = {m.uid for m in messages}
+    uids = set()
+    for part in uid_set.split(','):
+        start, _, end = part.partition(':')
+        start = highest if start == '*' else int(start)
+        end = start if not end else highest if end == '*' else int(end)
+        low, high = min(start, end), max(start, end)
+        uids.update(uid for uid in existing if low <= uid <= high)
+    return sorted(uids)
+
+
+def make_message(to, subject='Test', body='Hello', sender='sender@example.com'):
+    """Build raw RFC822 bytes for a plain-text message."""
+    return (
+        f'From: {sender}\r\n'
+        f'To: {to}\r\n'
+        f'Subject: {subject}\r\n'
+        f'Date: {format_datetime(datetime.now(timezone.utc))}\r\n'
+        f'Message-ID: <{time.monotonic_ns()}@example.com>\r\n'
+        f'\r\n'
+        f'{body}\r\n'
+    ).encode()
@@ -0,0 +1,356 @@
+import random
+import re
+import select
+import ssl
+import time
+import logging
+from tempfile import SpooledTemporaryFile
+
+logger = logging.getLogger(__name__)
+
+EXISTS_RE = re.compile(rb'^\* (\d+) EXISTS')
+FETCH_START_RE = re.compile(rb'^(\d+) \(')
+FETCH_NUMBER_RE = re.compile(rb'(UID|RFC822\.SIZE|MODSEQ) \(?(\d+)')
+FETCH_INTERNALDATE_RE = re.compile(rb'INTERNALDATE "([^"]+)"')
+FETCH_LITERAL_RE = re.compile(rb'(RFC822|BODY\[[^\]]*\]) \{\d+\}$')
+UNTAGGED_FETCH_RE = re.compile(rb'^\* (\d+) FETCH (\(.*)$', re.DOTALL)
+LITERAL_SIZE_RE = re.compile(rb'\{(\d+)\}\r\n$')
+
+
+def parse_fetch(data):
+    """
+    Group the raw data of an imaplib FETCH response into one dict per message,
+    e.g. {'UID': 12, 'RFC822.SIZE': 3456, 'HEADER': b'To: ...'}. Full bodies
+    (RFC822 or BODY[]) are stored under 'RFC822' and header sections
+    (BODY[HEADER...]) under 'HEADER'.
+    """
+    messages = []
+    current = None
+    for item in data:
+        if item is None:
+            continue
+        prefix, literal = item if isinstance(item, tuple) else (item, None)
+        start = FETCH_START_RE.match(prefix)
+        if start:
+            current = {'SEQ': int(start.group(1))}
+            messages.append(current)
+        if current is None:
+            continue
+        for name, value in FETCH_NUMBER_RE.findall(prefix):
+            current[name.decode()] = int(value)
+        internaldate = FETCH_INTERNALDATE_RE.search(prefix)
+        if internaldate:
+            current['INTERNALDATE'] = internaldate.group(1).decode()
+        if literal is not None:
+            section = FETCH_LITERAL_RE.search(prefix)
+            if section:
+                key = 'HEADER' if section.group(1).startswith(b'BODY[HEADER') else 'RFC822'
+                current[key] = literal
+    return messages
+
+
+def plan_batches(messages, max_count, max_bytes):
+    """
+    Split (uid, size) pairs into UID batches of at most *max_count* messages
+    and roughly *max_bytes* bytes. A message larger than *max_bytes* gets a
+    batch of its own.
+    """
+    batches = []
+    batch, batch_bytes = [], 0
+    for uid, size in messages:
+        if batch and (len(batch) >= max_count or batch_bytes + size > max_bytes):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(uid)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def uid_set(uids):
+    """Compress sorted UIDs into an IMAP sequence set, e.g. [1, 2, 3, 7] -> '1:3,7'."""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(a) if a == b else f'{a}:{b}' for a, b in ranges)
+
+
+def _read_literal(imap, size, spool_threshold=None):
+    """
+    Read a *size*-byte literal: as bytes, or into a SpooledTemporaryFile
+    (rewound, on disk beyond *spool_threshold* bytes) when it is larger than
+    *spool_threshold*, so big messages never sit in memory in one piece.
+    """
+    if spool_threshold is None or size <= spool_threshold:
+        return imap.read(size)
+    spool = SpooledTemporaryFile(max_size=spool_threshold)
+    remaining = size
+    while remaining:
+        chunk = imap.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            spool.close()
+            raise imap.abort('socket error: EOF during FETCH literal')
+        spool.write(chunk)
+        remaining -= len(chunk)
+    spool.seek(0)
+    return spool
+
+
+def _read_response(imap, spool_threshold=None):
+    """
+    Read one complete server response, including any literals, in the same
+    shape imaplib uses for FETCH data: a list of (prefix, literal) tuples
+    followed by the trailing bytes. Literals over *spool_threshold* bytes
+    are returned as spooled files (see _read_literal()).
+    """
+    parts = []
+    line = imap.readline()
+    while True:
+        if not line:
+            raise imap.abort('socket error: EOF during FETCH')
+        literal_size = LITERAL_SIZE_RE.search(line)
+        if not literal_size:
+            parts.append(line.rstrip(b'\r\n'))
+            return parts
+        parts.append((line[:-2], _read_literal(imap, int(literal_size.group(1)), spool_threshold)))
+        line = imap.readline()
+
+
+def fetch_messages(imap, batches, items, depth=2, spool_threshold=None, sizes=None, max_in_flight=None):
+    """
+    Stream a UID FETCH of *items* for each UID batch in *batches*, keeping up
+    to *depth* commands in flight, and yield each message as a parse_fetch()
+    dict as soon as its response has been read.
+
+    With *sizes* ({uid: bytes}) and *max_in_flight*, a further batch is only
+    requested while the messages requested but not yet handed back to the
+    consumer stay within that many bytes (one batch is always allowed), so
+    a slow consumer throttles the download. Literals over *spool_threshold*
+    bytes arrive as spooled files; the consumer owns and closes them.
+
+    The generator reads every outstanding response even if the consumer
+    stops early, so the session stays usable afterwards.
+    """
+    sizes = sizes or {}
+    pending = []
+    batches = iter(batches)
+    upcoming = [next(batches, None)]
+    in_flight = 0
+
+    def fill():
+        nonlocal in_flight
+        while len(pending) < depth and upcoming[0] is not None:
+            batch = upcoming[0]
+            batch_bytes = sum(sizes.get(uid, 0) for uid in batch)
+            if max_in_flight and in_flight and in_flight + batch_bytes > max_in_flight:
+                return
+            tag = imap._new_tag()
+            imap.send(tag + f' UID FETCH {uid_set(batch)} {items}\r\n'.encode())
+            pending.append(tag)
+            in_flight += batch_bytes
+            upcoming[0] = next(batches, None)
+
+    fill()
+
+    connection_lost = False
+    try:
+        while pending:
+            parts = _read_response(imap, spool_threshold)
+            first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+            if first.startswith(pending[0]):
+                status = first[len(pending[0]):].strip()
+                # Read by hand, so imaplib never drops the tag itself
+                imap.tagged_commands.pop(pending.pop(0), None)
+                if not status.startswith(b'OK'):
+                    raise imap.error(f'UID FETCH failed: {status!r}')
+                fill()
+                continue
+            fetch = UNTAGGED_FETCH_RE.match(first)
+            if not fetch:
+                exists = EXISTS_RE.match(first)
+                if exists:
+                    # Keep new-mail notifications visible to IMAPSession.probe()
+                    imap._append_untagged('EXISTS', exists.group(1))
+                continue
+            # Strip "* " and "FETCH" the way imaplib does before parsing
+            prefix = fetch.group(1) + b' ' + fetch.group(2)
+            parts[0] = (prefix, parts[0][1]) if isinstance(parts[0], tuple) else prefix
+            for message in parse_fetch(parts):
+                yield message
+                # The consumer is done with it
+                in_flight -= sizes.get(message.get('UID'), 0)
+                fill()
+    except (imap.abort, OSError):
+        connection_lost = True
+        raise
+    finally:
+        # Drain responses the consumer did not wait for
+        while pending and not connection_lost:
+            parts = _read_response(imap, spool_threshold)
+            for part in parts:
+                if isinstance(part, tuple) and hasattr(part[1], 'close'):
+                    part[1].close()
+            first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+            if first.startswith(pending[0]):
+                imap.tagged_commands.pop(pending.pop(0), None)
+
+
+def supports_idle(imap):
+    """Return True if the server advertises the IDLE extension (RFC 2177)."""
+    return 'IDLE' in imap.capabilities
+
+
+def _has_pending_data(sock):
+    """SSL sockets may hold decrypted bytes that select() cannot see."""
+    return isinstance(sock, ssl.SSLSocket) and sock.pending() > 0
+
+
+def _read_available_lines(imap):
+    """
+    Read the line the server just started sending, then every further
+    complete line that is already available without blocking.
+    """
+    line = imap.readline()
+    if not line:
+        raise imap.abort('socket error: EOF during IDLE')
+    lines = [line]
+
+    sock = imap.sock
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        while True:
+            try:
+                line = imap.readline()
+            except (BlockingIOError, ssl.SSLWantReadError):
+                break
+            # A non-blocking read returns b'' when nothing is buffered
+            if not line:
+                break
+            lines.append(line)
+    finally:
+        sock.settimeout(timeout)
+    return lines
+
+
+def idle(imap, timeout):
+    """
+    Put the selected mailbox into IDLE and block until the server announces
+    new mail with an EXISTS response or *timeout* seconds elapse.
+    Returns True if new mail was announced.
+    """
+    tag = imap._new_tag()
+    try:
+        return _idle(imap, tag, timeout)
+    finally:
+        # The tagged reply is read by hand, so imaplib never drops the tag itself
+        imap.tagged_commands.pop(tag, None)
+
+
+def _idle(imap, tag, timeout):
+    imap.send(tag + b' IDLE\r\n')
+    line = imap.readline()
+    if not line.startswith(b'+'):
+        raise imap.error(f'IDLE rejected: {line!r}')
+
+    new_mail = False
+    deadline = time.monotonic() + timeout
+    while not new_mail:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not _has_pending_data(imap.sock):
+            readable, _, _ = select.select([imap.sock], [], [], remaining)
+            if not readable:
+                break
+        for line in _read_available_lines(imap):
+            logger.debug(f"IDLE response: {line!r}")
+            if EXISTS_RE.match(line):
+                new_mail = True
+    imap.send(b'DONE\r\n')
+
+    # Consume anything the server sent between our DONE and its tagged reply
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imap.abort('socket error: EOF while ending IDLE')
+        if line.startswith(tag):
+            if not line[len(tag):].strip().startswith(b'OK'):
+                raise imap.error(f'IDLE failed: {line!r}')
+            break
+        if EXISTS_RE.match(line):
+            new_mail = True
+    return new_mail
+
+
+class IMAPSession:
+    """
+    Long-lived IMAP connection shared across check cycles.
+
+    *connect* is a callable returning an authenticated imaplib connection
+    with the folder selected. Connection failures are retried with bounded,
+    jittered exponential backoff; callers drop a broken connection with
+    reset() and the next get() transparently opens a new one.
+    """
+
+    def __init__(self, connect, backoff_min=1, backoff_max=300, sleep=time.sleep):
+        self._connect = connect
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self._sleep = sleep
+        self.imap = None
+        self.failures = 0
+        self.connects = 0
+
+    def backoff(self):
+        """Delay before the next connection attempt."""
+        delay = min(self.backoff_max, self.backoff_min * 2 ** max(0, self.failures - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def get(self):
+        """Return the live connection, (re)connecting until it succeeds."""
+        while self.imap is None:
+            try:
+                self.imap = self._connect()
+                self.failures = 0
+                self.connects += 1
+            except Exception as e:
+                self.failures += 1
+                delay = self.backoff()
+                logger.error(f"IMAP connection attempt {self.failures} failed: {e}. Retrying in {delay:.1f} seconds")
+                self._sleep(delay)
+        return self.imap
+
+    def probe(self):
+        """
+        Send a NOOP as a cheap liveness check and return True if the server
+        has announced new mail (an EXISTS response) since the last probe.
+        """
+        typ, data = self.imap.noop()
+        if typ != 'OK':
+            raise self.imap.abort(f'NOOP failed: {data}')
+        new_mail = 'EXISTS' in self.imap.untagged_responses
+        # imaplib keeps unclaimed untagged responses forever; don't let them pile up
+        self.imap.untagged_responses.clear()
+        return new_mail
+
+    def reset(self):
+        """Drop a connection that is known or suspected to be broken."""
+        if self.imap is not None:
+            try:
+                self.imap.shutdown()
+            except Exception:
+                pass
+        self.imap = None
+
+    def close(self):
+        if self.imap is not None:
+            try:
+                self.imap.logout()
+            except Exception:
+                pass
+        self.imap = None
@@ -0,0 +1,142 @@
+"""
+Database leases that let several daemon replicas share the mailbox shards.
+A replica works on a shard only while it holds the shard's lease, renewed
+by a heartbeat thread; the other replicas stand by and take the lease over
+once it has gone unrenewed for its TTL. Every acquisition bumps the lease's
+epoch, and writes made under the lease are conditional on that epoch, so a
+replica that stalled past its TTL cannot move the checkpoint behind the
+back of the one that took over.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+import django.db
+from django.db.models import Exists, F, Q
+from django.utils import timezone
+
+from .models import ShardLease
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLost(Exception):
+    """The lease expired or was taken over while work under it was in progress."""
+
+
+def replica_id():
+    """Identifies this process among the replicas: host, pid and a random suffix."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class Lease:
+    """
+    *holder*'s claim on the lease *name*. It counts as held until *ttl*
+    seconds after the last successful acquire or renewal, measured on this
+    host's monotonic clock from before the write, so this replica always
+    stops before any other could take over (given clock skew below the TTL).
+    """
+
+    def __init__(self, name, holder, ttl=30, heartbeat=10):
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.epoch = None
+        self._deadline = 0.0
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {'acquired': 0, 'renewed': 0, 'lost': 0}
+
+    @property
+    def held(self):
+        return self.epoch is not None and time.monotonic() < self._deadline
+
+    def acquire(self):
+        """Take the lease if it is free or has expired; returns whether this replica now holds it."""
+        started = time.monotonic()
+        now = timezone.now()
+        ShardLease.objects.get_or_create(name=self.name)
+        taken = ShardLease.objects.filter(name=self.name).filter(
+            Q(expires_at__isnull=True) | Q(expires_at__lt=now)
+        ).update(
+            holder=self.holder,
+            expires_at=now + timedelta(seconds=self.ttl),
+            epoch=F('epoch') + 1,
+            acquired_at=now,
+            renewed_at=now,
+        )
+        if not taken:
+            self.epoch = None
+            return False
+        self.epoch = ShardLease.objects.values_list('epoch', flat=True).get(name=self.name)
+        self._deadline = started + self.ttl
+        self.stats['acquired'] += 1
+        logger.info(f"Acquired lease {self.name} (epoch {self.epoch})")
+        return True
+
+    def renew(self):
+        """Extend the lease; returns False, and drops it, if another replica has taken it over."""
+        if self.epoch is None:
+            return False
+        started = time.monotonic()
+        now = timezone.now()
+        renewed = ShardLease.objects.filter(name=self.name, holder=self.holder, epoch=self.epoch).update(
+            expires_at=now + timedelta(seconds=self.ttl), renewed_at=now,
+        )
+        if not renewed:
+            self.epoch = None
+            self.stats['lost'] += 1
+            logger.warning(f"Lost lease {self.name} to another replica")
+            return False
+        self._deadline = started + self.ttl
+        self.stats['renewed'] += 1
+        return True
+
+    def release(self):
+        """Give the lease up so a standby replica can take over without waiting for the TTL."""
+        if self.epoch is not None:
+            ShardLease.objects.filter(name=self.name, holder=self.holder, epoch=self.epoch).update(
+                holder='', expires_at=None,
+            )
+            logger.info(f"Released lease {self.name}")
+        self.epoch = None
+
+    def check(self):
+        """Raise LeaseLost unless the lease is held; called before work that must not be done twice."""
+        if not self.held:
+            raise LeaseLost(f"Lease {self.name} is no longer held")
+
+    def fence(self, queryset):
+        """*queryset* restricted to rows that only match while this replica holds the lease at its epoch."""
+        return queryset.filter(Exists(
+            ShardLease.objects.filter(name=self.name, holder=self.holder, epoch=self.epoch).values('pk')
+        ))
+
+    def start(self):
+        """Renew the lease every *heartbeat* seconds from a background thread while it is held."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._heartbeat, name='lease-heartbeat', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.heartbeat):
+            try:
+                if self.epoch is not None:
+                    self.renew()
+            except Exception as e:
+                logger.error(f"Error renewing lease {self.name}: {str(e)}")
+                logger.error("Error details:", exc_info=True)
+            finally:
+                django.db.connections.close_all()
@@ -0,0 +1,265 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from emails import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the email daemon against local stand-in mail servers'
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='scenario', required=True)
+
+        fetch = subparsers.add_parser('fetch', help='UID FETCH throughput vs. batch size and pipeline depth')
+        fetch.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 5, 10, 25, 50, 100])
+        fetch.add_argument('--depths', type=int, nargs='+', default=[1, 2])
+        fetch.add_argument('--messages', type=int, default=200)
+        fetch.add_argument('--message-size', type=int, default=20_000, help='Body size in bytes')
+        fetch.add_argument('--latency', type=float, default=0.02, help='Simulated round trip in seconds')
+
+        smtp = subparsers.add_parser('smtp', help='SMTP handshakes and forward latency with and without pooling')
+        smtp.add_argument('--pool-sizes', type=int, nargs='+', default=[0, 2])
+        smtp.add_argument('--messages', type=int, default=20)
+        smtp.add_argument('--subscribers', type=int, default=5)
+        smtp.add_argument('--latency', type=float, default=0.02, help='Simulated round trip in seconds')
+
+        fanout = subparsers.add_parser('fanout', help='Per-subscriber sends vs. one pipelined multi-recipient envelope')
+        fanout.add_argument('--subscribers', type=int, nargs='+', default=[10, 100, 500])
+        fanout.add_argument('--max-recipients', type=int, default=100, help='RCPT TOs per transaction')
+        fanout.add_argument('--latency', type=float, default=0.02, help='Simulated round trip in seconds')
+
+        rewrite = subparsers.add_parser('rewrite', help='CPU and memory of MIME rebuild vs. passthrough header rewrite')
+        rewrite.add_argument('--subscribers', type=int, default=20)
+        rewrite.add_argument('--html-size', type=int, default=200_000, help='HTML part size in characters')
+        rewrite.add_argument('--attachments', type=int, default=2)
+        rewrite.add_argument('--repeat', type=int, default=5)
+
+        workers = subparsers.add_parser('workers', help='Fan-out throughput vs. number of concurrent sender workers')
+        workers.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4, 8])
+        workers.add_argument('--subscribers', type=int, default=200)
+        workers.add_argument('--latency', type=float, default=0.02, help='Simulated round trip in seconds')
+        workers.add_argument('--rate-limit', type=float, default=None, help='Recipients per second across all workers')
+        workers.add_argument('--rate-burst', type=int, default=50)
+
+        stress = subparsers.add_parser('stress', help='Peak RSS while pushing very large messages through a check cycle')
+        stress.add_argument('--messages', type=int, default=2)
+        stress.add_argument('--message-mb', type=int, default=50)
+        stress.add_argument('--subscribers', type=int, default=2)
+        stress.add_argument('--modes', nargs='+', choices=['spooled', 'in-memory'], default=['spooled', 'in-memory'])
+        stress.add_argument('--max-rss-mb', type=float, default=None,
+                            help='Fail if the spooled run peaks above this RSS')
+
+        engines = subparsers.add_parser('engines', help='Full check cycles: blocking vs. sender workers vs. asyncio')
+        engines.add_argument('--engines', nargs='+', choices=['sync', 'sync-workers', 'async'],
+                             default=['sync', 'sync-workers', 'async'])
+        engines.add_argument('--messages', type=int, default=20)
+        engines.add_argument('--subscribers', type=int, default=50)
+        engines.add_argument('--latency', type=float, default=0.02, help='Simulated round trip in seconds')
+        engines.add_argument('--concurrency', type=int, default=8,
+                             help='Sender workers / async envelopes in flight')
+
+        pipeline = subparsers.add_parser('pipeline', help='Head-of-line blocking without and with the staged pipeline')
+        pipeline.add_argument('--modes', nargs='+', choices=['sequential', 'pipeline'], default=['sequential', 'pipeline'])
+        pipeline.add_argument('--big-subscribers', type=int, default=200)
+        pipeline.add_argument('--small-messages', type=int, default=10)
+        pipeline.add_argument('--small-subscribers', type=int, default=2)
+        pipeline.add_argument('--latency', type=float, default=0.02, help='Simulated round trip in seconds')
+        pipeline.add_argument('--send-workers', type=int, default=4)
+
+        replicas = subparsers.add_parser('replicas', help='Several leased replicas; every message must arrive exactly once')
+        replicas.add_argument('--replicas', type=int, default=3)
+        replicas.add_argument('--shards', type=int, default=2)
+        replicas.add_argument('--messages', type=int, default=20)
+        replicas.add_argument('--subscribers', type=int, default=3)
+        replicas.add_argument('--lease-ttl', type=float, default=3, help='Seconds before a dead holder\'s lease is taken over')
+
+        e2e = subparsers.add_parser('e2e', help='The daemon process end to end over a synthetic mailbox')
+        e2e.add_argument('--messages', type=int, default=200)
+        e2e.add_argument('--lists', type=int, default=4)
+        e2e.add_argument('--subscribers', type=int, default=10, help='Per list')
+        e2e.add_argument('--hit-rate', type=float, default=0.8, help='Share of messages addressed to a list')
+        e2e.add_argument('--size-median', type=int, default=20_000, help='Median message size in bytes')
+        e2e.add_argument('--size-sigma', type=float, default=1.0, help='Spread of the log-normal message size')
+        e2e.add_argument('--size-max', type=int, default=5_000_000, help='Largest message size in bytes')
+        e2e.add_argument('--attachment-rate', type=float, default=0.2, help='Share of messages with attachments')
+        e2e.add_argument('--arrival-rate', type=float, default=50.0,
+                         help='Messages per second delivered into the mailbox (0: all at once)')
+        e2e.add_argument('--imap-latency', type=float, default=0.02, help='Simulated IMAP round trip in seconds')
+        e2e.add_argument('--smtp-latency', type=float, default=0.02, help='Simulated SMTP round trip in seconds')
+        e2e.add_argument('--imap-failure-rate', type=float, default=0.0,
+                         help='Share of IMAP commands answered by dropping the connection')
+        e2e.add_argument('--smtp-failure-rate', type=float, default=0.0,
+                         help='Share of SMTP transactions answered with a 451')
+        e2e.add_argument('--engine', choices=['sync', 'async'], default='sync')
+        e2e.add_argument('--poll', action='store_true', help='Poll every 0.2 seconds instead of using IMAP IDLE')
+        e2e.add_argument('--retry-delay', type=float, default=1, help='Seconds before a failed copy is retried')
+        e2e.add_argument('--timeout', type=float, default=120)
+        e2e.add_argument('--seed', type=int, default=1)
+
+        mime = subparsers.add_parser('mime', help='Time and allocations per call of the MIME parsing and building paths')
+        mime.add_argument('--messages', nargs='+', default=None,
+                          help='Corpus messages to run: plain, html-only, alternative, related, '
+                               'attachment-<N>mb, legacy-charsets (default: all)')
+        mime.add_argument('--repeat', type=int, default=5)
+        mime.add_argument('--attachment-mb', type=int, default=10)
+        mime.add_argument('--baseline', metavar='FILE', help='Compare with the results of an earlier --output run')
+        mime.add_argument('--threshold', type=float, default=0.25,
+                          help='Fail if time or allocations per call grew by more than this fraction of the baseline')
+
+        web = subparsers.add_parser('web', help='Subscribe and unsubscribe request latency with inline vs queued emails')
+        web.add_argument('--modes', nargs='+', choices=['inline', 'outbox'], default=['inline', 'outbox'])
+        web.add_argument('--signups', type=int, default=10, help='Addresses that subscribe and then unsubscribe')
+        web.add_argument('--lists', type=int, default=3)
+        web.add_argument('--smtp-latency', type=float, default=0.05, help='Simulated SMTP round trip in seconds')
+        web.add_argument('--coalesce', type=float, default=0.5,
+                         help='Seconds the outbox waits to fold unsubscribe requests together')
+
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+        parser.add_argument('--output', metavar='FILE', help='Also write the results, with the parameters used, as JSON to FILE')
+
+    def handle(self, *args, **options):
+        scenario = options['scenario']
+        if scenario == 'fetch':
+            results = benchmarks.bench_fetch(
+                batch_sizes=options['batch_sizes'],
+                messages=options['messages'],
+                message_size=options['message_size'],
+                latency=options['latency'],
+                depths=options['depths'],
+            )
+        elif scenario == 'smtp':
+            results = benchmarks.bench_smtp_pool(
+                pool_sizes=options['pool_sizes'],
+                messages=options['messages'],
+                subscribers=options['subscribers'],
+                latency=options['latency'],
+            )
+        elif scenario == 'fanout':
+            results = benchmarks.bench_fanout(
+                subscribers=options['subscribers'],
+                latency=options['latency'],
+                max_recipients=options['max_recipients'],
+            )
+        elif scenario == 'rewrite':
+            results = benchmarks.bench_rewrite(
+                subscribers=options['subscribers'],
+                html_size=options['html_size'],
+                attachments=options['attachments'],
+                repeat=options['repeat'],
+            )
+        elif scenario == 'workers':
+            results = benchmarks.bench_workers(
+                workers=options['workers'],
+                subscribers=options['subscribers'],
+                latency=options['latency'],
+                rate_limit=options['rate_limit'],
+                rate_burst=options['rate_burst'],
+            )
+        elif scenario == 'stress':
+            results = benchmarks.bench_stress(
+                messages=options['messages'],
+                message_mb=options['message_mb'],
+                subscribers=options['subscribers'],
+                modes=options['modes'],
+            )
+        elif scenario == 'engines':
+            results = benchmarks.bench_engines(
+                engines=options['engines'],
+                messages=options['messages'],
+                subscribers=options['subscribers'],
+                latency=options['latency'],
+                concurrency=options['concurrency'],
+            )
+        elif scenario == 'pipeline':
+            results = benchmarks.bench_pipeline(
+                modes=options['modes'],
+                big_subscribers=options['big_subscribers'],
+                small_messages=options['small_messages'],
+                small_subscribers=options['small_subscribers'],
+                latency=options['latency'],
+                send_workers=options['send_workers'],
+            )
+        elif scenario == 'replicas':
+            results = benchmarks.bench_replicas(
+                replicas=options['replicas'],
+                shards=options['shards'],
+                messages=options['messages'],
+                subscribers=options['subscribers'],
+                lease_ttl=options['lease_ttl'],
+            )
+        elif scenario == 'e2e':
+            results = benchmarks.bench_e2e(
+                messages=options['messages'],
+                lists=options['lists'],
+                subscribers=options['subscribers'],
+                hit_rate=options['hit_rate'],
+                size_median=options['size_median'],
+                size_sigma=options['size_sigma'],
+                size_max=options['size_max'],
+                attachment_rate=options['attachment_rate'],
+                arrival_rate=options['arrival_rate'],
+                imap_latency=options['imap_latency'],
+                smtp_latency=options['smtp_latency'],
+                imap_failure_rate=options['imap_failure_rate'],
+                smtp_failure_rate=options['smtp_failure_rate'],
+                engine=options['engine'],
+                idle=not options['poll'],
+                retry_delay=options['retry_delay'],
+                timeout=options['timeout'],
+                seed=options['seed'],
+            )
+        elif scenario == 'mime':
+            results = benchmarks.bench_mime(
+                messages=options['messages'],
+                repeat=options['repeat'],
+                attachment_mb=options['attachment_mb'],
+            )
+            regressions = []
+            if options['baseline']:
+                regressions = benchmarks.compare_with_baseline(
+                    results, options['baseline'], key=('message', 'operation'),
+                    measures=('us_per_op', 'peak_alloc_kb'), threshold=options['threshold'],
+                )
+        elif scenario == 'web':
+            results = benchmarks.bench_web(
+                modes=options['modes'],
+                signups=options['signups'],
+                lists=options['lists'],
+                smtp_latency=options['smtp_latency'],
+                coalesce=options['coalesce'],
+            )
+
+        report = {'scenario': scenario, 'results': results}
+        if options['output']:
+            parameters = {
+                key: value for key, value in options.items()
+                if key not in ('scenario', 'json', 'output', 'baseline', 'verbosity', 'settings', 'pythonpath', 'traceback',
+                               'no_color', 'force_color', 'skip_checks')
+            }
+            with open(options['output'], 'w') as output:
+                json.dump(dict(report, parameters=parameters), output, indent=2)
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            columns = list(results[0])
+            self.stdout.write('  '.join(f'{c:>16}' for c in columns))
+            for row in results:
+                self.stdout.write('  '.join(f'{row[c]!s:>16}' for c in columns))
+
+        if scenario == 'stress' and options['max_rss_mb']:
+            for row in results:
+                if row['mode'] == 'spooled' and row['peak_rss_mb'] > options['max_rss_mb']:
+                    raise CommandError(f"Peak RSS {row['peak_rss_mb']} MB exceeds the {options['max_rss_mb']} MB ceiling")
+        if scenario == 'replicas':
+            for row in results:
+                if row['duplicates'] or row['missing']:
+                    raise CommandError(
+                        f"{row['duplicates']} duplicate and {row['missing']} missing copies across {row['replicas']} replicas"
+                    )
+        if scenario == 'mime' and regressions:
+            slower = ', '.join(f"{row['message']}/{row['operation']}" for row in regressions)
+            raise CommandError(f"{len(regressions)} operations regressed by more than {options['threshold']:.0%}: {slower}")
+        if scenario == 'e2e':
+            for row in results:
+                if row['duplicates'] or row['missing']:
+                    raise CommandError(f"{row['duplicates']} duplicate and {row['missing']} missing copies")
@@ -0,0 +1,83 @@
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from emails import tracing
+from emails.models import MessageTrace
+
+
+class Command(BaseCommand):
+    help = 'Summarises the per-message latency traces recorded by the email daemon'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--list', dest='mailing_list', help='Only traces for this list alias')
+        parser.add_argument('--since', type=float, default=24, metavar='HOURS',
+                            help='Only messages fetched in the last HOURS hours (default: 24; 0 for all)')
+        parser.add_argument('--slowest', type=int, default=0, metavar='N',
+                            help='Also show the spans of the N slowest messages')
+        parser.add_argument('--trace', help='Show the spans of this trace ID only')
+        parser.add_argument('--export', metavar='FILE', help='Write the matching traces as JSON lines ("-" for stdout)')
+
+    def handle(self, *args, **options):
+        traces = MessageTrace.objects.all()
+        if options['trace']:
+            traces = traces.filter(trace_id=options['trace'])
+            if not traces.exists():
+                raise CommandError(f"No trace {options['trace']}")
+        if options['mailing_list']:
+            traces = traces.filter(mailing_list=options['mailing_list'])
+        if options['since'] and not options['trace']:
+            traces = traces.filter(fetched_at__gte=timezone.now() - timedelta(hours=options['since']))
+
+        if options['export']:
+            lines = (json.dumps(tracing.as_json(trace)) + '\n' for trace in traces.order_by('fetched_at').iterator())
+            if options['export'] == '-':
+                for line in lines:
+                    self.stdout.write(line, ending='')
+                return
+            count = 0
+            with open(options['export'], 'w') as output:
+                for line in lines:
+                    output.write(line)
+                    count += 1
+            self.stdout.write(self.style.SUCCESS(f"Exported {count} traces to {options['export']}"))
+            return
+
+        if options['trace']:
+            for trace in traces:
+                self._show(trace)
+            return
+
+        summary = tracing.summarize(traces.filter(completed_at__isnull=False).iterator())
+        if not summary:
+            self.stdout.write('No completed traces')
+        for row in summary:
+            latencies = ', '.join(
+                f"{pct} {row[f'{pct}_ms'] / 1000:.2f}s" if row[f'{pct}_ms'] is not None else f"{pct} -"
+                for pct in ('p50', 'p95', 'p99', 'max')
+            )
+            spans = ', '.join(f"{name} {ms:.0f} ms" for name, ms in row['mean_span_ms'].items())
+            self.stdout.write(f"{row['mailing_list']}: {row['messages']} messages, {latencies}")
+            self.stdout.write(f"  mean per message: {spans}")
+        pending = traces.filter(completed_at__isnull=True).count()
+        if pending:
+            self.stdout.write(f"{pending} traces still have queued deliveries")
+
+        if options['slowest']:
+            slowest = traces.filter(latency_ms__isnull=False).order_by('-latency_ms')[:options['slowest']]
+            for trace in slowest:
+                self._show(trace)
+
+    def _show(self, trace):
+        latency = f"{trace.latency_ms / 1000:.2f}s" if trace.latency_ms is not None else 'incomplete'
+        self.stdout.write(
+            f"\n{trace.trace_id} {trace.message_id or trace.source} -> {trace.mailing_list}: {latency}, "
+            f"{trace.delivered} delivered, {trace.refused} refused"
+        )
+        if trace.arrived_at:
+            waited = (trace.fetched_at - trace.arrived_at).total_seconds()
+            self.stdout.write(f"  {'arrived':<14} {-waited * 1000:>10.1f} ms  (INTERNALDATE {trace.arrived_at.isoformat()})")
+        for name, start, duration, *detail in trace.spans:
+            extra = f"  {detail[0][1]}/{detail[0][0]} accepted" if detail else ''
+            self.stdout.write(f"  {name:<14} {start:>10.1f} ms  +{duration:.1f} ms{extra}")
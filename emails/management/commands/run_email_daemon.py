@@ -1,5 +1,8 @@
 from django.core.management.base import BaseCommand
+from emails.async_daemon import AsyncEmailDaemon
 from emails.email_daemon import EmailDaemon
+from emails.shards import get_shard, get_shards
+from emails.supervisor import ShardSupervisor
 import logging
 
 logger = logging.getLogger(__name__)
@@ -7,15 +10,78 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = 'Runs the email forwarding daemon'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--idle',
+            action='store_true',
+            help='Keep one IMAP session open and wait for new mail with IMAP IDLE instead of polling',
+        )
+        parser.add_argument(
+            '--engine',
+            choices=['sync', 'async'],
+            default='sync',
+            help='sync: blocking daemon (default); async: fetch, route and send concurrently on one asyncio loop',
+        )
+        shard = parser.add_mutually_exclusive_group()
+        shard.add_argument(
+            '--shard',
+            help='Run only this MAILBOX_SHARDS entry (default: the first)',
+        )
+        shard.add_argument(
+            '--supervisor',
+            action='store_true',
+            help='Run every MAILBOX_SHARDS entry in its own process, restarting any that crash',
+        )
+        parser.add_argument(
+            '--profile',
+            action='store_true',
+            help='Write a cProfile .pstats file for every check cycle (toggle at runtime with SIGUSR1)',
+        )
+        parser.add_argument(
+            '--profile-slow',
+            type=float,
+            metavar='SECONDS',
+            help='Write a cProfile .pstats file for check cycles slower than this',
+        )
+        parser.add_argument(
+            '--profile-dir',
+            help='Where profiles and memory snapshots are written (default: PROFILE_DIR)',
+        )
+        parser.add_argument(
+            '--trace-memory',
+            type=float,
+            metavar='SECONDS',
+            help='Trace allocations and log the top growth every this many seconds (snapshot now with SIGUSR2)',
+        )
+
     def handle(self, *args, **options):
         try:
             self.stdout.write(self.style.SUCCESS('Initializing email daemon...'))
-            daemon = EmailDaemon()
+            profiling = {}
+            if options['profile']:
+                profiling['every'] = True
+            if options['profile_slow'] is not None:
+                profiling['slow'] = options['profile_slow']
+            if options['profile_dir']:
+                profiling['directory'] = options['profile_dir']
+            if options['trace_memory'] is not None:
+                profiling['memory_interval'] = options['trace_memory']
+
+            if options['supervisor']:
+                supervisor = ShardSupervisor(get_shards(), idle=options['idle'], engine=options['engine'],
+                                             profiling=profiling)
+                self.stdout.write(self.style.SUCCESS(f'Supervising {len(supervisor.workers)} mailbox shards...'))
+                supervisor.run()
+                return
+
+            shard = get_shard(options['shard']) if options['shard'] else None
+            daemon = AsyncEmailDaemon(shard) if options['engine'] == 'async' else EmailDaemon(shard)
+            daemon.profiler.configure(**profiling)
             self.stdout.write(self.style.SUCCESS('Email daemon started successfully!'))
-            self.stdout.write(self.style.SUCCESS('Watching for emails from @cyphy.life...'))
+            self.stdout.write(self.style.SUCCESS(f'Watching {daemon.shard} for emails from @cyphy.life...'))
 
             # Run the daemon
-            daemon.run()
+            daemon.run(idle=options['idle'])
 
         except Exception as e:
             self.stdout.write(self.style.ERROR(f'Error: {str(e)}'))
@@ -0,0 +1,202 @@
+"""
+Counters, gauges and latency histograms in the Prometheus text format.
+Recording is a lock and an addition, and nothing is formatted until a
+scraper asks, so instrumentation costs next to nothing when nobody is
+watching. The web app serves its process's metrics at /metrics/; the daemon
+serves its own from a small HTTP listener on METRICS_PORT.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Seconds; from a local cache hit to a slow SMTP transaction
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labels, values)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels, registry)
+
+    def observe(self, value, *labels):
+        if not self._registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # Per-bucket counts (the last is +Inf), then the sum
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the duration of the with-block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((values, list(series)) for values, series in self._values.items())
+        for values, series in items:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), series):
+                cumulative += count
+                labels = _format_labels(self.labels, values, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(series[-1])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._metrics = []
+
+    def register(self, metric):
+        metric._registry = self
+        self._metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """Serve *registry* at http://host:port/metrics from a daemon thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+# Daemon
+IMAP_CONNECT_SECONDS = Histogram('emaildaemon_imap_connect_seconds', 'IMAP connect, authenticate and SELECT time')
+IMAP_FETCH_SECONDS = Histogram(
+    'emaildaemon_imap_fetch_seconds',
+    'Routing-header FETCH per check (phase=headers) and waits for message bodies (phase=body)',
+    labels=('phase',),
+)
+IMAP_FETCHED_BYTES = Counter('emaildaemon_imap_fetched_bytes_total', 'Message bytes downloaded')
+MESSAGES = Counter(
+    'emaildaemon_messages_total', 'New messages by outcome: routed, skipped (no list) or duplicate',
+    labels=('outcome',),
+)
+PICKUP_LAG_SECONDS = Histogram(
+    'emaildaemon_pickup_lag_seconds', 'From the Date header to the check that routed the message',
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+PARSE_SECONDS = Histogram('emaildaemon_parse_seconds', 'Parsing a message for forwarding', labels=('mode',))
+ROUTE_LOOKUP_SECONDS = Histogram(
+    'emaildaemon_route_lookup_seconds', 'Looking up the mailing list for a recipient address',
+    buckets=(0.00001, 0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5),
+)
+SMTP_CONNECT_SECONDS = Histogram('emaildaemon_smtp_connect_seconds', 'SMTP connect, STARTTLS and AUTH time')
+SMTP_SEND_SECONDS = Histogram('emaildaemon_smtp_send_seconds', 'One SMTP mail transaction')
+RECIPIENTS = Counter(
+    'emaildaemon_recipients_total', 'Forwarded copies by result: delivered, refused or failed',
+    labels=('result',),
+)
+CHECK_SECONDS = Histogram('emaildaemon_check_seconds', 'Duration of a check cycle', labels=('result',))
+LAST_CHECK = Gauge('emaildaemon_last_check_timestamp_seconds', 'Unix time the last check cycle finished')
+
+# Web
+WEB_REQUESTS = Counter('emaildaemon_web_requests_total', 'HTTP requests', labels=('view', 'method', 'status'))
+WEB_REQUEST_SECONDS = Histogram('emaildaemon_web_request_seconds', 'HTTP request latency', labels=('view',))
+WEB_EMAILS = Counter('emaildaemon_web_emails_total', 'Emails sent by the web app, by result', labels=('result',))
+WEB_EMAIL_QUEUE_SECONDS = Histogram(
+    'emaildaemon_web_email_queue_seconds', 'From a view queueing an email to the SMTP server accepting it',
+)
@@ -0,0 +1,22 @@
+import time
+
+from . import metrics
+
+
+class MetricsMiddleware:
+    """Counts requests and their latency per view for the /metrics/ endpoint."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not metrics.REGISTRY.enabled:
+            return self.get_response(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        # Label by URL name rather than path, so that tokens in URLs don't create new series
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        metrics.WEB_REQUEST_SECONDS.observe(time.perf_counter() - started, view)
+        metrics.WEB_REQUESTS.inc(view, request.method, str(response.status_code))
+        return response
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0002_alter_subscriber_unique_together_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(max_length=254)),
+                ('folder', models.CharField(default='INBOX', max_length=255)),
+                ('uidvalidity', models.BigIntegerField()),
+                ('last_uid', models.BigIntegerField(default=0)),
+                ('highest_modseq', models.BigIntegerField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('account', 'folder')},
+            },
+        ),
+    ]
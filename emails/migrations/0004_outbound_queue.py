@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0003_mailboxcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=512)),
+                ('message_id', models.CharField(blank=True, max_length=998)),
+                ('raw', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('mailing_list', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbound_messages', to='emails.mailinglist')),
+            ],
+            options={
+                'unique_together': {('source', 'mailing_list')},
+            },
+        ),
+        migrations.CreateModel(
+            name='Delivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.EmailField(max_length=254)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField()),
+                ('last_error', models.TextField(blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='emails.outboundmessage')),
+            ],
+            options={
+                'verbose_name_plural': 'deliveries',
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='emails_deli_status_bfeb6e_idx')],
+                'unique_together': {('message', 'recipient')},
+            },
+        ),
+    ]
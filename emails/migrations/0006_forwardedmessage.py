@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0005_routingversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForwardedMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('mailing_list_id', models.PositiveBigIntegerField()),
+                ('forwarded_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'unique_together': {('key', 'mailing_list_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0007_oauthtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardLease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('holder', models.CharField(blank=True, max_length=255)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+                ('epoch', models.PositiveIntegerField(default=0)),
+                ('acquired_at', models.DateTimeField(blank=True, null=True)),
+                ('renewed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
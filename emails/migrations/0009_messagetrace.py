@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0008_shardlease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTrace',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trace_id', models.CharField(max_length=32)),
+                ('source', models.CharField(max_length=512)),
+                ('message_id', models.CharField(blank=True, max_length=998)),
+                ('mailing_list', models.CharField(max_length=100)),
+                ('arrived_at', models.DateTimeField(blank=True, null=True)),
+                ('fetched_at', models.DateTimeField(db_index=True)),
+                ('spans', models.JSONField(default=list)),
+                ('delivered', models.PositiveIntegerField(default=0)),
+                ('refused', models.PositiveIntegerField(default=0)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('latency_ms', models.PositiveIntegerField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['mailing_list', 'completed_at'], name='emails_mess_mailing_f5625a_idx'), models.Index(fields=['source'], name='emails_mess_source_4e9904_idx')],
+                'unique_together': {('trace_id', 'mailing_list')},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0009_messagetrace'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='emails.outboundmessage')),
+            ],
+            options={
+                'unique_together': {('message', 'index')},
+            },
+        ),
+    ]
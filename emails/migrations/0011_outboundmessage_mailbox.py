@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:45
+
+from django.db import migrations, models
+
+
+def set_mailbox(apps, schema_editor):
+    """Fill account and folder in from source ("account/folder/uidvalidity/uid"; the folder may contain '/')."""
+    OutboundMessage = apps.get_model('emails', 'OutboundMessage')
+    for message in OutboundMessage.objects.only('pk', 'source').iterator():
+        mailbox = message.source.rsplit('/', 2)[0]
+        account, _, folder = mailbox.partition('/')
+        OutboundMessage.objects.filter(pk=message.pk).update(account='' if account == 'None' else account, folder=folder)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0010_outboundchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboundmessage',
+            name='account',
+            field=models.CharField(blank=True, default='', max_length=254),
+        ),
+        migrations.AddField(
+            model_name='outboundmessage',
+            name='folder',
+            field=models.CharField(default='INBOX', max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='outboundmessage',
+            index=models.Index(fields=['account', 'folder'], name='emails_outb_account_bf0616_idx'),
+        ),
+        migrations.RunPython(set_mailbox, migrations.RunPython.noop),
+    ]
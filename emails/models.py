@@ -8,6 +8,21 @@ class MailingList(models.Model):
     def __str__(self):
         return self.alias
 
+    def iter_active_subscriber_emails(self, chunk_size=500):
+        """Yield active subscriber addresses, paging by primary key instead of loading them all at once."""
+        last_pk = 0
+        while True:
+            chunk = list(
+                self.subscribers.filter(is_active=True, pk__gt=last_pk)
+                .order_by('pk')
+                .values_list('pk', 'email')[:chunk_size]
+            )
+            if not chunk:
+                return
+            for _, email in chunk:
+                yield email
+            last_pk = chunk[-1][0]
+
 class Subscriber(models.Model):
     email = models.EmailField()
     mailing_lists = models.ManyToManyField(MailingList, related_name='subscribers')  # Changed from ForeignKey to ManyToManyField
@@ -21,3 +36,143 @@ class Subscriber(models.Model):
     def __str__(self):
         lists = ", ".join([ml.alias for ml in self.mailing_lists.all()])
         return f"{self.email} -> [{lists}]"
+
+class MailboxCheckpoint(models.Model):
+    """Highest IMAP UID the daemon has fully processed in a mailbox folder."""
+    account = models.CharField(max_length=254)
+    folder = models.CharField(max_length=255, default='INBOX')
+    uidvalidity = models.BigIntegerField()
+    last_uid = models.BigIntegerField(default=0)
+    highest_modseq = models.BigIntegerField(null=True, blank=True)  # only when the server supports CONDSTORE
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('account', 'folder')]
+
+    def __str__(self):
+        return f"{self.account}/{self.folder} uid={self.last_uid} (validity {self.uidvalidity})"
+
+class OutboundMessage(models.Model):
+    """An incoming list message queued for delivery to the list's subscribers."""
+    mailing_list = models.ForeignKey(MailingList, on_delete=models.CASCADE, related_name='outbound_messages')
+    # The mailbox it came from: each daemon drains only the messages of its own
+    account = models.CharField(max_length=254, blank=True, default='')
+    folder = models.CharField(max_length=255, default='INBOX')
+    # account/folder/uidvalidity/uid of the IMAP message it came from, so a refetch is never queued twice
+    source = models.CharField(max_length=512)
+    message_id = models.CharField(max_length=998, blank=True)
+    raw = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [('source', 'mailing_list')]
+        indexes = [models.Index(fields=['account', 'folder'])]
+
+    def __str__(self):
+        return f"{self.message_id or self.source} -> {self.mailing_list}"
+
+class OutboundChunk(models.Model):
+    """A piece of a queued message that was spooled to disk; such messages keep an empty raw and are stored in order here."""
+    message = models.ForeignKey(OutboundMessage, on_delete=models.CASCADE, related_name='chunks')
+    index = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = [('message', 'index')]
+
+    def __str__(self):
+        return f"{self.message} chunk {self.index}"
+
+class Delivery(models.Model):
+    """One (queued message, recipient) delivery and its retry state."""
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (SENT, 'Sent'), (FAILED, 'Failed')]
+
+    message = models.ForeignKey(OutboundMessage, on_delete=models.CASCADE, related_name='deliveries')
+    recipient = models.EmailField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField()
+    last_error = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('message', 'recipient')]
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+        verbose_name_plural = 'deliveries'
+
+    def __str__(self):
+        return f"{self.recipient} ({self.status}, {self.attempts} attempts)"
+
+class RoutingVersion(models.Model):
+    """Change counter per mailing list, bumped on every subscription change so the daemon knows what to reload."""
+    # Plain id rather than a ForeignKey so the row outlives a deleted list and announces its removal
+    mailing_list_id = models.PositiveBigIntegerField(unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"list {self.mailing_list_id} v{self.version}"
+
+class ForwardedMessage(models.Model):
+    """A message already forwarded to a list, keyed by Message-ID (or a content hash without one)."""
+    key = models.CharField(max_length=255)
+    mailing_list_id = models.PositiveBigIntegerField()
+    forwarded_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = [('key', 'mailing_list_id')]
+
+    def __str__(self):
+        return f"{self.key} -> list {self.mailing_list_id}"
+
+class OAuthToken(models.Model):
+    """The current access token for an account, shared by the daemon and the web workers."""
+    account = models.CharField(max_length=254, unique=True)
+    access_token = models.TextField(blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    # Set while one process is calling the token endpoint; the others wait for its result
+    refreshing_until = models.DateTimeField(null=True, blank=True)
+    refreshed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.account} (expires {self.expires_at})"
+
+
+class ShardLease(models.Model):
+    """Which daemon replica is working on a mailbox; renewed by its heartbeat, taken over once it expires."""
+    name = models.CharField(max_length=255, unique=True)  # "account/folder"
+    holder = models.CharField(max_length=255, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    # Incremented on every acquisition; writes made under the lease check it is unchanged
+    epoch = models.PositiveIntegerField(default=0)
+    acquired_at = models.DateTimeField(null=True, blank=True)
+    renewed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name} held by {self.holder or 'nobody'} (until {self.expires_at})"
+
+
+class MessageTrace(models.Model):
+    """Where the time went between a message arriving in the mailbox and its copies to one list being accepted."""
+    trace_id = models.CharField(max_length=32)
+    source = models.CharField(max_length=512)  # "account/folder/uidvalidity/uid", as on OutboundMessage
+    message_id = models.CharField(max_length=998, blank=True)
+    # Alias rather than a ForeignKey so traces outlive a deleted list
+    mailing_list = models.CharField(max_length=100)
+    arrived_at = models.DateTimeField(null=True, blank=True)  # the server's INTERNALDATE
+    fetched_at = models.DateTimeField(db_index=True)  # span offsets count from here
+    # [name, start ms, duration ms], sends followed by [recipients, delivered]
+    spans = models.JSONField(default=list)
+    delivered = models.PositiveIntegerField(default=0)
+    refused = models.PositiveIntegerField(default=0)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    latency_ms = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        unique_together = [('trace_id', 'mailing_list')]
+        indexes = [models.Index(fields=['mailing_list', 'completed_at']), models.Index(fields=['source'])]
+
+    def __str__(self):
+        return f"{self.message_id or self.source} -> {self.mailing_list} ({self.latency_ms} ms)"
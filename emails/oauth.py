@@ -0,0 +1,183 @@
+"""
+One OAuth2 access token per account, shared through an OAuthToken row by
+the daemon and every web worker instead of each refreshing its own. A
+process that finds the token close to expiry claims the row with a
+conditional UPDATE and calls the token endpoint; the others keep using the
+current token meanwhile, or wait for the new one once it has expired.
+"""
+import functools
+import logging
+import threading
+import time
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+from .models import OAuthToken
+
+logger = logging.getLogger(__name__)
+
+# A token this close to expiry is no longer handed out
+MIN_TTL = timedelta(seconds=30)
+
+
+def request_token(token_uri, refresh_token, client_id, client_secret):
+    """Exchange the refresh token at *token_uri*; returns (access_token, aware expiry)."""
+    credentials = Credentials(
+        token=None,
+        refresh_token=refresh_token,
+        token_uri=token_uri,
+        client_id=client_id,
+        client_secret=client_secret,
+    )
+    credentials.refresh(Request())
+    # google-auth reports naive UTC, and nothing when the endpoint sent no expires_in
+    expiry = credentials.expiry or (timezone.now() + timedelta(hours=1)).replace(tzinfo=None)
+    return credentials.token, expiry.replace(tzinfo=dt_timezone.utc)
+
+
+class TokenProvider:
+    """
+    Hands out the shared access token for *account*. *fetch* returns a new
+    (access_token, aware expiry) pair; it is called by at most one process
+    at a time, once the token is within *margin* seconds of expiring.
+    """
+
+    def __init__(self, account, fetch, margin=300, claim_timeout=30, poll_interval=0.2):
+        self.account = account
+        self.fetch = fetch
+        self.margin = timedelta(seconds=margin)
+        self.claim_timeout = timedelta(seconds=claim_timeout)
+        self.poll_interval = poll_interval
+        self._token = None
+        self._expiry = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {'refreshes': 0, 'shared': 0, 'waits': 0, 'failures': 0}
+
+    @property
+    def expiry(self):
+        """Naive UTC expiry of the token last handed out, as google-auth and the SMTP pool use it."""
+        if self._expiry is None:
+            return None
+        return self._expiry.astimezone(dt_timezone.utc).replace(tzinfo=None)
+
+    def _use(self, token, expiry):
+        self._token, self._expiry = token, expiry
+        return token
+
+    def get_token(self):
+        """A valid access token, refreshed here or by another process when it is close to expiry."""
+        with self._lock:
+            if self._token and self._expiry - timezone.now() > self.margin:
+                return self._token
+
+            waited = False
+            while True:
+                row, _ = OAuthToken.objects.get_or_create(account=self.account)
+                now = timezone.now()
+                usable = bool(row.access_token) and row.expires_at is not None and row.expires_at - now > MIN_TTL
+                if usable and row.expires_at - now > self.margin:
+                    if row.access_token != self._token:
+                        self.stats['shared'] += 1
+                    return self._use(row.access_token, row.expires_at)
+                if self._claim(now):
+                    return self._refresh(row if usable else None)
+                if usable:
+                    # Another process is already refreshing; this token is still good for now
+                    return self._use(row.access_token, row.expires_at)
+                if not waited:
+                    self.stats['waits'] += 1
+                    waited = True
+                time.sleep(self.poll_interval)
+
+    def _claim(self, now):
+        """Take the right to refresh, unless another process holds an unexpired claim."""
+        claimed = OAuthToken.objects.filter(account=self.account).filter(
+            Q(refreshing_until__isnull=True) | Q(refreshing_until__lt=now)
+        ).update(refreshing_until=now + self.claim_timeout)
+        return claimed == 1
+
+    def _refresh(self, current):
+        try:
+            token, expiry = self.fetch()
+        except Exception as e:
+            OAuthToken.objects.filter(account=self.account).update(refreshing_until=None)
+            self.stats['failures'] += 1
+            if current is None:
+                raise
+            logger.warning(f"Token refresh for {self.account} failed, keeping the current token: {str(e)}")
+            return self._use(current.access_token, current.expires_at)
+
+        OAuthToken.objects.filter(account=self.account).update(
+            access_token=token, expires_at=expiry, refreshing_until=None, refreshed_at=timezone.now(),
+        )
+        self.stats['refreshes'] += 1
+        logger.info(f"Refreshed access token for {self.account}, valid until {expiry:%H:%M:%S}")
+        return self._use(token, expiry)
+
+    def invalidate(self, token=None):
+        """Drop *token* (default: the one last handed out) after the server rejected it."""
+        with self._lock:
+            token = token or self._token
+            if token is None:
+                return
+            if token == self._token:
+                self._token = self._expiry = None
+        # Only the rejected token: another process may already have replaced it
+        OAuthToken.objects.filter(account=self.account, access_token=token).update(expires_at=timezone.now())
+
+    def start(self):
+        """Keep the shared token refreshed ahead of expiry from a background thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._refresh_loop, name='oauth-refresh', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _refresh_loop(self):
+        delay = 0
+        while not self._stop.wait(delay):
+            try:
+                self.get_token()
+                # Wake just after the token enters the refresh margin
+                delay = max(1.0, (self._expiry - self.margin - timezone.now()).total_seconds() + 1)
+            except Exception as e:
+                logger.error(f"Error refreshing access token: {str(e)}")
+                logger.error("Error details:", exc_info=True)
+                delay = 30
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(account=None, refresh_token=None, client_id=None, client_secret=None):
+    """
+    The TokenProvider this process uses for *account* (default:
+    EMAIL_ADDRESS). Credentials not given default to the GMAIL_* settings.
+    """
+    account = account or settings.EMAIL_ADDRESS or ''
+    key = (account, settings.GMAIL_TOKEN_URI)
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            fetch = functools.partial(
+                request_token,
+                settings.GMAIL_TOKEN_URI,
+                refresh_token or settings.GMAIL_REFRESH_TOKEN,
+                client_id or settings.GMAIL_CLIENT_ID,
+                client_secret or settings.GMAIL_CLIENT_SECRET,
+            )
+            provider = _providers[key] = TokenProvider(account, fetch, margin=settings.OAUTH_REFRESH_MARGIN)
+    return provider
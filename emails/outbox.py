@@ -0,0 +1,207 @@
+"""
+Background sender for the web app's confirmation and unsubscribe emails.
+Views queue them and return; one thread per web worker process sends them
+over a single authenticated SMTP session that stays open between emails
+(until OUTBOX_IDLE_TIMEOUT seconds pass without one, or after
+SMTP_MAX_MESSAGES_PER_CONNECTION). Unsubscribe requests for the same
+address queued within OUTBOX_COALESCE_SECONDS of each other go out as one
+email with a link per list.
+
+The queue lives in memory: emails still queued when a worker is killed are
+lost, as they were when a request died halfway through sending.
+"""
+import logging
+import queue
+import threading
+import time
+
+import django.db
+from django.conf import settings
+from django.core.mail import get_connection
+
+from . import metrics
+from .utils import send_subscription_confirmation, subscription_confirmation_message, unsubscribe_message
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBE = 'subscribe'
+UNSUBSCRIBE = 'unsubscribe'
+
+
+class Outbox:
+    def __init__(self, coalesce=2, idle_timeout=60, queue_size=1000, max_messages=100):
+        self.coalesce = coalesce
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.queue = queue.Queue(queue_size)
+        self.stats = {'queued': 0, 'sent': 0, 'failed': 0, 'coalesced': 0, 'connections': 0}
+        self._connection = None
+        self._connection_messages = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        # Web threads queue while the outbox thread sends
+        with self._lock:
+            self.stats[key] += 1
+
+    def put(self, kind, email, mailing_lists):
+        """
+        Queue a SUBSCRIBE confirmation or UNSUBSCRIBE links for *email*. When
+        the queue is full the email is sent right away instead.
+        """
+        item = (kind, email, list(mailing_lists), time.monotonic())
+        self._start()
+        try:
+            self.queue.put_nowait(item)
+            self._count('queued')
+        except queue.Full:
+            logger.warning(f"Email outbox full, sending the {kind} email to {email} in the request")
+            self._build([item])[0][0].send()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='email-outbox', daemon=True)
+                self._thread.start()
+
+    def join(self):
+        """Wait until every queued email has been sent (or given up on)."""
+        self.queue.join()
+
+    def stop(self):
+        """Send what is queued, close the session and stop the thread."""
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._close()
+                continue
+            batch = [] if item is None else [item]
+            stopping = item is None
+            taken = 1
+            # Wait for more unsubscribe requests to fold in; everything else goes out with what is already queued
+            deadline = time.monotonic() + self.coalesce
+            while not stopping:
+                wait = deadline - time.monotonic() if any(kind == UNSUBSCRIBE for kind, *_ in batch) else 0
+                try:
+                    item = self.queue.get(timeout=wait) if wait > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                taken += 1
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+            try:
+                for message, queued_at in self._build(batch):
+                    self._send(message, queued_at)
+            except Exception as e:
+                logger.error(f"Error sending queued emails: {str(e)}")
+                logger.error("Error details:", exc_info=True)
+            finally:
+                django.db.connections.close_all()
+                for _ in range(taken):
+                    self.queue.task_done()
+            if stopping:
+                self._close()
+                return
+
+    def _build(self, batch):
+        """[(message, queued_at)] for *batch*, with one message per address for its unsubscribe requests."""
+        messages = []
+        unsubscribes = {}
+        for kind, email, mailing_lists, queued_at in batch:
+            if kind == SUBSCRIBE:
+                messages.append((subscription_confirmation_message(email, mailing_lists), queued_at))
+                continue
+            pending = unsubscribes.get(email.lower())
+            if pending is None:
+                unsubscribes[email.lower()] = [email, list(mailing_lists), queued_at]
+                continue
+            self._count('coalesced')
+            seen = {mailing_list.pk for mailing_list in pending[1]}
+            pending[1].extend(mailing_list for mailing_list in mailing_lists if mailing_list.pk not in seen)
+        for email, mailing_lists, queued_at in unsubscribes.values():
+            messages.append((unsubscribe_message(email, mailing_lists), queued_at))
+        return messages
+
+    def _send(self, message, queued_at):
+        """Send *message* on the open session, reconnecting once if it has gone stale."""
+        for attempt in (1, 2):
+            try:
+                if self._connection is None:
+                    self._connection = get_connection()
+                    self._connection.open()
+                    self._connection_messages = 0
+                    self._count('connections')
+                self._connection.send_messages([message])
+                break
+            except Exception as e:
+                self._close()
+                if attempt == 2:
+                    self._count('failed')
+                    logger.error(f"Error sending '{message.subject}' to {', '.join(message.to)}: {str(e)}")
+                    logger.error("Error details:", exc_info=True)
+                    return
+        self._count('sent')
+        metrics.WEB_EMAIL_QUEUE_SECONDS.observe(time.monotonic() - queued_at)
+        self._connection_messages += 1
+        if self._connection_messages >= self.max_messages:
+            self._close()
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception as e:
+                logger.warning(f"Error closing the outbox SMTP session: {str(e)}")
+            self._connection = None
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    """This process's Outbox, created on first use."""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox(
+                coalesce=settings.OUTBOX_COALESCE_SECONDS,
+                idle_timeout=settings.OUTBOX_IDLE_TIMEOUT,
+                queue_size=settings.OUTBOX_QUEUE_SIZE,
+                max_messages=settings.SMTP_MAX_MESSAGES_PER_CONNECTION,
+            )
+        return _outbox
+
+
+def reset_outbox():
+    """Stop this process's Outbox after sending what it has queued; the next email starts a new one."""
+    global _outbox
+    with _outbox_lock:
+        outbox, _outbox = _outbox, None
+    if outbox is not None:
+        outbox.stop()
+
+
+def queue_subscription_confirmation(email, mailing_lists):
+    if settings.WEB_EMAIL_OUTBOX:
+        get_outbox().put(SUBSCRIBE, email, mailing_lists)
+    else:
+        send_subscription_confirmation(email, mailing_lists)
+
+
+def queue_unsubscribe_email(email, mailing_lists):
+    """Links to leave each of *mailing_lists*, in one email."""
+    if settings.WEB_EMAIL_OUTBOX:
+        get_outbox().put(UNSUBSCRIBE, email, mailing_lists)
+    else:
+        unsubscribe_message(email, mailing_lists).send()
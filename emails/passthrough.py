@@ -0,0 +1,156 @@
+"""
+Forwarding without re-encoding: the original message's body bytes are kept
+as they arrived and only the top-level headers are rewritten, so nested
+multipart structures, charsets and transfer encodings survive untouched.
+Messages spooled to a file are streamed from it rather than loaded.
+"""
+import re
+import threading
+
+LINE_END_RE = re.compile(rb'\r?\n')
+
+# Original headers carried over verbatim; everything else (Received, DKIM-Signature,
+# the sender's From/To/Cc, ...) is dropped or rewritten for the list
+KEPT_HEADERS = {b'date', b'in-reply-to', b'mime-version'}
+
+
+def split_message(raw):
+    """
+    Split raw RFC822 bytes into ([(lowercase name, field bytes), ...], body).
+    Field bytes include the name, any folded continuation lines and the
+    trailing CRLF, exactly as they appeared in *raw*.
+    """
+    if raw.count(b'\n') != raw.count(b'\r\n'):
+        raw = LINE_END_RE.sub(b'\r\n', raw)
+
+    end = raw.find(b'\r\n\r\n')
+    if raw.startswith(b'\r\n'):
+        head, body = b'', raw[2:]
+    elif end == -1:
+        head, body = raw, b''
+    else:
+        head, body = raw[:end + 2], raw[end + 4:]
+
+    return parse_fields(head), body
+
+
+def parse_fields(head):
+    """[(lowercase name, field bytes), ...] for a CRLF-terminated header block."""
+    fields = []
+    for line in head.splitlines(keepends=True):
+        if line[:1] in (b' ', b'\t') and fields:
+            name, field = fields[-1]
+            fields[-1] = (name, field + line)
+        elif b':' in line:
+            fields.append((line.split(b':', 1)[0].strip().lower(), line))
+    return fields
+
+
+def read_head(fileobj):
+    """Read the header block from *fileobj*, leaving it positioned at the start of the body."""
+    lines = []
+    for line in iter(fileobj.readline, b''):
+        if line in (b'\r\n', b'\n'):
+            break
+        lines.append(line if line.endswith(b'\r\n') else line.rstrip(b'\n') + b'\r\n')
+    return b''.join(lines)
+
+
+def _value(field):
+    """The raw value of a header field, without its name or trailing CRLF."""
+    return field.split(b':', 1)[1].strip()
+
+
+class PassthroughMessage:
+    """
+    An incoming message prepared for header-only rewriting. The header block
+    for each list is built once; render() then only splices in the To line,
+    so per-subscriber work is a single bytes join.
+    """
+
+    def __init__(self, raw):
+        self._heads = {}
+        if isinstance(raw, bytes):
+            self.fields, self.body = split_message(raw)
+            self.eight_bit = not self.body.isascii()
+            return
+
+        # A spooled message: only the header block is read into memory
+        self.fields = parse_fields(read_head(raw))
+        self.body = None
+        self.body_file = raw
+        self.body_offset = raw.tell()
+        self._file_lock = threading.Lock()
+        self.eight_bit = not all(chunk.isascii() for chunk in self.body_chunks())
+
+    def body_chunks(self, size=1024 * 1024):
+        """Iterate over the body in *size* chunks; safe to use from several threads at once."""
+        if self.body is not None:
+            yield self.body
+            return
+        position = self.body_offset
+        while True:
+            with self._file_lock:
+                self.body_file.seek(position)
+                chunk = self.body_file.read(size)
+            if not chunk:
+                return
+            position += len(chunk)
+            yield chunk
+
+    def get(self, name):
+        """The raw value of the first *name* header, or None."""
+        name = name.lower().encode()
+        for field_name, field in self.fields:
+            if field_name == name:
+                return _value(field)
+        return None
+
+    def _list_head(self, alias):
+        head = self._heads.get(alias)
+        if head is not None:
+            return head
+
+        alias_bytes = alias.encode()
+        list_name = alias.split('@')[0].upper().encode()
+        lines = [
+            b'From: ' + alias_bytes + b'\r\n',
+            b'Subject: [' + list_name + b'] ' + (self.get('Subject') or b'') + b'\r\n',
+            b'Reply-To: ' + alias_bytes + b'\r\n',
+        ]
+
+        references = self.get('References')
+        message_id = self.get('Message-ID')
+        if references and message_id:
+            lines.append(b'References: ' + references + b'\r\n ' + message_id + b'\r\n')
+        elif references or message_id:
+            lines.append(b'References: ' + (references or message_id) + b'\r\n')
+
+        for name, field in self.fields:
+            if name in KEPT_HEADERS or name.startswith(b'content-'):
+                lines.append(field)
+
+        head = self._heads[alias] = b''.join(lines)
+        return head
+
+    def render(self, alias, to_addr):
+        """
+        Serialized bytes of this message forwarded through *alias* to
+        *to_addr*, or a StreamedMessage when the body is spooled to a file.
+        """
+        head = b''.join((self._list_head(alias), b'To: ', to_addr.encode(), b'\r\n\r\n'))
+        if self.body is None:
+            return StreamedMessage(head, self)
+        return head + self.body
+
+
+class StreamedMessage:
+    """A rendered message whose body is read from the spool as it is sent; see smtp.send_envelope()."""
+
+    def __init__(self, head, source):
+        self.head = head
+        self.source = source
+
+    def chunks(self):
+        yield self.head
+        yield from self.source.body_chunks()
@@ -0,0 +1,145 @@
+"""
+Thread stages connected by bounded queues. Each stage hands what it
+produces to the next one, so a slow stage (usually SMTP fan-out) works in
+parallel with the ones before it, and a full queue pushes back on them
+rather than letting work pile up in memory. Queue depth and service time
+are tracked per stage to show where the bottleneck is.
+"""
+import logging
+import queue
+import threading
+import time
+
+import django.db
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class Stage:
+    """
+    *workers* threads applying *handler* to the items put() on a queue of at
+    most *queue_size*. The handler returns the items for the *downstream*
+    stage (or None); they are put there before the item counts as done.
+    """
+
+    def __init__(self, name, handler, workers=1, queue_size=16, downstream=None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.downstream = downstream
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._busy = 0
+        self.stats = {'items': 0, 'errors': 0, 'service_seconds': 0.0, 'blocked_seconds': 0.0, 'max_queue_depth': 0}
+
+    def start(self):
+        for i in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, name=f'{self.name}-{len(self._threads)}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, item):
+        """Queue *item*, blocking while the stage is full; returns the seconds spent waiting."""
+        started = time.perf_counter()
+        self._queue.put(item)
+        waited = time.perf_counter() - started
+        with self._lock:
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self._queue.qsize())
+        return waited
+
+    def _work(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    self._queue.task_done()
+                    return
+                with self._lock:
+                    self._busy += 1
+                started = time.perf_counter()
+                try:
+                    outputs = self.handler(item) or ()
+                except Exception as e:
+                    outputs = ()
+                    with self._lock:
+                        self.stats['errors'] += 1
+                    logger.error(f"Error in {self.name} stage: {str(e)}")
+                    logger.error("Error details:", exc_info=True)
+                service = time.perf_counter() - started
+                blocked = 0.0
+                try:
+                    for output in outputs:
+                        blocked += self.downstream.put(output)
+                finally:
+                    with self._lock:
+                        self._busy -= 1
+                        self.stats['items'] += 1
+                        self.stats['service_seconds'] += service
+                        self.stats['blocked_seconds'] += blocked
+                    self._queue.task_done()
+        finally:
+            # Each thread has its own database connection
+            django.db.connections.close_all()
+
+    def join(self):
+        """Wait until every item put so far has been handled."""
+        self._queue.join()
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def snapshot(self):
+        with self._lock:
+            items = self.stats['items']
+            return {
+                'stage': self.name,
+                'workers': self.workers,
+                'busy': self._busy,
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self.stats['max_queue_depth'],
+                'items': items,
+                'errors': self.stats['errors'],
+                'mean_service_ms': round(self.stats['service_seconds'] / items * 1000, 1) if items else 0.0,
+                'blocked_seconds': round(self.stats['blocked_seconds'], 2),
+            }
+
+
+class Pipeline:
+    """
+    Stages built from (name, handler, workers) tuples, each feeding the next.
+    The caller put()s into the first stage and join()s to wait until every
+    stage has drained.
+    """
+
+    def __init__(self, stages, queue_size=16):
+        self.stages = []
+        downstream = None
+        for name, handler, workers in reversed(stages):
+            downstream = Stage(name, handler, workers, queue_size, downstream)
+            self.stages.insert(0, downstream)
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item):
+        return self.stages[0].put(item)
+
+    def join(self):
+        # Upstream stages only finish an item after handing on its outputs
+        for stage in self.stages:
+            stage.join()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def snapshot(self):
+        return [stage.snapshot() for stage in self.stages]
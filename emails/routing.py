@@ -0,0 +1,105 @@
+"""
+In-memory alias -> active subscribers table for the daemon, so routing a
+message needs no queries. Every change to lists or subscriptions bumps a
+per-list RoutingVersion row (see emails.signals), in whichever process made
+it; refresh() compares those counters in one query and reloads only the
+lists that changed.
+"""
+import logging
+import threading
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import MailingList, RoutingVersion
+
+logger = logging.getLogger(__name__)
+
+
+def bump_routing_version(mailing_list_ids):
+    """Record that the routing of each list in *mailing_list_ids* has changed."""
+    ids = set(mailing_list_ids)
+    if not ids:
+        return
+    with transaction.atomic():
+        existing = set(
+            RoutingVersion.objects.filter(mailing_list_id__in=ids).values_list('mailing_list_id', flat=True)
+        )
+        RoutingVersion.objects.filter(mailing_list_id__in=existing).update(version=F('version') + 1)
+        for mailing_list_id in ids - existing:
+            try:
+                with transaction.atomic():
+                    RoutingVersion.objects.create(mailing_list_id=mailing_list_id, version=1)
+            except IntegrityError:
+                # Created concurrently by another process
+                RoutingVersion.objects.filter(mailing_list_id=mailing_list_id).update(version=F('version') + 1)
+
+
+class ListRoute:
+    """A mailing list as seen by the router: its alias and active subscriber addresses."""
+
+    __slots__ = ('pk', 'alias', 'subscribers')
+
+    def __init__(self, pk, alias, subscribers=()):
+        self.pk = pk
+        self.alias = alias
+        self.subscribers = tuple(subscribers)
+
+    def iter_active_subscriber_emails(self, chunk_size=None):
+        """Same contract as MailingList.iter_active_subscriber_emails(), served from memory."""
+        return iter(self.subscribers)
+
+    def __str__(self):
+        return self.alias
+
+
+class RoutingTable:
+    def __init__(self):
+        self._routes = {}  # alias -> ListRoute
+        self._versions = None  # mailing_list_id -> version at last load
+        self._lock = threading.Lock()
+        self.stats = {'full_loads': 0, 'partial_loads': 0}
+
+    def _load(self, pks=None):
+        """ListRoutes for all lists, or only those in *pks*, in one query."""
+        queryset = MailingList.objects.all()
+        if pks is not None:
+            queryset = queryset.filter(pk__in=pks)
+        routes = {}
+        rows = queryset.order_by('pk', 'subscribers__pk').values_list(
+            'pk', 'alias', 'subscribers__email', 'subscribers__is_active'
+        )
+        for pk, alias, email, is_active in rows:
+            route = routes.setdefault(pk, (alias, []))
+            if email and is_active:
+                route[1].append(email)
+        return {pk: ListRoute(pk, alias, emails) for pk, (alias, emails) in routes.items()}
+
+    def refresh(self):
+        """Bring the table up to date: one query when nothing changed, plus one to reload changed lists."""
+        versions = dict(RoutingVersion.objects.values_list('mailing_list_id', 'version'))
+        with self._lock:
+            if self._versions is None:
+                loaded = self._load()
+                self._routes = {route.alias: route for route in loaded.values()}
+                self.stats['full_loads'] += 1
+                logger.info(f"Loaded routing for {len(self._routes)} mailing lists")
+            else:
+                changed = {pk for pk, version in versions.items() if self._versions.get(pk) != version}
+                if not changed:
+                    self._versions = versions
+                    return
+                loaded = self._load(changed)
+                routes = {alias: route for alias, route in self._routes.items() if route.pk not in changed}
+                routes.update((route.alias, route) for route in loaded.values())
+                self._routes = routes
+                self.stats['partial_loads'] += 1
+                logger.info(f"Reloaded routing for {len(changed)} changed mailing lists")
+            self._versions = versions
+
+    def lookup(self, alias):
+        """The ListRoute for *alias*, or None if no such list was loaded."""
+        return self._routes.get(alias)
+
+    def __len__(self):
+        return len(self._routes)
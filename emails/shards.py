@@ -0,0 +1,63 @@
+"""
+Mailbox shards: each watched account/folder pair, with its own OAuth2
+credentials and, optionally, the set of list aliases it forwards. Without
+MAILBOX_SHARDS the daemon has a single shard, EMAIL_ADDRESS's INBOX.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .oauth import get_provider
+
+
+class Shard:
+    __slots__ = ('name', 'account', 'folder', 'aliases', 'refresh_token', 'client_id', 'client_secret')
+
+    def __init__(self, name, account, folder='INBOX', aliases=None,
+                 refresh_token=None, client_id=None, client_secret=None):
+        self.name = name
+        self.account = account
+        self.folder = folder
+        # None forwards every list; otherwise only these aliases
+        self.aliases = None if aliases is None else {alias.lower() for alias in aliases}
+        self.refresh_token = refresh_token or settings.GMAIL_REFRESH_TOKEN
+        self.client_id = client_id or settings.GMAIL_CLIENT_ID
+        self.client_secret = client_secret or settings.GMAIL_CLIENT_SECRET
+
+    def handles(self, alias):
+        """Whether mail to the list *alias* is forwarded by this shard."""
+        return self.aliases is None or alias.lower() in self.aliases
+
+    def token_provider(self):
+        return get_provider(self.account, self.refresh_token, self.client_id, self.client_secret)
+
+    def __str__(self):
+        return f"{self.name} ({self.account}/{self.folder})"
+
+
+def get_shards():
+    """The configured shards; raises ImproperlyConfigured for duplicate names or mailboxes."""
+    if not settings.MAILBOX_SHARDS:
+        return [Shard('default', settings.EMAIL_ADDRESS)]
+
+    shards = []
+    for config in settings.MAILBOX_SHARDS:
+        try:
+            shards.append(Shard(**config))
+        except TypeError as e:
+            raise ImproperlyConfigured(f"Invalid MAILBOX_SHARDS entry {config!r}: {e}")
+
+    names = [shard.name for shard in shards]
+    mailboxes = [(shard.account, shard.folder) for shard in shards]
+    if len(set(names)) != len(names):
+        raise ImproperlyConfigured("MAILBOX_SHARDS names must be unique")
+    # The checkpoint is kept per mailbox, so two shards must never read the same one
+    if len(set(mailboxes)) != len(mailboxes):
+        raise ImproperlyConfigured("MAILBOX_SHARDS must not list the same account and folder twice")
+    return shards
+
+
+def get_shard(name):
+    for shard in get_shards():
+        if shard.name == name:
+            return shard
+    raise ImproperlyConfigured(f"No mailbox shard named {name!r}")
@@ -0,0 +1,34 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .models import MailingList, Subscriber
+from .routing import bump_routing_version
+
+
+@receiver(post_save, sender=MailingList)
+@receiver(post_delete, sender=MailingList)
+def mailing_list_changed(sender, instance, **kwargs):
+    bump_routing_version([instance.pk])
+
+
+@receiver(post_save, sender=Subscriber)
+@receiver(pre_delete, sender=Subscriber)
+def subscriber_changed(sender, instance, **kwargs):
+    # pre_delete: the subscriptions are gone by post_delete
+    if instance.pk:
+        bump_routing_version(instance.mailing_lists.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Subscriber.mailing_lists.through)
+def subscriptions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # instance is a MailingList
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            bump_routing_version([instance.pk])
+    elif action == 'pre_clear':
+        # Remember which lists lose the subscriber; post_clear no longer knows
+        instance._cleared_list_pks = list(instance.mailing_lists.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        bump_routing_version(getattr(instance, '_cleared_list_pks', ()))
+    elif action in ('post_add', 'post_remove'):
+        bump_routing_version(pk_set or ())
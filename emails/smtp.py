@@ -0,0 +1,437 @@
+import queue
+import smtplib
+import threading
+import time
+import logging
+from concurrent.futures import Future
+from datetime import datetime
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPDataLost(smtplib.SMTPServerDisconnected):
+    """The connection dropped after DATA began, so the server may already have accepted the message."""
+
+
+def send_envelope(smtp, from_addr, recipients, data, mail_options=()):
+    """
+    Deliver the already-serialized *data* to many *recipients* in a single
+    SMTP transaction. When the server advertises PIPELINING, MAIL FROM and
+    every RCPT TO go out in one write and their replies are read afterwards.
+    Returns {recipient: (code, response)} for refused recipients; DATA is
+    skipped (and the transaction reset) when nobody was accepted.
+    *mail_options* (e.g. 'BODY=8BITMIME') are appended to MAIL FROM;
+    BODY=8BITMIME is dropped when the server does not advertise 8BITMIME.
+    """
+    recipients = list(recipients)
+    if not smtp.has_extn('8bitmime'):
+        mail_options = [option for option in mail_options if option.upper() != 'BODY=8BITMIME']
+    commands = [' '.join([f'MAIL FROM:{smtplib.quoteaddr(from_addr)}', *mail_options])]
+    commands += [f'RCPT TO:{smtplib.quoteaddr(rcpt)}' for rcpt in recipients]
+
+    if smtp.has_extn('pipelining'):
+        smtp.send(''.join(command + '\r\n' for command in commands))
+        replies = [smtp.getreply() for _ in commands]
+    else:
+        replies = []
+        for command in commands:
+            smtp.send(command + '\r\n')
+            replies.append(smtp.getreply())
+            if len(replies) == 1 and replies[0][0] != 250:
+                break
+
+    code, response = replies[0]
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, response, from_addr)
+
+    refused = {
+        rcpt: reply for rcpt, reply in zip(recipients, replies[1:])
+        if reply[0] not in (250, 251)
+    }
+    if len(refused) == len(recipients):
+        smtp.rset()
+        return refused
+
+    try:
+        if hasattr(data, 'chunks'):
+            code, response = _stream_data(smtp, data.chunks())
+        else:
+            code, response = smtp.data(data)
+    except smtplib.SMTPServerDisconnected as e:
+        raise SMTPDataLost(str(e)) from e
+    except smtplib.SMTPException:
+        raise
+    except OSError as e:
+        raise SMTPDataLost(str(e)) from e
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+def _dot_stuffed(chunks, max_line=1024 * 1024):
+    """Escape lines starting with '.' across arbitrary chunk boundaries (RFC 5321 4.5.2)."""
+    at_line_start = True
+    carry = b''
+    for chunk in chunks:
+        data = carry + chunk
+        cut = data.rfind(b'\n') + 1
+        if not cut and len(data) < max_line:
+            carry = data
+            continue
+        if not cut:
+            # An overlong line: pass it on without waiting for its end
+            cut = len(data)
+        data, carry = data[:cut], data[cut:]
+        if at_line_start and data.startswith(b'.'):
+            data = b'.' + data
+        yield data.replace(b'\n.', b'\n..')
+        at_line_start = data.endswith(b'\n')
+    if carry:
+        if at_line_start and carry.startswith(b'.'):
+            carry = b'.' + carry
+        yield carry.replace(b'\n.', b'\n..')
+
+
+def _stream_data(smtp, chunks):
+    """smtplib.SMTP.data() for a message produced in chunks, so it is never held in memory whole."""
+    code, response = smtp.docmd('DATA')
+    if code != 354:
+        raise smtplib.SMTPDataError(code, response)
+    last = b''
+    for piece in _dot_stuffed(chunks):
+        if piece:
+            smtp.send(piece)
+            last = piece
+    smtp.send(b'.\r\n' if last.endswith(b'\r\n') else b'\r\n.\r\n')
+    return smtp.getreply()
+
+
+class PooledConnection:
+    def __init__(self, smtp, expires_at=None):
+        self.smtp = smtp
+        self.expires_at = expires_at  # naive UTC expiry of the token it authenticated with
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages_sent = 0
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except OSError:
+            try:
+                self.smtp.close()
+            except OSError:
+                pass
+
+
+class SMTPConnectionPool:
+    """
+    Keeps authenticated SMTP sessions warm between forwards.
+
+    *connect* returns an (smtplib.SMTP, token_expiry) pair for a freshly
+    authenticated session. Idle sessions are health-checked with NOOP
+    before reuse and recycled once their token has expired, after
+    *max_messages* messages, or when idle for longer than *max_idle*
+    seconds. With size=0 nothing is kept between sessions, so every
+    session() performs a full handshake.
+    """
+
+    def __init__(self, connect, size=2, max_messages=100, max_idle=240):
+        self._connect = connect
+        self.size = size
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self.stats = {'handshakes': 0, 'reused': 0, 'recycled': 0, 'broken': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _is_reusable(self, conn):
+        if conn.messages_sent >= self.max_messages:
+            return False
+        if conn.expires_at and datetime.utcnow() >= conn.expires_at:
+            return False
+        return time.monotonic() - conn.last_used <= self.max_idle
+
+    def _is_alive(self, conn):
+        try:
+            return conn.smtp.noop()[0] == 250
+        except OSError:
+            return False
+
+    def acquire(self):
+        """Return a healthy pooled session, opening a new one if none is idle."""
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                break
+            if self._is_reusable(conn) and self._is_alive(conn):
+                self._count('reused')
+                return conn
+            self._count('recycled')
+            conn.close()
+
+        smtp, expires_at = self._connect()
+        self._count('handshakes')
+        return PooledConnection(smtp, expires_at)
+
+    def release(self, conn, reset=False):
+        """Return *conn* to the pool; reset=True clears a half-finished transaction with RSET."""
+        conn.last_used = time.monotonic()
+        if reset:
+            try:
+                conn.smtp.rset()
+            except OSError:
+                self.discard(conn)
+                return
+        with self._lock:
+            if len(self._idle) < self.size and self._is_reusable(conn):
+                self._idle.append(conn)
+                return
+        self._count('recycled')
+        conn.close()
+
+    def discard(self, conn):
+        """Throw away a session that failed mid-use."""
+        self._count('broken')
+        try:
+            conn.smtp.close()
+        except OSError:
+            pass
+
+    def session(self):
+        """Borrow pooled connections for a run of sends: `with pool.session() as session: ...`."""
+        return PoolSession(self)
+
+    def send_message(self, msg, from_addr=None, to_addrs=None):
+        with self.session() as session:
+            return session.send_message(msg, from_addr, to_addrs)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class PoolSession:
+    """
+    Holds one pooled connection across consecutive sends, swapping it for a
+    fresh one when it reaches the pool's per-connection message cap or the
+    server drops it.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def release(self):
+        """Hand the held connection back to the pool; the next send borrows a new one."""
+        if self.conn is not None:
+            self.pool.release(self.conn)
+            self.conn = None
+
+    def _connection(self):
+        if self.conn is not None and self.conn.messages_sent >= self.pool.max_messages:
+            self.pool.release(self.conn)
+            self.conn = None
+        if self.conn is None:
+            self.conn = self.pool.acquire()
+        return self.conn
+
+    def send_message(self, msg, from_addr=None, to_addrs=None):
+        """
+        Send *msg* (smtplib.send_message semantics) and return the
+        refused-recipients dict. Not retried: smtplib does not say whether a
+        dropped connection had already taken the message.
+        """
+        return self._send(lambda smtp: smtp.send_message(msg, from_addr, to_addrs), retry=False)
+
+    def send_envelope(self, from_addr, recipients, data, mail_options=()):
+        """Deliver serialized *data* to all *recipients* in one transaction; see send_envelope()."""
+        return self._send(lambda smtp: send_envelope(smtp, from_addr, recipients, data, mail_options))
+
+    def _send(self, transaction, retry=True):
+        """
+        Run one mail transaction on the held connection. A connection the
+        server has silently dropped before DATA is replaced and the
+        transaction retried once; a drop once DATA began raises SMTPDataLost
+        instead, since the server may have accepted the message already.
+        """
+        for attempt in (1, 2) if retry else (2,):
+            conn = self._connection()
+            started = time.perf_counter()
+            try:
+                result = transaction(conn.smtp)
+            except SMTPDataLost:
+                self.pool.discard(conn)
+                self.conn = None
+                raise
+            except smtplib.SMTPServerDisconnected:
+                dropped = True
+            except smtplib.SMTPException:
+                # A protocol-level refusal: clear the transaction so the connection stays usable
+                try:
+                    conn.smtp.rset()
+                except OSError:
+                    self.pool.discard(conn)
+                    self.conn = None
+                raise
+            except OSError:
+                # SMTPException subclasses OSError, so this only sees socket errors
+                dropped = True
+            else:
+                dropped = False
+            if dropped:
+                self.pool.discard(conn)
+                self.conn = None
+                if attempt == 2:
+                    raise smtplib.SMTPServerDisconnected('SMTP connection lost' + (' twice in a row' if retry else ''))
+                logger.warning("Pooled SMTP connection was dropped, retrying on a new one")
+                continue
+            conn.messages_sent += 1
+            metrics.SMTP_SEND_SECONDS.observe(time.perf_counter() - started)
+            return result
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: refills at *rate* tokens per second up to
+    *burst*. acquire() reserves tokens immediately and sleeps off any
+    deficit, so concurrent callers are served in arrival order.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._level = burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take *tokens* without waiting; returns the seconds the caller must wait before using them."""
+        with self._lock:
+            now = self._clock()
+            self._level = min(self.burst, self._level + (now - self._updated) * self.rate)
+            self._updated = now
+            self._level -= min(tokens, self.burst)
+            return max(0.0, -self._level / self.rate)
+
+    def acquire(self, tokens=1):
+        """Take *tokens*, blocking until they are available; returns the seconds waited."""
+        wait = self.reserve(tokens)
+        if wait:
+            self._sleep(wait)
+        return wait
+
+
+class SenderPool:
+    """
+    A fixed set of sender threads, each holding its own authenticated session
+    from *pool*, fed from a bounded queue of envelopes. submit() blocks while
+    the queue is full and returns a Future resolving to the refused-recipients
+    dict of send_envelope(). An optional *limiter* (TokenBucket) is charged
+    one token per recipient before every transaction, which caps the
+    aggregate rate across all workers.
+    """
+
+    def __init__(self, pool, workers=4, queue_size=100, limiter=None):
+        self.pool = pool
+        self.workers = workers
+        self.limiter = limiter
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started_at = None
+        self.stats = {
+            'submitted': 0, 'sent': 0, 'failed': 0, 'recipients': 0, 'refused': 0,
+            'throttled_seconds': 0.0, 'max_queue_depth': 0,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._started_at = time.monotonic()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'smtp-sender-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, from_addr, recipients, data, mail_options=()):
+        """Queue one envelope for delivery; returns a Future."""
+        self.start()
+        future = Future()
+        self._queue.put((future, from_addr, list(recipients), data, mail_options))
+        with self._lock:
+            self.stats['submitted'] += 1
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self._queue.qsize())
+        return future
+
+    def _work(self):
+        session = self.pool.session()
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    break
+                future, from_addr, recipients, data, mail_options = job
+                del job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                waited = self.limiter.acquire(len(recipients)) if self.limiter else 0
+                try:
+                    refused = session.send_envelope(from_addr, recipients, data, mail_options)
+                except Exception as e:
+                    with self._lock:
+                        self.stats['failed'] += 1
+                        self.stats['throttled_seconds'] += waited
+                    future.set_exception(e)
+                else:
+                    with self._lock:
+                        self.stats['sent'] += 1
+                        self.stats['recipients'] += len(recipients) - len(refused)
+                        self.stats['refused'] += len(refused)
+                        self.stats['throttled_seconds'] += waited
+                    future.set_result(refused)
+                del future, data
+                if self._queue.empty():
+                    # Let idle sessions go back to the pool (and its idle/expiry checks)
+                    session.release()
+        finally:
+            session.release()
+
+    def snapshot(self):
+        """Current stats plus queue depth and delivered recipients per second since start."""
+        with self._lock:
+            stats = dict(self.stats)
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0
+        stats['queue_depth'] = self._queue.qsize()
+        stats['workers'] = len(self._threads)
+        stats['recipients_per_sec'] = round(stats['recipients'] / elapsed, 1) if elapsed else 0.0
+        return stats
+
+    def close(self):
+        """Finish queued envelopes, then stop the workers."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,202 @@
+"""
+One daemon process per mailbox shard. The supervisor restarts a shard
+whose process exits, with exponential backoff kept per shard so one
+crash-looping mailbox does not hold up the others, and logs the counters
+each worker reports every SHARD_STATS_INTERVAL seconds.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+import django.db
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# A shard that ran this long before exiting is restarted without backoff
+HEALTHY_RUN = 60
+
+
+def run_shard(shard, idle, engine, reports, interval, metrics_port=None, profiling=None):
+    """
+    Worker process: run the daemon for *shard*, putting its snapshot() on
+    *reports* every *interval* seconds and serving its metrics on *metrics_port*.
+    *profiling* overrides the daemon's profiler options.
+    """
+    from .async_daemon import AsyncEmailDaemon
+    from .email_daemon import EmailDaemon
+
+    # The supervisor stops workers with SIGTERM; exit through the daemon's cleanup (e.g. releasing its lease)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    daemon = AsyncEmailDaemon(shard) if engine == 'async' else EmailDaemon(shard)
+    daemon.metrics_port = metrics_port
+    daemon.profiler.configure(**(profiling or {}))
+
+    def report():
+        while True:
+            time.sleep(interval)
+            reports.put((shard.name, daemon.snapshot()))
+
+    threading.Thread(target=report, name='shard-stats', daemon=True).start()
+    daemon.run(idle=idle)
+
+
+class ShardWorker:
+    """The process running one shard, and its restart bookkeeping."""
+
+    __slots__ = ('shard', 'process', 'started_at', 'restarts', 'failures', 'next_start', 'last_report')
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.failures = 0  # consecutive exits soon after starting
+        self.next_start = 0.0
+        self.last_report = {}
+
+
+class ShardSupervisor:
+    def __init__(self, shards, idle=False, engine='sync', profiling=None):
+        self.idle = idle
+        self.engine = engine
+        self.profiling = profiling
+        self.workers = {shard.name: ShardWorker(shard) for shard in shards}
+        # Served on METRICS_PORT; shard i serves its own on METRICS_PORT + 1 + i
+        self.metrics = metrics.Registry()
+        self.shard_up = metrics.Gauge('emaildaemon_shard_up', 'Whether the shard process is running',
+                                      labels=('shard',), registry=self.metrics)
+        self.shard_restarts = metrics.Gauge('emaildaemon_shard_restarts', 'Times the shard process was restarted',
+                                            labels=('shard',), registry=self.metrics)
+        self.shard_processed = metrics.Gauge('emaildaemon_shard_processed', 'New emails the shard reported processing',
+                                             labels=('shard',), registry=self.metrics)
+        self._context = multiprocessing.get_context('fork')
+        self.reports = self._context.Queue()
+        self._stopping = False
+
+    def _start(self, worker):
+        # Children must not share the parent's database connections
+        django.db.connections.close_all()
+        metrics_port = None
+        if settings.METRICS_PORT:
+            metrics_port = settings.METRICS_PORT + 1 + list(self.workers).index(worker.shard.name)
+        worker.process = self._context.Process(
+            target=run_shard,
+            args=(worker.shard, self.idle, self.engine, self.reports, settings.SHARD_STATS_INTERVAL, metrics_port,
+                  self.profiling),
+            name=f"shard-{worker.shard.name}",
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        logger.info(f"Started shard {worker.shard} as process {worker.process.pid}")
+
+    def _reap(self, worker, now):
+        """Schedule a restart for *worker* if its process has exited."""
+        if worker.process is None or worker.process.is_alive():
+            return
+        exitcode = worker.process.exitcode
+        worker.process.join()
+        worker.process = None
+        if now - worker.started_at >= HEALTHY_RUN:
+            worker.failures = 0
+        delay = min(settings.SHARD_RESTART_BACKOFF_MAX, settings.SHARD_RESTART_BACKOFF_MIN * 2 ** worker.failures)
+        worker.failures += 1
+        worker.restarts += 1
+        worker.next_start = now + delay
+        logger.error(f"Shard {worker.shard} exited with code {exitcode}, restarting in {delay} seconds")
+
+    def _collect(self, timeout):
+        """Take the workers' reports, waiting up to *timeout* seconds for the first, and update the shard gauges."""
+        try:
+            while True:
+                name, report = self.reports.get(timeout=timeout)
+                self.workers[name].last_report = report
+                timeout = 0
+        except queue.Empty:
+            pass
+        for name, worker in self.workers.items():
+            self.shard_up.set(int(worker.process is not None and worker.process.is_alive()), name)
+            self.shard_restarts.set(worker.restarts, name)
+            self.shard_processed.set(worker.last_report.get('processed', 0), name)
+
+    def snapshot(self):
+        """Per-shard reports with process state, and totals across shards."""
+        shards = {}
+        totals = {'running': 0, 'restarts': 0, 'checks': 0, 'processed': 0, 'errors': 0}
+        for name, worker in self.workers.items():
+            running = worker.process is not None and worker.process.is_alive()
+            shards[name] = dict(
+                worker.last_report,
+                running=running,
+                pid=worker.process.pid if running else None,
+                restarts=worker.restarts,
+            )
+            totals['running'] += running
+            totals['restarts'] += worker.restarts
+            for key in ('checks', 'processed', 'errors'):
+                totals[key] += worker.last_report.get(key, 0)
+        return {'shards': shards, 'totals': totals}
+
+    def _log_stats(self):
+        snapshot = self.snapshot()
+        totals = snapshot['totals']
+        per_shard = ', '.join(f"{name} {report.get('processed', 0)}" for name, report in snapshot['shards'].items())
+        logger.info(
+            f"Shards: {totals['running']}/{len(self.workers)} running, {totals['restarts']} restarts, "
+            f"{totals['processed']} emails processed ({per_shard}), {totals['errors']} errors"
+        )
+
+    def _handle_signal(self, signum, frame):
+        self._stopping = True
+
+    def _forward_signal(self, signum, frame):
+        """Pass the profiling signals (SIGUSR1/SIGUSR2) on to every shard process."""
+        for worker in self.workers.values():
+            if worker.process is not None and worker.process.is_alive():
+                os.kill(worker.process.pid, signum)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGUSR1, self._forward_signal)
+        signal.signal(signal.SIGUSR2, self._forward_signal)
+        shards = ', '.join(str(worker.shard) for worker in self.workers.values())
+        logger.info(f"Supervising {len(self.workers)} shards: {shards}")
+        if settings.METRICS_PORT and metrics.REGISTRY.enabled:
+            metrics.serve(settings.METRICS_PORT, settings.METRICS_HOST, self.metrics)
+        next_stats = time.monotonic() + settings.SHARD_STATS_INTERVAL
+        try:
+            while not self._stopping:
+                now = time.monotonic()
+                for worker in self.workers.values():
+                    self._reap(worker, now)
+                    if worker.process is None and now >= worker.next_start:
+                        self._start(worker)
+                self._collect(timeout=1)
+                if time.monotonic() >= next_stats:
+                    self._log_stats()
+                    next_stats = time.monotonic() + settings.SHARD_STATS_INTERVAL
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Terminate every shard process and wait for it to exit."""
+        for worker in self.workers.values():
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers.values():
+            if worker.process is not None:
+                worker.process.join(timeout=10)
+                if worker.process.is_alive():
+                    worker.process.kill()
+                    worker.process.join()
+                worker.process = None
+        logger.info("All shards stopped")
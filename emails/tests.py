@@ -1,3 +1,775 @@
-from django.test import TestCase
+import asyncio
+import functools
+import multiprocessing
+import os
+import smtplib
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import timedelta
+from email import message_from_bytes
+from unittest import mock
 
-# Create your tests here.
+from django.core import mail
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from .aio import AsyncSMTPClient, AsyncSMTPPool
+from .async_daemon import AsyncEmailDaemon
+from .benchmarks import _serve_stress
+from .email_daemon import EmailDaemon
+from .fakes import (
+    TLS_CERT_FILE, FakeIMAPServer, FakeMailbox, FakeSMTPServer, FakeTokenServer, FixedTokenProvider, make_message,
+)
+from .delivery import DeliveryRecorder, enqueue
+from .leases import LeaseLost
+from .models import (
+    Delivery, MailboxCheckpoint, MailingList, OAuthToken, OutboundChunk, RoutingVersion, ShardLease, Subscriber,
+)
+from .oauth import TokenProvider, request_token
+from .outbox import SUBSCRIBE, UNSUBSCRIBE, Outbox
+from .routing import RoutingTable
+from .shards import Shard
+from .smtp import SMTPConnectionPool, SMTPDataLost, send_envelope
+
+ALIAS = 'stress@cyphy.life'
+
+
+def _daemon_settings(imap_port, smtp_port, **overrides):
+    return override_settings(**{
+        'IMAP_SERVER': '127.0.0.1', 'IMAP_PORT': imap_port, 'IMAP_USE_SSL': False,
+        'SMTP_SERVER': '127.0.0.1', 'SMTP_PORT': smtp_port, 'SMTP_USE_TLS': False,
+        'EMAIL_ADDRESS': '', 'DELIVERY_QUEUE': False, 'SMTP_RATE_LIMIT': None, **overrides,
+    })
+
+
+def _check_once():
+    """Run one check cycle of a fresh daemon and return the number of messages processed."""
+    daemon = EmailDaemon()
+    daemon.tokens = FixedTokenProvider()
+    try:
+        return daemon.check_emails()
+    finally:
+        daemon.session.close()
+        daemon.smtp_pool.close()
+
+
+class LargeMessageTests(TestCase):
+    """Messages over IMAP_SPOOL_THRESHOLD are spooled to disk and streamed to SMTP."""
+
+    def setUp(self):
+        mailing_list = MailingList.objects.create(alias=ALIAS)
+        for i in range(2):
+            Subscriber.objects.create(email=f'subscriber{i}@example.com').mailing_lists.add(mailing_list)
+
+    def _start_checkpoint(self, uidvalidity):
+        MailboxCheckpoint.objects.all().delete()
+        MailboxCheckpoint.objects.create(account='', folder='INBOX', uidvalidity=uidvalidity, last_uid=0)
+
+    def _assert_memory_bounded(self, **overrides):
+        message_size = 16 * 1024 * 1024
+        # The stand-in servers run in a child process so only the daemon's allocations are traced
+        context = multiprocessing.get_context('fork')
+        parent_conn, child_conn = context.Pipe()
+        child = context.Process(target=_serve_stress, args=(child_conn, 2, message_size, ALIAS), daemon=True)
+        child.start()
+        try:
+            imap_port, smtp_port, uidvalidity = parent_conn.recv()
+            self._start_checkpoint(uidvalidity)
+            with _daemon_settings(imap_port, smtp_port, IMAP_SPOOL_THRESHOLD=1024 * 1024, **overrides):
+                tracemalloc.start()
+                try:
+                    processed = _check_once()
+                    _, peak = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+        finally:
+            parent_conn.send('stop')
+            smtp_stats = parent_conn.recv()
+            child.join()
+
+        self.assertEqual(processed, 2)
+        self.assertEqual(smtp_stats['messages'], 4)
+        self.assertGreater(smtp_stats['bytes'], 4 * message_size)
+        # Two 16 MB messages forwarded twice each, without ever holding one in memory
+        self.assertLess(peak, message_size / 2)
+
+    def test_spooled_message_memory_stays_bounded(self):
+        self._assert_memory_bounded()
+
+    def test_queued_spooled_message_memory_stays_bounded(self):
+        # Queued in DELIVERY_CHUNK_SIZE rows and drained through a spool file again
+        self._assert_memory_bounded(DELIVERY_QUEUE=True)
+        # 16 MB plus headers: 17 rows of 1 MB per message, none of it in OutboundMessage.raw
+        self.assertEqual(OutboundChunk.objects.count(), 2 * 17)
+
+    def test_spooled_message_forwards_byte_for_byte(self):
+        line = b'QUJDREVGR0hJSktMTU5PUFFSU1RVVldYWVphYmNkZWZnaGlqa2xtbm9wcXJzdHV2d3h5ejAxMjM0\r\n'
+        chunk = 1024 * 1024
+        body = b'.leading dot\r\n..two dots\r\n.\r\n' + line * 100
+        # A dot line starting exactly on the first 1 MB chunk boundary of the spooled body...
+        body += line * ((chunk - len(body)) // len(line))
+        body += b'x' * (chunk - len(body) - 2) + b'\r\n.on the boundary\r\n'
+        # ...and one right after a CRLF split across the second
+        body += line * ((2 * chunk - len(body)) // len(line))
+        body += b'y' * (2 * chunk - len(body) - 1) + b'\r\n.after a split CRLF\r\n' + line * 10 + b'.\r\n'
+        head = (
+            b'Received: from mx.example.com by mx.google.com\r\n'
+            b'DKIM-Signature: v=1; a=rsa-sha256; d=example.com\r\n'
+            b'From: Sender <sender@example.com>\r\n'
+            b'To: ' + ALIAS.encode() + b'\r\n'
+            b'Subject: Quarterly report\r\n'
+            b'Date: Mon, 05 Oct 2026 09:30:00 +0000\r\n'
+            b'Message-ID: <report@example.com>\r\n'
+            b'MIME-Version: 1.0\r\n'
+            b'Content-Type: text/plain;\r\n charset="us-ascii"\r\n'
+            b'Content-Transfer-Encoding: 7bit\r\n'
+        )
+        raw = head + b'\r\n' + body
+
+        forwarded = {}
+        for mode, threshold, queued in (('spooled', 64 * 1024, False), ('queued', 64 * 1024, True),
+                                        ('in-memory', None, False)):
+            mailbox = FakeMailbox()
+            mailbox.append(raw)
+            with FakeIMAPServer(mailbox=mailbox) as imap_server, FakeSMTPServer() as smtp_server:
+                self._start_checkpoint(mailbox.uidvalidity)
+                with _daemon_settings(imap_server.port, smtp_server.port, MESSAGE_DEDUP=False,
+                                      FORWARD_PASSTHROUGH=True, IMAP_SPOOL_THRESHOLD=threshold,
+                                      DELIVERY_QUEUE=queued, DELIVERY_CHUNK_SIZE=256 * 1024):
+                    self.assertEqual(_check_once(), 1)
+                forwarded[mode] = {tuple(recipients): data for _, recipients, data in smtp_server.messages}
+
+        self.assertEqual(forwarded['spooled'], forwarded['in-memory'])
+        self.assertEqual(forwarded['queued'], forwarded['in-memory'])
+        self.assertEqual(sorted(forwarded['spooled']), [('subscriber0@example.com',), ('subscriber1@example.com',)])
+        data = forwarded['spooled'][('subscriber0@example.com',)]
+        forwarded_head, _, forwarded_body = data.partition(b'\r\n\r\n')
+        self.assertEqual(forwarded_body, body)
+        self.assertEqual(forwarded_head.split(b'\r\n', 3)[:3], [
+            b'From: ' + ALIAS.encode(),
+            b'Subject: [STRESS] Quarterly report',
+            b'Reply-To: ' + ALIAS.encode(),
+        ])
+        for kept in (b'Date: Mon, 05 Oct 2026 09:30:00 +0000\r\n', b'MIME-Version: 1.0\r\n',
+                     b'Content-Type: text/plain;\r\n charset="us-ascii"\r\n', b'Content-Transfer-Encoding: 7bit\r\n',
+                     b'To: subscriber0@example.com'):
+            self.assertIn(kept, forwarded_head + b'\r\n')
+        self.assertNotIn(b'Received:', forwarded_head)
+        self.assertNotIn(b'DKIM-Signature:', forwarded_head)
+
+
+class ReplicaTests(TestCase):
+    """Two replicas of one shard sharing the database: each message goes out exactly once."""
+
+    def setUp(self):
+        mailing_list = MailingList.objects.create(alias=ALIAS)
+        for i in range(2):
+            Subscriber.objects.create(email=f'subscriber{i}@example.com').mailing_lists.add(mailing_list)
+        self.mailbox = FakeMailbox()
+        MailboxCheckpoint.objects.create(account='', folder='INBOX', uidvalidity=self.mailbox.uidvalidity, last_uid=0)
+
+    def _add_messages(self, batch, count=3):
+        for i in range(count):
+            self.mailbox.append(make_message(ALIAS, subject=f'Batch {batch} message {i}'))
+
+    def test_messages_forwarded_exactly_once_across_takeover(self):
+        ttl = 0.5
+        with FakeIMAPServer(mailbox=self.mailbox) as imap_server, FakeSMTPServer() as smtp_server, \
+                _daemon_settings(imap_server.port, smtp_server.port, SHARD_LEASES=True, LEASE_TTL=ttl):
+            first, second = EmailDaemon(), EmailDaemon()
+            for daemon in (first, second):
+                daemon.tokens = FixedTokenProvider()
+            try:
+                self._add_messages(1)
+                self.assertEqual(first.check_emails(), 3)
+                # The second replica stands by while the first holds the lease
+                self.assertEqual(second.check_emails(), 0)
+
+                # The first replica stalls past its TTL and the second takes over
+                time.sleep(ttl + 0.1)
+                self._add_messages(2)
+                self.assertEqual(second.check_emails(), 3)
+                with self.assertRaises(LeaseLost):
+                    first._advance_checkpoint(first.checkpoint.last_uid + 1)
+                self.assertEqual(first.check_emails(), 0)
+
+                self._add_messages(3)
+                self.assertEqual(second.check_emails(), 3)
+                self.assertEqual(first.check_emails(), 0)
+            finally:
+                for daemon in (first, second):
+                    daemon.session.close()
+                    daemon.smtp_pool.close()
+
+        copies = Counter(
+            (recipient, message_from_bytes(data)['Subject'])
+            for _, recipients, data in smtp_server.messages
+            for recipient in recipients
+        )
+        expected = {
+            (f'subscriber{i}@example.com', f'[STRESS] Batch {batch} message {n}')
+            for i in range(2) for batch in (1, 2, 3) for n in range(3)
+        }
+        self.assertEqual(set(copies), expected)
+        self.assertEqual(set(copies.values()), {1})
+        self.assertEqual(MailboxCheckpoint.objects.get().last_uid, 9)
+        self.assertEqual(ShardLease.objects.get().epoch, 2)
+
+
+class RoutingTableTests(TestCase):
+    """Every list or subscription change bumps the list's RoutingVersion and reaches the next lookup."""
+
+    def setUp(self):
+        self.mailing_list = MailingList.objects.create(alias=ALIAS)
+        self.subscriber = Subscriber.objects.create(email='subscriber0@example.com')
+        self.subscriber.mailing_lists.add(self.mailing_list)
+        self.routes = RoutingTable()
+        self.routes.refresh()
+
+    def _version(self, mailing_list=None):
+        return RoutingVersion.objects.get(mailing_list_id=(mailing_list or self.mailing_list).pk).version
+
+    def _subscribers(self, alias=ALIAS):
+        """Subscribers of *alias* in the next lookup, or None once the list is gone."""
+        self.routes.refresh()
+        route = self.routes.lookup(alias)
+        return None if route is None else set(route.subscribers)
+
+    def assertBumps(self, change, expected, mailing_list=None):
+        version = self._version(mailing_list)
+        change()
+        self.assertEqual(self._version(mailing_list), version + 1)
+        self.assertEqual(self._subscribers((mailing_list or self.mailing_list).alias), expected)
+
+    def test_subscriber_save_and_delete(self):
+        self.assertEqual(self._subscribers(), {'subscriber0@example.com'})
+        self.subscriber.is_active = False
+        self.assertBumps(self.subscriber.save, set())
+        self.subscriber.is_active = True
+        self.subscriber.email = 'renamed@example.com'
+        self.assertBumps(self.subscriber.save, {'renamed@example.com'})
+        self.assertBumps(self.subscriber.delete, set())
+
+    def test_subscription_add_remove_and_clear(self):
+        other = Subscriber.objects.create(email='subscriber1@example.com')
+        self.assertBumps(lambda: other.mailing_lists.add(self.mailing_list), {'subscriber0@example.com', 'subscriber1@example.com'})
+        self.assertBumps(lambda: other.mailing_lists.remove(self.mailing_list), {'subscriber0@example.com'})
+        # From the list's side of the relation
+        self.assertBumps(lambda: self.mailing_list.subscribers.add(other), {'subscriber0@example.com', 'subscriber1@example.com'})
+        self.assertBumps(lambda: self.mailing_list.subscribers.remove(self.subscriber), {'subscriber1@example.com'})
+        self.assertBumps(other.mailing_lists.clear, set())
+
+    def test_list_create_and_delete(self):
+        new_list = MailingList.objects.create(alias='new@cyphy.life')
+        self.assertEqual(self._version(new_list), 1)
+        self.assertEqual(self._subscribers('new@cyphy.life'), set())
+        pk, version = self.mailing_list.pk, self._version()
+        self.mailing_list.delete()
+        # The row outlives the list to announce its removal
+        self.assertEqual(RoutingVersion.objects.get(mailing_list_id=pk).version, version + 1)
+        self.assertIsNone(self._subscribers())
+        self.assertEqual(self._subscribers('new@cyphy.life'), set())
+
+    def test_daemon_routes_by_latest_subscriptions(self):
+        mailbox = FakeMailbox()
+        MailboxCheckpoint.objects.create(account='', folder='INBOX', uidvalidity=mailbox.uidvalidity, last_uid=0)
+        with FakeIMAPServer(mailbox=mailbox) as imap_server, FakeSMTPServer() as smtp_server, \
+                _daemon_settings(imap_server.port, smtp_server.port, ROUTING_CACHE=True):
+            daemon = EmailDaemon()
+            daemon.tokens = FixedTokenProvider()
+            try:
+                mailbox.append(make_message(ALIAS, subject='Before'))
+                self.assertEqual(daemon.check_emails(), 1)
+                Subscriber.objects.create(email='subscriber1@example.com').mailing_lists.add(self.mailing_list)
+                self.subscriber.delete()
+                mailbox.append(make_message(ALIAS, subject='After'))
+                self.assertEqual(daemon.check_emails(), 1)
+            finally:
+                daemon.session.close()
+                daemon.smtp_pool.close()
+        self.assertEqual([recipients for _, recipients, _ in smtp_server.messages], [['subscriber0@example.com'], ['subscriber1@example.com']])
+        self.assertEqual(daemon.routes.stats, {'full_loads': 1, 'partial_loads': 1})
+
+
+class DedupTests(TransactionTestCase):
+    """MESSAGE_DEDUP only remembers a message for the lists it actually reached (the pipeline sends from worker threads)."""
+
+    def setUp(self):
+        mailing_list = MailingList.objects.create(alias=ALIAS)
+        for i in range(2):
+            Subscriber.objects.create(email=f'subscriber{i}@example.com').mailing_lists.add(mailing_list)
+        self.mailbox = FakeMailbox()
+        MailboxCheckpoint.objects.create(account='', folder='INBOX', uidvalidity=self.mailbox.uidvalidity, last_uid=0)
+
+    def test_failed_forward_is_not_deduplicated(self):
+        for pipeline in (False, True):
+            with self.subTest(pipeline=pipeline):
+                raw = make_message(ALIAS, subject=f'Pipeline {pipeline}')
+                with FakeIMAPServer(mailbox=self.mailbox) as imap_server, FakeSMTPServer() as smtp_server, \
+                        _daemon_settings(imap_server.port, smtp_server.port, MESSAGE_DEDUP=True, PIPELINE=pipeline):
+                    # Every transaction gets a 451: nobody receives the first copy
+                    smtp_server.failure_rate = 1.0
+                    self.mailbox.append(raw)
+                    self.assertEqual(_check_once(), 1)
+                    self.assertEqual(smtp_server.messages, [])
+
+                    # The same message arriving again is forwarded, and only then remembered
+                    smtp_server.failure_rate = 0.0
+                    self.mailbox.append(raw)
+                    self.assertEqual(_check_once(), 1)
+                    self.mailbox.append(raw)
+                    self.assertEqual(_check_once(), 1)
+                self.assertEqual(len(smtp_server.messages), 2)
+                self.assertEqual(smtp_server.stats['failures'], 2)
+
+
+class _Killed(BaseException):
+    """Stands in for the daemon process dying mid fan-out."""
+
+
+class DeliveryQueueTests(TestCase):
+    """The database-backed delivery queue (DELIVERY_QUEUE) across daemon restarts."""
+
+    def setUp(self):
+        mailing_list = MailingList.objects.create(alias=ALIAS)
+        for i in range(3):
+            Subscriber.objects.create(email=f'subscriber{i}@example.com').mailing_lists.add(mailing_list)
+        self.mailbox = FakeMailbox()
+        MailboxCheckpoint.objects.create(account='', folder='INBOX', uidvalidity=self.mailbox.uidvalidity, last_uid=0)
+
+    def test_resume_after_kill_skips_claimed_deliveries(self):
+        record = DeliveryRecorder.record
+        flush = DeliveryRecorder.flush
+        killed = []
+
+        def dying_record(recorder, recipients, result):
+            # Killed after the second envelope was accepted, before its outcome was recorded
+            if killed or len(recorder.recorded) == 1:
+                killed.append(True)
+                raise _Killed()
+            record(recorder, recipients, result)
+
+        def dying_flush(recorder):
+            if not killed:
+                flush(recorder)
+
+        self.mailbox.append(make_message(ALIAS, subject='Queued'))
+        with FakeIMAPServer(mailbox=self.mailbox) as imap_server, FakeSMTPServer() as smtp_server, \
+                _daemon_settings(imap_server.port, smtp_server.port, DELIVERY_QUEUE=True, DELIVERY_INFLIGHT_TIMEOUT=1):
+            with mock.patch.object(DeliveryRecorder, 'record', dying_record), \
+                    mock.patch.object(DeliveryRecorder, 'flush', dying_flush):
+                with self.assertRaises(_Killed):
+                    _check_once()
+            self.assertEqual(len(smtp_server.messages), 2)
+
+            # A restart within the claim leaves the in-flight deliveries alone
+            _check_once()
+            self.assertEqual(len(smtp_server.messages), 2)
+
+            # Once the claim is stale, only the deliveries without a recorded outcome go out
+            time.sleep(1.1)
+            _check_once()
+
+        copies = Counter(recipient for _, recipients, _ in smtp_server.messages for recipient in recipients)
+        self.assertEqual(copies, {'subscriber0@example.com': 1, 'subscriber1@example.com': 2, 'subscriber2@example.com': 1})
+        self.assertEqual(set(Delivery.objects.values_list('status', flat=True)), {Delivery.SENT})
+
+    def test_drains_only_its_own_mailbox(self):
+        mailing_list = MailingList.objects.get()
+        # A nested folder shares the parent's source prefix ("/Lists/...")
+        for folder in ('Lists', 'Lists/Archive', 'Lists2'):
+            enqueue(make_message(ALIAS, subject=folder), f"/{folder}/1/1", mailing_list, account='', folder=folder)
+
+        with FakeSMTPServer() as smtp_server, _daemon_settings(0, smtp_server.port, DELIVERY_QUEUE=True):
+            daemon = EmailDaemon(shard=Shard('lists', '', 'Lists'))
+            daemon.tokens = FixedTokenProvider()
+            try:
+                self.assertEqual(daemon.drain_deliveries(), 3)
+            finally:
+                daemon.session.close()
+                daemon.smtp_pool.close()
+
+        self.assertEqual({message_from_bytes(data)['Subject'] for _, _, data in smtp_server.messages}, {'[STRESS] Lists'})
+        pending = Delivery.objects.filter(status=Delivery.PENDING).values_list('message__folder', flat=True)
+        self.assertEqual(Counter(pending), {'Lists/Archive': 3, 'Lists2': 3})
+
+
+class AsyncEngineTests(TransactionTestCase):
+    """The asyncio engine's SMTP sessions: STARTTLS and recovering from sessions the server dropped."""
+
+    def setUp(self):
+        mailing_list = MailingList.objects.create(alias=ALIAS)
+        for i in range(2):
+            Subscriber.objects.create(email=f'subscriber{i}@example.com').mailing_lists.add(mailing_list)
+        self.mailbox = FakeMailbox()
+        MailboxCheckpoint.objects.create(account='', folder='INBOX', uidvalidity=self.mailbox.uidvalidity, last_uid=0)
+
+    def _run(self, smtp_server, checks, between=None, **overrides):
+        """Run a check per entry of *checks*, appending that many messages first; returns the processed counts."""
+        async def go():
+            daemon = AsyncEmailDaemon()
+            daemon.tokens = FixedTokenProvider()
+            processed = []
+            try:
+                for i, messages in enumerate(checks):
+                    if i and between is not None:
+                        between(daemon)
+                    for _ in range(messages):
+                        self.mailbox.append(make_message(ALIAS, subject=f'Check {i}'))
+                    processed.append(await daemon.check_emails_async())
+            finally:
+                await daemon.close()
+            return processed
+
+        with FakeIMAPServer(mailbox=self.mailbox) as imap_server:
+            with _daemon_settings(imap_server.port, smtp_server.port, **overrides):
+                return asyncio.run(go())
+
+    def test_starttls(self):
+        with FakeSMTPServer(tls=True) as smtp_server, mock.patch.dict(os.environ, {'SSL_CERT_FILE': TLS_CERT_FILE}):
+            processed = self._run(smtp_server, [2], SMTP_USE_TLS=True, ASYNC_SMTP_CONCURRENCY=1)
+        self.assertEqual(processed, [2])
+        self.assertEqual(smtp_server.stats['tls'], 1)
+        self.assertEqual(smtp_server.stats['messages'], 4)
+
+    def test_dropped_idle_session_is_replaced(self):
+        def drop(daemon):
+            # Gmail closing a session that sat idle between checks
+            smtp_server.drop_connections()
+
+        with FakeSMTPServer() as smtp_server:
+            processed = self._run(smtp_server, [1, 1], between=drop, ASYNC_SMTP_CONCURRENCY=1)
+        self.assertEqual(processed, [1, 1])
+        self.assertEqual(smtp_server.stats['messages'], 4)
+        self.assertEqual(smtp_server.stats['connections'], 2)
+
+    def test_send_retried_once_after_disconnect(self):
+        def drop_unnoticed(daemon):
+            # A drop the NOOP health check cannot see: the session dies right after it passes
+            async def alive(entry):
+                smtp_server.drop_connections()
+                return True
+            daemon.smtp._is_alive = alive
+
+        with FakeSMTPServer() as smtp_server:
+            processed = self._run(smtp_server, [1, 1], between=drop_unnoticed, ASYNC_SMTP_CONCURRENCY=1)
+        self.assertEqual(processed, [1, 1])
+        self.assertEqual(smtp_server.stats['messages'], 4)
+
+    def test_sessions_idle_past_max_idle_are_recycled(self):
+        recycled = []
+
+        def expire(daemon):
+            daemon.smtp.max_idle = 0.1
+            time.sleep(0.2)
+            recycled.append(daemon.smtp)
+
+        with FakeSMTPServer() as smtp_server:
+            self._run(smtp_server, [1, 1], between=expire, ASYNC_SMTP_CONCURRENCY=1)
+        self.assertEqual(smtp_server.stats['messages'], 4)
+        self.assertEqual(smtp_server.stats['connections'], 2)
+        self.assertEqual(recycled[0].stats['recycled'], 1)
+
+
+class MetricsViewTests(TestCase):
+    def test_not_served_without_a_token(self):
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get('/metrics/').status_code, 404)
+
+    def test_requires_the_token(self):
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics/').status_code, 401)
+            self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+            response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'emaildaemon_web_requests_total', response.content)
+
+
+class SMTPPoolTests(TestCase):
+    """Pooled sessions and send_envelope() against the stand-in SMTP server."""
+
+    def _pool(self, smtp_server, **options):
+        def connect():
+            return smtplib.SMTP('127.0.0.1', smtp_server.port, timeout=10), None
+        pool = SMTPConnectionPool(connect, **options)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_drop_before_data_is_retried(self):
+        with FakeSMTPServer() as smtp_server:
+            smtp_server.drop_once = 'MAIL'
+            with self._pool(smtp_server).session() as session:
+                self.assertEqual(session.send_envelope('list@cyphy.life', ['a@example.com'], b'Subject: x\r\n\r\nx\r\n'), {})
+        self.assertEqual(smtp_server.stats['messages'], 1)
+        self.assertEqual(smtp_server.stats['connections'], 2)
+
+    def test_drop_after_data_is_not_resent(self):
+        with FakeSMTPServer() as smtp_server:
+            smtp_server.drop_once = 'DATA'
+            with self._pool(smtp_server).session() as session:
+                with self.assertRaises(SMTPDataLost):
+                    session.send_envelope('list@cyphy.life', ['a@example.com'], b'Subject: x\r\n\r\nx\r\n')
+        self.assertEqual(smtp_server.stats['messages'], 1)
+        self.assertEqual(smtp_server.stats['connections'], 1)
+
+    def _run_async_pool(self, smtp_server, send, **options):
+        """Run *send*(pool) on an AsyncSMTPPool, closing the pool afterwards; returns the clients it connected."""
+        clients = []
+
+        async def connect():
+            client = await AsyncSMTPClient.connect('127.0.0.1', smtp_server.port, use_tls=False, timeout=10)
+            clients.append(client)
+            return client, None
+
+        async def go():
+            pool = AsyncSMTPPool(connect, **options)
+            try:
+                await send(pool)
+            finally:
+                await pool.close()
+
+        asyncio.run(go())
+        return clients
+
+    def test_async_drop_after_data_is_not_resent(self):
+        async def send(pool):
+            with self.assertRaises(SMTPDataLost):
+                await pool.send_envelope('list@cyphy.life', ['a@example.com'], b'Subject: x\r\n\r\nx\r\n')
+
+        with FakeSMTPServer() as smtp_server:
+            smtp_server.drop_once = 'DATA'
+            self._run_async_pool(smtp_server, send)
+        self.assertEqual(smtp_server.stats['messages'], 1)
+        self.assertEqual(smtp_server.stats['connections'], 1)
+
+    def test_async_close_waits_for_retired_sessions(self):
+        async def send(pool):
+            for _ in range(2):
+                await pool.send_envelope('list@cyphy.life', ['a@example.com'], b'Subject: x\r\n\r\nx\r\n')
+
+        # Sessions retire after each message; their QUIT takes a round trip of 0.2 s
+        with FakeSMTPServer(latency=0.2) as smtp_server:
+            clients = self._run_async_pool(smtp_server, send, max_messages=1)
+        self.assertEqual(len(clients), 2)
+        self.assertTrue(all(client.writer.is_closing() for client in clients))
+        self.assertEqual(smtp_server.commands.count('QUIT'), 2)
+
+    def _smtp(self, smtp_server):
+        smtp = smtplib.SMTP('127.0.0.1', smtp_server.port, timeout=10)
+        self.addCleanup(smtp.close)
+        smtp.ehlo()
+        return smtp
+
+    def test_pipelined_partial_refusal(self):
+        with FakeSMTPServer(reject={'b@example.com'}) as smtp_server:
+            smtp = self._smtp(smtp_server)
+            with mock.patch.object(smtp, 'send', wraps=smtp.send) as send:
+                refused = send_envelope(smtp, 'list@cyphy.life', ['a@example.com', 'b@example.com', 'c@example.com'], b'Subject: x\r\n\r\nx\r\n')
+        self.assertEqual(list(refused), ['b@example.com'])
+        self.assertEqual(refused['b@example.com'][0], 550)
+        self.assertEqual(smtp_server.messages, [('list@cyphy.life', ['a@example.com', 'c@example.com'], b'Subject: x\r\n\r\nx\r\n')])
+        # MAIL FROM and all three RCPT TO went out in a single write
+        envelope = send.call_args_list[0].args[0]
+        self.assertEqual((envelope.count('MAIL FROM'), envelope.count('RCPT TO')), (1, 3))
+
+    def test_all_recipients_refused_skips_data(self):
+        recipients = ['a@example.com', 'b@example.com']
+        with FakeSMTPServer(reject=recipients) as smtp_server:
+            refused = send_envelope(self._smtp(smtp_server), 'list@cyphy.life', recipients, b'Subject: x\r\n\r\nx\r\n')
+        self.assertEqual(sorted(refused), recipients)
+        self.assertEqual(smtp_server.commands, ['EHLO', 'MAIL', 'RCPT', 'RCPT', 'RSET'])
+        self.assertEqual(smtp_server.messages, [])
+
+    def test_refused_sender_raises(self):
+        with FakeSMTPServer(reject={'list@cyphy.life'}) as smtp_server:
+            with self.assertRaises(smtplib.SMTPSenderRefused) as raised:
+                send_envelope(self._smtp(smtp_server), 'list@cyphy.life', ['a@example.com'], b'Subject: x\r\n\r\nx\r\n')
+        self.assertEqual(raised.exception.smtp_code, 550)
+        self.assertEqual(smtp_server.commands, ['EHLO', 'MAIL', 'RCPT', 'RSET'])
+        self.assertEqual(smtp_server.messages, [])
+
+    def test_without_pipelining(self):
+        with FakeSMTPServer(extensions=('8BITMIME',), reject={'b@example.com'}) as smtp_server:
+            smtp = self._smtp(smtp_server)
+            with mock.patch.object(smtp, 'send', wraps=smtp.send) as send:
+                refused = send_envelope(smtp, 'list@cyphy.life', ['a@example.com', 'b@example.com'], b'Subject: x\r\n\r\nx\r\n')
+            self.assertEqual(list(refused), ['b@example.com'])
+            # One write per envelope command, each answered before the next
+            self.assertEqual(send.call_args_list[1].args[0], 'RCPT TO:<a@example.com>\r\n')
+            smtp_server.reject.add('list@cyphy.life')
+            with self.assertRaises(smtplib.SMTPSenderRefused):
+                send_envelope(smtp, 'list@cyphy.life', ['a@example.com'], b'Subject: x\r\n\r\nx\r\n')
+        self.assertEqual(smtp_server.messages, [('list@cyphy.life', ['a@example.com'], b'Subject: x\r\n\r\nx\r\n')])
+        # The refused MAIL FROM is not followed by any RCPT TO
+        self.assertEqual(smtp_server.commands[-2:], ['MAIL', 'RSET'])
+
+    def test_8bitmime_only_when_advertised(self):
+        data = 'Subject: caf\u00e9\r\n\r\nd\u00e9j\u00e0 vu\r\n'.encode()
+
+        async def send_async(port):
+            client = await AsyncSMTPClient.connect('127.0.0.1', port, use_tls=False, timeout=10)
+            try:
+                return await client.send_envelope('list@cyphy.life', ['a@example.com'], data, ('BODY=8BITMIME',))
+            finally:
+                await client.quit()
+
+        for extensions in [('PIPELINING', '8BITMIME'), ('PIPELINING',), ()]:
+            with self.subTest(extensions=extensions), FakeSMTPServer(extensions=extensions) as smtp_server:
+                self.assertEqual(send_envelope(self._smtp(smtp_server), 'list@cyphy.life', ['a@example.com'], data, ('BODY=8BITMIME',)), {})
+                self.assertEqual(asyncio.run(send_async(smtp_server.port)), {})
+                self.assertEqual(smtp_server.messages, [('list@cyphy.life', ['a@example.com'], data)] * 2)
+
+
+class TokenProviderTests(TransactionTestCase):
+    """The shared OAuth2 access token against a stand-in token endpoint; providers play separate processes."""
+
+    account = 'tokens@cyphy.life'
+
+    def _provider(self, token_server):
+        fetch = functools.partial(request_token, token_server.url, 'refresh-token', 'client-id', 'client-secret')
+        return TokenProvider(self.account, fetch, margin=300, poll_interval=0.05)
+
+    def _in_thread(self, target):
+        """Run *target* on its own thread (and database connection); returns a join() that yields its result."""
+        result = []
+
+        def run():
+            try:
+                result.append(target())
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+
+        def join():
+            thread.join(timeout=10)
+            return result[0]
+        return join
+
+    def test_refresh_on_expiry(self):
+        with FakeTokenServer(expires_in=600) as token_server:
+            provider = self._provider(token_server)
+            self.assertEqual(provider.get_token(), 'fake-token-1')
+            self.assertEqual(provider.get_token(), 'fake-token-1')
+            self.assertEqual(token_server.stats['requests'], 1)
+
+            # Ten minutes on the token is inside the 300 s margin: the next call refreshes it
+            later = timezone.now() + timedelta(seconds=400)
+            with mock.patch('emails.oauth.timezone.now', return_value=later):
+                self.assertEqual(provider.get_token(), 'fake-token-2')
+        self.assertEqual(token_server.stats['requests'], 2)
+        self.assertEqual(provider.stats['refreshes'], 2)
+        row = OAuthToken.objects.get()
+        self.assertEqual(row.access_token, 'fake-token-2')
+        self.assertIsNone(row.refreshing_until)
+
+    def test_claim_held_by_another_process(self):
+        now = timezone.now()
+        OAuthToken.objects.create(account=self.account, access_token='old-token', expires_at=now + timedelta(seconds=60),
+                                  refreshing_until=now + timedelta(seconds=30))
+        with FakeTokenServer() as token_server:
+            provider = self._provider(token_server)
+            # Close to expiry but still usable while the other process refreshes it
+            self.assertEqual(provider.get_token(), 'old-token')
+
+            # Expired: wait for the other process to store the new token
+            OAuthToken.objects.update(expires_at=now)
+            join = self._in_thread(provider.get_token)
+            time.sleep(0.2)
+            OAuthToken.objects.update(access_token='new-token', expires_at=now + timedelta(hours=1), refreshing_until=None)
+            self.assertEqual(join(), 'new-token')
+            self.assertEqual(provider.stats['waits'], 1)
+            self.assertEqual(token_server.stats['requests'], 0)
+
+            # A claim left behind by a process that died mid-refresh is taken over once stale
+            OAuthToken.objects.update(expires_at=now, refreshing_until=now - timedelta(seconds=1))
+            provider.invalidate()
+            self.assertEqual(provider.get_token(), 'fake-token-1')
+        self.assertEqual(token_server.stats['requests'], 1)
+
+    def test_providers_share_one_refresh(self):
+        with FakeTokenServer(latency=0.3) as token_server:
+            providers = [self._provider(token_server) for _ in range(2)]
+            joins = [self._in_thread(provider.get_token) for provider in providers]
+            tokens = [join() for join in joins]
+        self.assertEqual(tokens, ['fake-token-1', 'fake-token-1'])
+        self.assertEqual(token_server.stats['requests'], 1)
+        self.assertEqual(sorted(provider.stats['refreshes'] for provider in providers), [0, 1])
+        self.assertEqual(OAuthToken.objects.get().access_token, 'fake-token-1')
+
+
+class OutboxTests(TestCase):
+    """The web app's background sender, with the test runner's in-memory email backend."""
+
+    def setUp(self):
+        self.mailing_lists = [MailingList.objects.create(alias=f'list{i}@cyphy.life') for i in range(3)]
+
+    def _outbox(self, **options):
+        outbox = Outbox(**options)
+        self.addCleanup(outbox.stop)
+        return outbox
+
+    def test_unsubscribes_coalesce_into_one_email(self):
+        outbox = self._outbox(coalesce=0.5)
+        outbox.put(UNSUBSCRIBE, 'reader@example.com', self.mailing_lists[:1])
+        for mailing_list in self.mailing_lists[1:]:
+            # Addresses are matched case-insensitively, and a list asked for twice is linked once
+            outbox.put(UNSUBSCRIBE, 'Reader@example.com', [mailing_list, self.mailing_lists[0]])
+        outbox.put(SUBSCRIBE, 'new@example.com', self.mailing_lists[:1])
+        outbox.join()
+
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ['new@example.com', 'reader@example.com'])
+        unsubscribe = next(message for message in mail.outbox if message.to == ['reader@example.com'])
+        self.assertEqual(unsubscribe.subject, 'Unsubscribe Confirmation - list0@cyphy.life, list1@cyphy.life, list2@cyphy.life')
+        self.assertEqual(outbox.stats['queued'], 4)
+        self.assertEqual(outbox.stats['coalesced'], 2)
+        self.assertEqual(outbox.stats['sent'], 2)
+        self.assertEqual(outbox.stats['connections'], 1)
+
+    def test_full_queue_sends_in_the_request(self):
+        outbox = self._outbox(queue_size=1)
+        # Keep the sending thread from draining the queue
+        with mock.patch.object(outbox, '_start'):
+            outbox.put(SUBSCRIBE, 'first@example.com', self.mailing_lists[:1])
+            self.assertEqual(mail.outbox, [])
+            outbox.put(SUBSCRIBE, 'second@example.com', self.mailing_lists[:1])
+            # Sent inline, before put() returned
+            self.assertEqual([message.to for message in mail.outbox], [['second@example.com']])
+        self.assertEqual(outbox.stats['queued'], 1)
+
+        outbox.put(SUBSCRIBE, 'third@example.com', self.mailing_lists[:1])
+        outbox.join()
+        self.assertEqual(
+            [message.to[0] for message in mail.outbox], ['second@example.com', 'first@example.com', 'third@example.com'],
+        )
+
+    def test_stop_sends_what_is_queued(self):
+        outbox = self._outbox(coalesce=30)
+        outbox.put(UNSUBSCRIBE, 'reader@example.com', self.mailing_lists[:1])
+        started = time.monotonic()
+        # Does not wait out the coalescing window
+        outbox.stop()
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([message.to for message in mail.outbox], [['reader@example.com']])
+        self.assertIsNone(outbox._thread)
+        self.assertIsNone(outbox._connection)
+
+        # The next email starts the thread again
+        outbox.put(SUBSCRIBE, 'new@example.com', self.mailing_lists[:1])
+        outbox.join()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_session_closed_when_idle_or_used_up(self):
+        outbox = self._outbox(coalesce=0, idle_timeout=0.2, max_messages=2)
+        for i in range(3):
+            outbox.put(SUBSCRIBE, f'new{i}@example.com', self.mailing_lists[:1])
+            outbox.join()
+        self.assertEqual(outbox.stats['connections'], 2)
+        self.assertIsNotNone(outbox._connection)
+        time.sleep(0.5)
+        self.assertIsNone(outbox._connection)
+        self.assertEqual(outbox.stats['sent'], 3)
@@ -0,0 +1,285 @@
+"""
+Per-message latency traces, from the mailbox's INTERNALDATE to the SMTP
+server accepting the last copy. A trace starts when a list message's
+routing headers are fetched and collects spans for the header fetch,
+routing, the body fetch, queueing (between pipeline stages, in the
+delivery queue), parsing and every send. Each list the message goes to is
+saved as one MessageTrace with its end-to-end latency; the message_traces
+command summarises and exports them.
+
+Spans are stored as [name, start, duration] in milliseconds since the
+header fetch began, and send spans add [recipients, delivered]. A send is
+timed from the previous one to the same list (or from when the list's
+forwarding began), so with sender workers or the async engine, where
+sends overlap, send spans show the spacing of acceptances rather than
+single SMTP transactions; SMTP_SEND_SECONDS has those. INTERNALDATE has
+one-second resolution, and so do the latencies measured from it.
+"""
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+
+from .models import MessageTrace
+
+logger = logging.getLogger(__name__)
+
+INTERNALDATE_FORMAT = '%d-%b-%Y %H:%M:%S %z'
+# Queueing shorter than this is not worth a span
+MIN_QUEUE_MS = 1.0
+
+
+def parse_internaldate(value):
+    """An aware datetime for an IMAP INTERNALDATE such as '17-Jul-1996 02:44:25 -0700', or None."""
+    try:
+        return datetime.strptime(value.strip(), INTERNALDATE_FORMAT)
+    except (AttributeError, ValueError):
+        return None
+
+
+def span(trace, name, alias=None):
+    """trace.span(), or a no-op context without a trace."""
+    return trace.span(name, alias) if trace is not None else nullcontext()
+
+
+class _ListTrace:
+    """The spans and send counts of a trace for one of the message's lists."""
+
+    __slots__ = ('spans', 'last', 'delivered', 'refused', 'accepted')
+
+    def __init__(self, last):
+        self.spans = []
+        self.last = last  # end of the latest span, where waiting starts
+        self.delivered = 0
+        self.refused = 0
+        self.accepted = None  # when the latest copy was accepted
+
+
+class Trace:
+    """
+    The spans of one message, timed on the monotonic clock from *origin*.
+    Spans recorded before the message is split into lists are shared by all
+    of them; the rest are kept per list alias.
+    """
+
+    def __init__(self, source, message_id='', arrived_at=None, origin=None, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.source = source
+        self.message_id = message_id
+        self.arrived_at = arrived_at
+        self.origin = time.monotonic() if origin is None else origin
+        self.fetched_at = timezone.now() - timedelta(seconds=time.monotonic() - self.origin)
+        self.spans = []
+        self.last = self.origin
+        self.lists = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def resume(cls, source, alias):
+        """The saved, unfinished trace of *source* for the list *alias*, to add queued sends to; None without one."""
+        row = MessageTrace.objects.filter(source=source, mailing_list=alias, completed_at__isnull=True).last()
+        if row is None:
+            return None
+        origin = time.monotonic() - (timezone.now() - row.fetched_at).total_seconds()
+        trace = cls(row.source, row.message_id, row.arrived_at, origin, row.trace_id)
+        trace.fetched_at = row.fetched_at
+        state = trace._list(alias)
+        state.spans = list(row.spans)
+        state.last = origin + max((start + duration for _, start, duration, *_ in row.spans), default=0) / 1000
+        state.delivered = row.delivered
+        state.refused = row.refused
+        accepted = [start + duration for name, start, duration, *detail in row.spans if name == 'send' and detail[0][1]]
+        if accepted:
+            state.accepted = origin + max(accepted) / 1000
+        return trace
+
+    def _ms(self, moment):
+        return round((moment - self.origin) * 1000, 1)
+
+    def _list(self, alias):
+        state = self.lists.get(alias)
+        if state is None:
+            state = self.lists[alias] = _ListTrace(self.last)
+        return state
+
+    def add(self, name, start, end=None, alias=None, detail=None):
+        """Record a span from *start* to *end* (default now), monotonic times, for *alias* or every list."""
+        if end is None:
+            end = time.monotonic()
+        entry = [name, self._ms(start), round((end - start) * 1000, 1)]
+        if detail is not None:
+            entry.append(detail)
+        with self._lock:
+            if alias is None:
+                self.spans.append(entry)
+                self.last = max(self.last, end)
+            else:
+                state = self._list(alias)
+                state.spans.append(entry)
+                state.last = max(state.last, end)
+
+    def queued(self, until=None, alias=None):
+        """Record the time since the latest span, up to *until* (default now), as a queue span."""
+        if until is None:
+            until = time.monotonic()
+        with self._lock:
+            last = self._list(alias).last if alias is not None else self.last
+        if (until - last) * 1000 >= MIN_QUEUE_MS:
+            self.add('queue', last, until, alias)
+
+    @contextmanager
+    def span(self, name, alias=None):
+        """Record the with-block as a span."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, started, alias=alias)
+
+    def recorder(self, alias, record=None):
+        """A record callback for _forward() that adds a send span per envelope, then passes it on to *record*."""
+        with self._lock:
+            state = self._list(alias)
+            state.last = max(state.last, time.monotonic())
+
+        def recorded(recipients, result):
+            now = time.monotonic()
+            delivered = 0 if isinstance(result, Exception) else len(recipients) - len(result)
+            with self._lock:
+                state.spans.append([
+                    'send', self._ms(state.last), round((now - state.last) * 1000, 1), [len(recipients), delivered],
+                ])
+                state.last = now
+                state.delivered += delivered
+                state.refused += len(recipients) - delivered
+                if delivered:
+                    state.accepted = now
+            if record is not None:
+                record(recipients, result)
+
+        return recorded
+
+    def save(self, alias, complete=True):
+        """
+        Write the trace for the list *alias*: *complete* once none of its
+        copies are left to send, which fixes its end-to-end latency.
+        """
+        with self._lock:
+            state = self._list(alias)
+            spans = self.spans + state.spans
+            finished = state.accepted if state.accepted is not None else state.last
+        completed_at = latency_ms = None
+        if complete:
+            completed_at = self.fetched_at + timedelta(seconds=finished - self.origin)
+            if state.accepted is not None:
+                latency = completed_at - (self.arrived_at or self.fetched_at)
+                latency_ms = max(0, round(latency.total_seconds() * 1000))
+        fields = {
+            'source': self.source,
+            'message_id': self.message_id[:998],
+            'arrived_at': self.arrived_at,
+            'fetched_at': self.fetched_at,
+            'spans': spans,
+            'delivered': state.delivered,
+            'refused': state.refused,
+            'completed_at': completed_at,
+            'latency_ms': latency_ms,
+        }
+        try:
+            # Not update_or_create(): its transaction fails at once on a busy SQLite database instead of waiting
+            if not MessageTrace.objects.filter(trace_id=self.trace_id, mailing_list=alias).update(**fields):
+                MessageTrace.objects.create(trace_id=self.trace_id, mailing_list=alias, **fields)
+        except Exception as e:
+            # Losing a trace must not affect forwarding
+            logger.error(f"Error saving trace {self.trace_id} for {alias}: {str(e)}")
+
+class Tracer:
+    """
+    The traces of the list messages found by the current check, by UID,
+    until processing picks them up, and pruning of old traces.
+    """
+
+    def __init__(self, retention=None):
+        self.retention = retention
+        self.traces = {}
+        self._last_prune = None
+
+    def start(self, uid, source, headers, internaldate, fetched, routed):
+        """
+        Trace the message *uid*: *fetched* is the (start, end) of the header
+        FETCH it came in and *routed* when routing it began.
+        """
+        trace = Trace(source, headers.get('Message-ID', ''), parse_internaldate(internaldate), fetched[0])
+        trace.add('fetch_headers', *fetched)
+        trace.add('route', routed)
+        self.traces[uid] = trace
+        return trace
+
+    def pop(self, uid):
+        return self.traces.pop(uid, None)
+
+    def clear(self):
+        self.traces.clear()
+
+    def prune(self, interval=3600):
+        """Delete traces older than the retention period, at most once per *interval* seconds."""
+        now = timezone.now()
+        if self.retention is None or (self._last_prune and (now - self._last_prune).total_seconds() < interval):
+            return 0
+        self._last_prune = now
+        deleted, _ = MessageTrace.objects.filter(fetched_at__lt=now - self.retention).delete()
+        if deleted:
+            logger.info(f"Pruned {deleted} message traces older than {self.retention.days} days")
+        return deleted
+
+
+def _percentile(values, pct):
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def summarize(traces):
+    """
+    Per list: completed traces, p50/p95/p99/max end-to-end latency in ms,
+    and the mean total duration of each kind of span per message.
+    """
+    by_list = {}
+    for trace in traces:
+        by_list.setdefault(trace.mailing_list, []).append(trace)
+    summary = []
+    for alias, rows in sorted(by_list.items()):
+        latencies = sorted(row.latency_ms for row in rows if row.latency_ms is not None)
+        phases = {}
+        for row in rows:
+            for name, _, duration, *_ in row.spans:
+                phases[name] = phases.get(name, 0) + duration
+        summary.append({
+            'mailing_list': alias,
+            'messages': len(rows),
+            'p50_ms': _percentile(latencies, 50) if latencies else None,
+            'p95_ms': _percentile(latencies, 95) if latencies else None,
+            'p99_ms': _percentile(latencies, 99) if latencies else None,
+            'max_ms': latencies[-1] if latencies else None,
+            'mean_span_ms': {name: round(total / len(rows), 1) for name, total in phases.items()},
+        })
+    return summary
+
+
+def as_json(trace):
+    """A MessageTrace as a JSON-serialisable dict, one line of an export."""
+    return {
+        'trace_id': trace.trace_id,
+        'source': trace.source,
+        'message_id': trace.message_id,
+        'mailing_list': trace.mailing_list,
+        'arrived_at': trace.arrived_at.isoformat() if trace.arrived_at else None,
+        'fetched_at': trace.fetched_at.isoformat(),
+        'completed_at': trace.completed_at.isoformat() if trace.completed_at else None,
+        'latency_ms': trace.latency_ms,
+        'delivered': trace.delivered,
+        'refused': trace.refused,
+        'spans': trace.spans,
+    }
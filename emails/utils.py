@@ -1,4 +1,4 @@
-from django.core.mail import send_mail
+from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
 from django.conf import settings
 from django.urls import reverse
@@ -7,22 +7,23 @@ from django.utils.encoding import force_bytes
 import jwt
 from datetime import datetime, timedelta
 
-def send_subscription_confirmation(email, mailing_lists):
+def _html_email(subject, message, email):
+    email_message = EmailMultiAlternatives(subject, message, settings.EMAIL_ADDRESS, [email])
+    email_message.attach_alternative(message, 'text/html')
+    return email_message
+
+def subscription_confirmation_message(email, mailing_lists):
+    """The subscription confirmation for *email*, ready to send"""
     subject = 'Subscription Confirmation - Cyphy.life Mailing Lists'
-    lists_str = ", ".join([ml.alias for ml in mailing_lists])
 
     message = render_to_string('emails/subscription_email.html', {
         'email': email,
         'mailing_lists': mailing_lists,
     })
+    return _html_email(subject, message, email)
 
-    send_mail(
-        subject,
-        message,
-        settings.EMAIL_ADDRESS,
-        [email],
-        html_message=message,
-    )
+def send_subscription_confirmation(email, mailing_lists):
+    subscription_confirmation_message(email, mailing_lists).send()
 
 def generate_unsubscribe_token(email, list_id):
     """Generate a JWT token for unsubscribe confirmation"""
@@ -41,22 +42,20 @@ def verify_unsubscribe_token(token):
     except:
         return None, None
 
-def send_unsubscribe_email(email, mailing_list):
-    """Send email with unsubscribe confirmation link"""
-    token = generate_unsubscribe_token(email, mailing_list.id)
-    unsubscribe_link = f"{settings.SITE_URL}{reverse('unsubscribe_confirm')}?token={token}"
+def unsubscribe_message(email, mailing_lists):
+    """One email with an unsubscribe confirmation link for each of *mailing_lists*, ready to send"""
+    links = []
+    for mailing_list in mailing_lists:
+        token = generate_unsubscribe_token(email, mailing_list.id)
+        links.append((mailing_list, f"{settings.SITE_URL}{reverse('unsubscribe_confirm')}?token={token}"))
 
-    subject = f'Unsubscribe Confirmation - {mailing_list.alias}'
+    subject = f"Unsubscribe Confirmation - {', '.join(ml.alias for ml in mailing_lists)}"
     message = render_to_string('emails/unsubscribe_email.html', {
         'email': email,
-        'mailing_list': mailing_list,
-        'unsubscribe_link': unsubscribe_link,
+        'links': links,
     })
+    return _html_email(subject, message, email)
 
-    send_mail(
-        subject,
-        message,
-        settings.EMAIL_ADDRESS,
-        [email],
-        html_message=message,
-    )
+def send_unsubscribe_email(email, mailing_list):
+    """Send email with unsubscribe confirmation link"""
+    unsubscribe_message(email, [mailing_list]).send()
@@ -10,7 +10,9 @@ from django.conf import settings
 from django.shortcuts import render, redirect
 from django.contrib import messages
 from .forms import SubscriptionForm, UnsubscribeForm
-from .utils import send_subscription_confirmation, send_unsubscribe_email, verify_unsubscribe_token
+from .utils import verify_unsubscribe_token
+from .outbox import queue_subscription_confirmation, queue_unsubscribe_email
+from . import metrics
 
 @csrf_exempt
 def test_webhook(request):
@@ -64,7 +66,7 @@ def mailing_lists(request):
                 subscriber.save()
 
                 # Send confirmation email
-                send_subscription_confirmation(email, selected_lists)
+                queue_subscription_confirmation(email, selected_lists)
 
                 messages.success(request, 'Successfully subscribed! Please check your email for confirmation.')
                 return redirect('mailing_lists')
@@ -92,15 +94,17 @@ def mailing_lists(request):
                 messages.error(request, 'Please select at least one list to unsubscribe from.')
                 return redirect('mailing_lists')
 
-            # Send unsubscribe confirmation email for each selected list
+            # One unsubscribe confirmation email with a link for each selected list
+            mailing_lists = []
             for list_id in lists_to_unsubscribe:
                 try:
-                    mailing_list = MailingList.objects.get(id=list_id)
-                    send_unsubscribe_email(email, mailing_list)
+                    mailing_lists.append(MailingList.objects.get(id=list_id))
                 except MailingList.DoesNotExist:
                     continue
+            if mailing_lists:
+                queue_unsubscribe_email(email, mailing_lists)
 
-            messages.success(request, 'Unsubscribe confirmation emails have been sent. Please check your inbox.')
+            messages.success(request, 'An unsubscribe confirmation email has been sent. Please check your inbox.')
             return redirect('mailing_lists')
 
     return render(request, 'emails/mailing_lists.html', {
@@ -126,3 +130,12 @@ def unsubscribe_confirm(request):
         messages.error(request, 'Invalid or expired unsubscribe link.')
 
     return redirect('mailing_lists')
+
+@require_GET
+def metrics_view(request):
+    """This web worker's metrics in the Prometheus text format, behind METRICS_TOKEN; not served without one."""
+    if not settings.METRICS_TOKEN:
+        return HttpResponse('Not Found', status=404)
+    if request.headers.get('Authorization') != f'Bearer {settings.METRICS_TOKEN}':
+        return HttpResponse('Unauthorized', status=401)
+    return HttpResponse(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)